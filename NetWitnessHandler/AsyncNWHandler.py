@@ -0,0 +1,391 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  AsyncNWHandler.py:
+
+  asyncio front end to NWHandler, exposing the NWDB query operations as coroutines so many queries can be kept in flight from a single process.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+import aiohttp
+try:
+    from .NetWitnessHandler import SERVICE_REPORT
+    from .NWTransport import TRANSPORT_DEFAULTS
+    from .NWMetrics import BYTES_BUCKETS, COUNT_BUCKETS
+    from .NWQuery import NWQueryError, isImmutable
+except ImportError:
+    from NetWitnessHandler import SERVICE_REPORT
+    from NWTransport import TRANSPORT_DEFAULTS
+    from NWMetrics import BYTES_BUCKETS, COUNT_BUCKETS
+    from NWQuery import NWQueryError, isImmutable
+
+# Defaults applied when the 'async' section of nwhandler_config.yaml omits a setting
+ASYNC_DEFAULTS = {
+    'max_concurrency': 200,
+    'limit_per_host': 0,
+    'wsgi_threads': 32
+}
+
+
+class RetryableStatus(Exception):
+    # Response status of a failed attempt that fetch() retries
+    def __init__(self, status):
+        super().__init__('NWDB returned HTTP ' + str(status))
+        self.status = status
+
+
+class AsyncNWHandler:
+
+    # Constructor
+    # * Wraps an NWHandler and uses its services, query validation, meta pivot, query cache, local session store and metrics; only the NWDB calls are made here, over aiohttp. The aiohttp session is created lazily on the running event loop.
+    # @param handler NWHandler instance to wrap
+    def __init__(self, handler):
+        self.handler = handler
+        self.metrics = handler.metrics
+        self.async_settings = dict(ASYNC_DEFAULTS)
+        self.async_settings.update(handler.config['netwitness'].get('async') or {})
+        transport = dict(TRANSPORT_DEFAULTS)
+        transport.update(handler.config['netwitness'].get('transport') or {})
+        self.timeout = aiohttp.ClientTimeout(sock_connect=float(transport['connect_timeout']), sock_read=float(transport['read_timeout']))
+        self.verify = transport['verify']
+        # Same retry policy as NWTransport: connection errors, timeouts and status_forcelist responses are retried with exponential backoff
+        self.retries = int(transport['retries'])
+        self.backoff_factor = float(transport['backoff_factor'])
+        self.status_forcelist = frozenset(int(s) for s in transport['status_forcelist'])
+        self.session = None
+        self.semaphore = None
+        # Cache key -> task of the call in flight, so identical concurrent calls on the loop share one NWDB execution
+        self.flights = {}
+
+    async def __aenter__(self):
+        await self.getSession()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # getSession
+    # Return the aiohttp session bound to the running loop, creating it (and the concurrency semaphore) on first use
+    async def getSession(self):
+        if self.session is None or self.session.closed:
+            auth = self.handler.config['netwitness']['auth']
+            connector = aiohttp.TCPConnector(limit=int(self.async_settings['max_concurrency']), limit_per_host=int(self.async_settings['limit_per_host']), ssl=None if self.verify else False)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                auth=aiohttp.BasicAuth(auth['user'], auth['pass'])
+            )
+            self.semaphore = asyncio.Semaphore(int(self.async_settings['max_concurrency']))
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    # fetch
+    # Issue a GET against NWDB under the concurrency bound and return the decoded JSON body, recording the first_byte, download and decode phases. Failed attempts are retried like NWTransport does; a non-2xx response left after that raises aiohttp.ClientResponseError instead of reaching the JSON decoder.
+    # @param params Query string arguments
+    # @param url NWDB service URL, defaults to the configured service
+    async def fetch(self, params, url=None):
+        session = await self.getSession()
+        # aiohttp only accepts str/int/float query values
+        params = { k: v if isinstance(v, (str, int, float)) else str(v) for k, v in params.items() }
+        msg = str(params.get('msg') or 'nwdb')
+        url = url or self.handler.url
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    startTime = time.perf_counter()
+                    async with session.get(url, params=params) as response:
+                        headersTime = time.perf_counter()
+                        if response.status in self.status_forcelist and attempt < self.retries:
+                            raise RetryableStatus(response.status)
+                        response.raise_for_status()
+                        body = await response.read()
+                    endTime = time.perf_counter()
+                break
+            except (RetryableStatus, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    self.metrics.inc('nwapi_nwdb_errors_total', msg=msg, host=urlsplit(url).netloc)
+                    raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+            except aiohttp.ClientResponseError:
+                self.metrics.inc('nwapi_nwdb_errors_total', msg=msg, host=urlsplit(url).netloc)
+                raise
+        self.metrics.phase(msg, 'first_byte', headersTime - startTime)
+        self.metrics.phase(msg, 'download', endTime - headersTime)
+        self.metrics.observe('nwapi_nwdb_response_bytes', len(body), BYTES_BUCKETS, msg=msg)
+        with self.metrics.timer(msg, 'decode'):
+            return json.loads(body)
+
+    # cached
+    # Coroutine counterpart of NWHandler.cached(), sharing its cache and keys. Misses await fn() once for all identical calls in flight on the loop; a caller being cancelled doesn't cancel the shared call.
+    # @param op Operation name
+    # @param query Query or where clause the operation runs
+    # @param params Dictionary of result shaping parameters (records, size, field, ...)
+    # @param fn Coroutine function producing the result on a miss
+    # @param cacheable Optional predicate on the result, False keeps it out of the cache
+    async def cached(self, op, query, params, fn, cacheable=None):
+        startTime = time.perf_counter()
+        key = self.handler.cacheKey(op, query, params)
+        found, value = self.handler.cache.get(key)
+        if found:
+            self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op=op, cache='hit')
+            return value
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = asyncio.ensure_future(fn())
+            flight.add_done_callback(lambda done: self.landed(key, query, done, cacheable))
+        value = await asyncio.shield(flight)
+        self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op=op, cache='miss')
+        return value
+
+    # landed
+    # Done callback of a cached() call: forget the flight and cache its result
+    def landed(self, key, query, flight, cacheable=None):
+        self.flights.pop(key, None)
+        if not flight.cancelled() and flight.exception() is None and (cacheable is None or cacheable(flight.result())):
+            self.handler.cache.put(key, flight.result(), isImmutable(query, settle=self.handler.cache.settle))
+
+    # cachedDistributed
+    # Coroutine version of NWHandler.cachedDistributed()
+    async def cachedDistributed(self, op, query, params, records):
+        result = await self.cached(op, query, params, lambda: self.aqueryDistributed(query, records, op=op), cacheable=lambda result: not result['partial'])
+        SERVICE_REPORT.set({ 'services': result['services'], 'partial': result['partial'] })
+        return result['sessions']
+
+    # answerLocal
+    # Answer a query from the handler's local session store on a worker thread, None when there is no store or it doesn't cover the query
+    async def answerLocal(self, query, records, op, raw=False):
+        if self.handler.store is None:
+            return None
+        return await asyncio.to_thread(self.handler.store.answer, query, records, op, raw)
+
+    # aNWGenerate
+    # Coroutine version of NWHandler.NWGenerate()
+    # @param query Query to execute against Netwitness NWDB directly
+    async def aNWGenerate(self, query):
+        try:
+            query, records = self.handler.checkQuery(query)
+        except NWQueryError as e:
+            return self.handler.inputError(e)
+        local = await self.answerLocal(query, records, 'NWGenerate', raw=True)
+        if local is not None:
+            return local
+        if len(self.handler.services) > 1:
+            return await self.cachedDistributed('NWGenerate', query, {}, records or 1000)
+        return await self.cached('NWGenerate', query, {}, lambda: self.agenerateFrom(query, self.handler.url, records))
+
+    # agenerateFrom
+    # Coroutine version of NWHandler.generateFrom()
+    async def agenerateFrom(self, query, url, records=None):
+        queryArgs = { 'msg': 'query', 'query': query, 'force-content-type': 'application/json' }
+        if records:
+            queryArgs['size'] = self.handler.metaPageSize(query, records)
+        nwResult = await self.fetch(queryArgs, url)
+        with self.metrics.timer('query', 'pivot'):
+            sessions = self.handler.processNWGenerate(nwResult)
+        return sessions[:records] if records else sessions
+
+    # afetchMetaPage
+    # Coroutine version of NWHandler.fetchMetaPage()
+    async def afetchMetaPage(self, query, id1=0, size=0, url=None):
+        query_args = { 'msg': 'query', 'query': query, 'id1': id1, 'id2': 0, 'size': size, 'force-content-type': 'application/json' }
+        meta = await self.fetch(query_args, url)
+        if type(meta) == dict:
+            meta = [meta]
+        self.metrics.observe('nwapi_nwdb_meta_rows', sum(len(rec['results'].get('fields', [])) for rec in meta if 'results' in rec), COUNT_BUCKETS, msg='query')
+        return meta
+
+    # aiterGroups
+    # Async generator version of NWHandler.iterGroups(), walking the query in meta id windows
+    async def aiterGroups(self, query, page_size=1000, id1=0, url=None, cursor=None):
+        if cursor is None:
+            cursor = {}
+        cursor.setdefault('id2', id1 - 1 if id1 else 0)
+        size = self.handler.metaPageSize(query, page_size)
+        state = {}
+        while True:
+            last_id = cursor['id2']
+            meta = await self.afetchMetaPage(query, id1, size, url)
+            with self.metrics.timer('query', 'pivot'):
+                completed = self.handler.pivotRows(self.handler.pageFields(meta, cursor), state)
+            for item in completed:
+                yield item
+            if not state['rows'] or cursor['id2'] <= last_id:
+                break
+            id1 = cursor['id2'] + 1
+        if state.get('group') is not None:
+            yield (state['group'], state['session'])
+
+    # aiter_sessions
+    # Async generator version of NWHandler.iter_sessions()
+    async def aiter_sessions(self, query, page_size=1000):
+        async for group, session in self.aiterGroups(query, page_size):
+            yield session
+
+    # aquerySessionsFrom
+    # Coroutine version of NWHandler.querySessionsFrom()
+    # @param records Max number of records to return, None for all
+    # @param page_size Optional number of sessions per NWDB window (defaults to records, never more)
+    async def aquerySessionsFrom(self, query, url, records=1000, page_size=None):
+        sessions = []
+        if records is not None and records <= 0:
+            return sessions
+        async for group, session in self.aiterGroups(query, self.handler.sessionWindow(records, page_size), 0, url):
+            sessions.append(session)
+            if records is not None and len(sessions) >= records:
+                break
+        return sessions
+
+    # aqueryDistributed
+    # Coroutine version of NWHandler.queryDistributed(): services that miss the distrib timeout are cancelled, which closes their NWDB connections
+    async def aqueryDistributed(self, query, records=1000, op='queryNWDB', timeout=None):
+        run = self.agenerateFrom if op == 'NWGenerate' else self.aquerySessionsFrom
+        timings = {}
+
+        async def runService(svc):
+            startTime = time.perf_counter()
+            try:
+                return await run(query, svc['url'], records)
+            finally:
+                timings[svc['name']] = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        tasks = [(svc, asyncio.ensure_future(runService(svc))) for svc in self.handler.services]
+        await asyncio.wait([task for svc, task in tasks], timeout=float(timeout or self.handler.distrib['timeout']))
+        outcomes = []
+        for svc, task in tasks:
+            latency = timings.get(svc['name'], time.perf_counter() - startTime)
+            if not task.done():
+                task.cancel()
+                outcomes.append((svc, 'timeout', latency, None, None))
+            elif task.exception() is not None:
+                outcomes.append((svc, 'error', latency, None, str(task.exception())))
+            else:
+                outcomes.append((svc, 'ok', latency, task.result(), None))
+        await asyncio.gather(*[task for svc, task in tasks], return_exceptions=True)
+        return self.handler.mergeDistributed(outcomes, records)
+
+    # aqueryNWDB
+    # Coroutine version of NWHandler.queryNWDB()
+    # @param query Query to send to NWDB
+    # @param records Max number of records to return
+    # @param page_size Optional number of sessions per NWDB window (defaults to records)
+    async def aqueryNWDB(self, query, records=1000, page_size=None):
+        try:
+            query, records = self.handler.checkQuery(query, records)
+        except NWQueryError as e:
+            return self.handler.inputError(e)
+        local = await self.answerLocal(query, records, 'queryNWDB')
+        if local is not None:
+            return local
+        if len(self.handler.services) > 1:
+            return await self.cachedDistributed('queryNWDB', query, { 'records': records }, records)
+        return await self.cached('queryNWDB', query, { 'records': records }, lambda: self.aquerySessionsFrom(query, self.handler.url, records, page_size))
+
+    # afetchValues
+    # Coroutine version of NWHandler.fetchValues()
+    async def afetchValues(self, query, field, size, url):
+        query_args = { 'msg': 'values', 'size': size, 'fieldName': field, 'where': query, 'flags': 'sort-total,order-descending', 'force-content-type': 'application/json' }
+        results = []
+        self.handler.processNetwitnessMetaAggregate(await self.fetch(query_args, url), results)
+        pairs = [(rec[field], int(rec['count'])) for rec in results if field in rec]
+        return (pairs, len(pairs) < size)
+
+    # aaggregateNWDB
+    # Coroutine version of NWHandler.aggregateNWDB(), running every (field, service) values call of a round concurrently
+    async def aaggregateNWDB(self, query, size, fields, exact=False):
+        if isinstance(fields, str):
+            fields = [f.strip() for f in fields.split(',') if f.strip()]
+        services = self.handler.services
+        fetch = { (field, svc['url']): max(int(size * float(self.handler.aggregate['overfetch'])), size) for field in fields for svc in services }
+        lists = {}
+        pending = list(fetch)
+        rounds = 0
+        ret = { 'results': {}, 'error_bound': {}, 'exact': {} }
+        while pending:
+            rounds += 1
+            lists.update(zip(pending, await asyncio.gather(*[self.afetchValues(query, key[0], fetch[key], key[1]) for key in pending])))
+            ret = { 'results': {}, 'error_bound': {}, 'exact': {} }
+            pending = []
+            for field in fields:
+                top, bound, isExact = self.handler.mergeTopK([lists[(field, svc['url'])] for svc in services], size)
+                ret['results'][field] = top
+                ret['error_bound'][field] = bound
+                ret['exact'][field] = isExact
+                if exact and not isExact and rounds < int(self.handler.aggregate['max_rounds']):
+                    for svc in services:
+                        key = (field, svc['url'])
+                        if not lists[key][1]:
+                            fetch[key] *= 4
+                            pending.append(key)
+        self.metrics.observe('nwapi_aggregate_rounds', rounds, COUNT_BUCKETS)
+        return ret
+
+    # aqueryNWDBAggregate
+    # Coroutine version of NWHandler.queryNWDBAggregate()
+    # @param query Query to select sessions to aggregate across
+    # @param size Records to return per field
+    # @param field Field or list of fields to aggregate across
+    # @param exact Require an exact global top-k across services
+    async def aqueryNWDBAggregate(self, query, size, field, exact=False):
+        try:
+            query, size, fields = self.handler.checkAggregate(query, size, field)
+        except NWQueryError as e:
+            return self.handler.inputError(e)
+
+        async def aggregate():
+            return (await self.aaggregateNWDB(query, size, fields, exact))['results']
+        return await self.cached('queryNWDBAggregate', query, { 'size': size, 'field': fields, 'exact': exact }, aggregate)
+
+    # gather
+    # Run many operations concurrently, bounded by the 'max_concurrency' setting. Results are returned in call order; a failed call returns its exception instead of aborting the batch.
+    # @param calls Iterable of (method name, args tuple) pairs, e.g. [('aqueryNWDB', (query, 100)), ...]
+    async def gather(self, calls):
+        await self.getSession()
+        return await asyncio.gather(*[getattr(self, name)(*args) for name, args in calls], return_exceptions=True)
+
+
+class AsyncRunner:
+
+    # Constructor
+    # * Runs an event loop on a daemon thread so synchronous callers (e.g. Flask request threads) can hand coroutines to a single shared AsyncNWHandler
+    # @param handler AsyncNWHandler instance owned by the loop
+    def __init__(self, handler):
+        self.handler = handler
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='AsyncNWHandler', daemon=True)
+        self.thread.start()
+
+    # submit
+    # Schedule a coroutine on the loop and return a concurrent.futures.Future for its result
+    # @param coro Coroutine to run
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # run
+    # Schedule a coroutine on the loop and wait for its result
+    # @param coro Coroutine to run
+    # @param timeout Seconds to wait before raising concurrent.futures.TimeoutError
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        self.run(self.handler.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
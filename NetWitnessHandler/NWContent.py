@@ -0,0 +1,239 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWContent.py:
+
+  Session content retrieval for NWHandler: PCAPs of many sessions fetched from NWDB in batches with bounded concurrency, spooled to local disk and concatenated into one PCAP stream that supports byte ranges.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from .NWMetrics import METRICS
+    from .NWQuery import NWQueryError
+except ImportError:
+    from NWMetrics import METRICS
+    from NWQuery import NWQueryError
+
+# Defaults applied when the 'content' section of nwhandler_config.yaml omits a setting
+CONTENT_DEFAULTS = {
+    'batch_sessions': 100,
+    'max_workers': 4,
+    'max_sessions': 100000,
+    'chunk_size': 65536,
+    'spool_path': '',
+    'ttl': 3600
+}
+
+# Length of the PCAP global header; every batch NWDB renders starts with one, the concatenated stream keeps only the first
+PCAP_HEADER_SIZE = 24
+
+PCAP_MIMETYPE = 'application/vnd.tcpdump.pcap'
+
+
+class NWContent:
+
+    # Constructor
+    # * Each batch of batch_sessions sessions is one NWDB /packets request written straight to a spool file, so memory use doesn't depend on the size of the evidence set. Spooled batches are kept for ttl seconds: a resumed or ranged download of the same sessions only fetches the batches it is missing.
+    # @param handler NWHandler used to talk to NWDB
+    # @param settings 'content' section of nwhandler_config.yaml (may be None)
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, handler, settings=None, debug=0):
+        self.handler = handler
+        self.debug = debug
+        self.settings = dict(CONTENT_DEFAULTS)
+        self.settings.update(settings or {})
+        self.batch_sessions = max(int(self.settings['batch_sessions']), 1)
+        self.max_workers = max(int(self.settings['max_workers']), 1)
+        self.chunk_size = int(self.settings['chunk_size'])
+        self.spool_path = self.settings['spool_path'] or os.path.join(tempfile.gettempdir(), 'nwapi-content')
+        os.makedirs(self.spool_path, exist_ok=True)
+        self.last_expire = 0.0
+
+    # resolve
+    # Session ids of a download: the given ids, or the sessions a where clause selects. Raises NWQueryError when neither is given, an id isn't a number, or there are more than max_sessions or validation.max_records (which would otherwise cut the selection short).
+    # @param sessions List of session ids, or a comma separated string of them
+    # @param where WHERE clause selecting the sessions, used when sessions is empty
+    # @param url NWDB service URL
+    def resolve(self, sessions=None, where=None, url=None):
+        limit = int(self.settings['max_sessions'])
+        if sessions:
+            if isinstance(sessions, str):
+                sessions = [s for s in sessions.split(',') if s.strip()]
+            try:
+                ids = [int(s) for s in sessions]
+            except (TypeError, ValueError):
+                raise NWQueryError('Session ids must be numbers')
+        elif where:
+            ids = self.handler.sessionIds(where, limit + 1, url)
+            cap = int(self.handler.validation.get('max_records') or 0) if self.handler.validation.get('enabled', True) else 0
+            if cap and cap <= limit and len(ids) >= cap:
+                raise NWQueryError('The where clause selects ' + str(cap) + ' or more sessions, the validation max_records limit; narrow the selection')
+        else:
+            raise NWQueryError('No session ids or where clause provided')
+        if len(ids) > limit:
+            raise NWQueryError('More than ' + str(limit) + ' sessions requested, narrow the selection')
+        return ids
+
+    # key
+    # Identify a content download by its service and ordered session ids; used as its spool directory name and ETag
+    def key(self, ids, url):
+        raw = url + '|' + ','.join(str(i) for i in ids)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    # batches
+    # Split the session ids into (spool file, ids) batches
+    def batches(self, ids, url):
+        spool = os.path.join(self.spool_path, self.key(ids, url))
+        os.makedirs(spool, exist_ok=True)
+        os.utime(spool)
+        size = self.batch_sessions
+        return [(os.path.join(spool, str(i // size).zfill(6) + '.pcap'), ids[i:i + size]) for i in range(0, len(ids), size)]
+
+    # fetch
+    # Return the batch's spool file, downloading it unless it is already spooled. Concurrent downloads of the same batch share one NWDB request.
+    def fetch(self, path, ids, url):
+        if os.path.exists(path):
+            METRICS.inc('nwapi_content_batches_total', source='spool')
+            return path
+        METRICS.inc('nwapi_content_batches_total', source='nwdb')
+        return self.handler.flight.do(hashlib.sha1(path.encode('utf-8')).hexdigest(), lambda: path if os.path.exists(path) else self.handler.fetchPackets(ids, path, url))
+
+    # spooled
+    # Generator over the batches' spool files in order, keeping up to max_workers downloads in flight ahead of the consumer. Closing it early doesn't wait for the downloads in flight; they finish in the background and stay spooled.
+    def spooled(self, batches, url):
+        pending = deque()
+        remaining = iter(batches)
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='NWContent')
+        try:
+            for path, ids in remaining:
+                pending.append(pool.submit(self.fetch, path, ids, url))
+                if len(pending) >= self.max_workers:
+                    break
+            while pending:
+                path = pending.popleft().result()
+                for nextPath, ids in remaining:
+                    pending.append(pool.submit(self.fetch, nextPath, ids, url))
+                    break
+                yield path
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    # part
+    # (path, offset, length) of a spool file's share of the concatenated stream, None when it adds nothing. The first non-empty batch keeps its PCAP global header, later ones contribute their packet records only.
+    # @param header True once a global header is part of the stream
+    def part(self, path, header):
+        offset = PCAP_HEADER_SIZE if header else 0
+        size = os.path.getsize(path)
+        if size <= offset:
+            return None
+        return (path, offset, size - offset)
+
+    def parts(self, paths):
+        ret = []
+        for path in paths:
+            part = self.part(path, bool(ret))
+            if part is not None:
+                ret.append(part)
+        return ret
+
+    # prepare
+    # Spool the batches in order (fetching only the missing ones) until they cover the first stop bytes of the stream, and return (parts, length) for serving byte ranges. length is the length of the whole stream when every batch is spooled, None when spooling stopped early and later batches are still missing.
+    # @param ids Session ids
+    # @param url NWDB service URL
+    # @param stop End (exclusive) of the byte range to serve, None to spool every batch
+    def prepare(self, ids, url, stop=None):
+        self.expire()
+        batches = self.batches(ids, url)
+        parts = []
+        position = 0
+        count = 0
+        spooled = self.spooled(batches, url)
+        try:
+            for path in spooled:
+                count += 1
+                part = self.part(path, bool(parts))
+                if part is not None:
+                    parts.append(part)
+                    position += part[2]
+                if stop is not None and position >= stop:
+                    break
+        finally:
+            spooled.close()
+        if count < len(batches):
+            return (parts, self.length(ids, url))
+        return (parts, position)
+
+    # length
+    # Length of the concatenated stream when every batch is already spooled, otherwise None
+    def length(self, ids, url):
+        batches = self.batches(ids, url)
+        if not all(os.path.exists(path) for path, batchIds in batches):
+            return None
+        return sum(length for path, offset, length in self.parts([path for path, batchIds in batches]))
+
+    # stream
+    # Generator over the concatenated PCAP of the sessions in chunk_size pieces, yielding each batch as soon as it is spooled
+    # @param ids Session ids
+    # @param url NWDB service URL
+    def stream(self, ids, url):
+        self.expire()
+        header = False
+        for path in self.spooled(self.batches(ids, url), url):
+            part = self.part(path, header)
+            if part is not None:
+                header = True
+                yield from self.readPart(*part)
+
+    # streamRange
+    # Generator over bytes start .. end - 1 of the concatenated stream described by parts (see prepare())
+    def streamRange(self, parts, start, end):
+        position = 0
+        for path, offset, length in parts:
+            if position + length > start and position < end:
+                skip = max(start - position, 0)
+                yield from self.readPart(path, offset + skip, min(length - skip, end - position - skip))
+            position += length
+            if position >= end:
+                break
+
+    # readPart
+    # Read length bytes of a spool file from offset in chunk_size pieces
+    def readPart(self, path, offset, length):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(self.chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    # expire
+    # Remove spooled downloads not used for ttl seconds, at most once a minute
+    def expire(self):
+        now = time.time()
+        if now - self.last_expire < 60:
+            return
+        self.last_expire = now
+        cutoff = now - float(self.settings['ttl'])
+        for entry in os.scandir(self.spool_path):
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
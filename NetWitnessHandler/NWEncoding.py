@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWEncoding.py:
+
+  Response encodings for the REST app: gzip/zstd content encoding for buffered and streamed responses, and MessagePack / Arrow IPC serialization as compact alternatives to JSON.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import io
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Defaults applied when the 'compression' section of nwhandler_config.yaml omits a setting
+COMPRESSION_DEFAULTS = {
+    'enabled': True,
+    'encodings': ['zstd', 'gzip'],
+    'min_size': 1024,
+    'gzip_level': 6,
+    'zstd_level': 3,
+    'flush_bytes': 65536
+}
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+MSGPACK_MIMETYPE = 'application/msgpack'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+# Responses never content-encoded: event streams must reach the client as soon as they are written, the rest are compressed already
+UNCOMPRESSED_MIMETYPES = ('text/event-stream', 'application/gzip', 'application/zstd')
+
+
+class NWEncoding:
+
+    # Constructor
+    # * zstd needs the zstandard package, MessagePack the msgpack package and Arrow IPC pyarrow; formats whose package is missing are simply not offered
+    # @param settings 'compression' section of nwhandler_config.yaml (may be None)
+    def __init__(self, settings=None):
+        self.settings = dict(COMPRESSION_DEFAULTS)
+        self.settings.update(settings or {})
+        self.enabled = bool(self.settings['enabled'])
+        self.min_size = int(self.settings['min_size'])
+        self.flush_bytes = int(self.settings['flush_bytes'])
+        # Content encodings offered to clients, in server preference order
+        self.encodings = [e for e in self.settings['encodings'] if e == 'gzip' or (e == 'zstd' and zstandard is not None)]
+
+    # formats
+    # Mimetypes a payload can be serialized to, JSON first so it stays the default for Accept: */*
+    # @param tabular True when the payload is a list of flat records (sessions), which Arrow IPC can represent
+    def formats(self, tabular=False):
+        ret = [JSON_MIMETYPE]
+        if msgpack is not None:
+            ret.append(MSGPACK_MIMETYPE)
+        if tabular and pyarrow is not None:
+            ret.append(ARROW_MIMETYPE)
+        return ret
+
+    # compressible
+    # True when a response of this mimetype and (known) length should be content-encoded
+    # @param mimetype Response mimetype
+    # @param length Body length in bytes, None for streamed bodies
+    def compressible(self, mimetype, length=None):
+        if not self.enabled or mimetype in UNCOMPRESSED_MIMETYPES:
+            return False
+        return length is None or length >= self.min_size
+
+    # compressor
+    # Return a (compress, flush, finish) triple of callables for encoding: compress(data) may buffer, flush() emits everything compressed so far as a decodable unit, finish() ends the stream
+    def compressor(self, encoding):
+        if encoding == 'zstd':
+            obj = zstandard.ZstdCompressor(level=int(self.settings['zstd_level'])).compressobj()
+            return (obj.compress, lambda: obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), obj.flush)
+        obj = zlib.compressobj(int(self.settings['gzip_level']), zlib.DEFLATED, 31)
+        return (obj.compress, lambda: obj.flush(zlib.Z_SYNC_FLUSH), obj.flush)
+
+    # compress
+    # Content-encode a whole body
+    def compress(self, data, encoding):
+        compress, flush, finish = self.compressor(encoding)
+        return compress(data) + finish()
+
+    # compressStream
+    # Content-encode a streamed body. Output is flushed every flush_bytes of input so clients can decode sessions while the stream is still running, without paying a flush per session.
+    # @param chunks Iterable of str or bytes chunks; closed when the stream ends
+    # @param encoding 'gzip' or 'zstd'
+    def compressStream(self, chunks, encoding):
+        compress, flush, finish = self.compressor(encoding)
+        pending = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                out = compress(chunk)
+                pending += len(chunk)
+                if pending >= self.flush_bytes:
+                    out += flush()
+                    pending = 0
+                if out:
+                    yield out
+            yield finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+# packMsgpack
+# Serialize a payload (sessions, aggregate results, ...) to MessagePack
+def packMsgpack(payload):
+    return msgpack.packb(payload, use_bin_type=True, default=str)
+
+
+# arrowTable
+# Build an Arrow table from flat records. Columns are the union of the records' keys in first-seen order, missing values are null, and a column whose values Arrow can't give one type (e.g. mixed numbers and strings) is stored as strings.
+# @param records List of dictionaries
+def arrowTable(records):
+    columns = {}
+    for record in records:
+        for key in record:
+            if key not in columns:
+                columns[key] = None
+    arrays = []
+    for key in columns:
+        values = [record.get(key) for record in records]
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, OverflowError):
+            arrays.append(pyarrow.array([None if v is None else str(v) for v in values], type=pyarrow.string()))
+    return pyarrow.Table.from_arrays(arrays, names=list(columns))
+
+
+# packArrow
+# Serialize flat records to an Arrow IPC stream
+def packArrow(records):
+    table = arrowTable(records)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWExport.py:
+
+  Batch writers for bulk exports of NWDB sessions to Parquet, CSV or NDJSON.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import csv
+import gzip
+import io
+import json
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = ('parquet', 'csv', 'ndjson')
+
+
+# exportFormat
+# Infer the export format from the file name when none is given
+# @param path Output file path
+# @param format Explicit format, one of EXPORT_FORMATS
+def exportFormat(path, format=None):
+    if format:
+        format = format.lower()
+    else:
+        name = path.lower()
+        for suffix in ('.gz', '.zst'):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        format = 'csv' if name.endswith('.csv') else 'ndjson' if name.endswith(('.ndjson', '.jsonl', '.json')) else 'parquet'
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unsupported export format: ' + str(format))
+    return format
+
+
+# openText
+# Open a text stream for writing, compressed with gzip or zstd when requested
+# @param path Output file path
+# @param compression None, 'gzip' or 'zstd'
+def openText(path, compression=None):
+    if not compression:
+        return io.open(path, 'w', encoding='utf-8', newline='')
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        raw = io.open(path, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw, closefd=True), encoding='utf-8', newline='')
+    raise ValueError('Unsupported compression: ' + str(compression))
+
+
+class NDJSONWriter:
+
+    def __init__(self, path, columns=None, compression=None):
+        self.columns = columns
+        self.stream = openText(path, compression)
+
+    def write(self, batch):
+        for session in batch:
+            if self.columns:
+                session = { c: session.get(c) for c in self.columns }
+            self.stream.write(json.dumps(session) + '\n')
+
+    def close(self):
+        self.stream.close()
+
+
+class CSVWriter:
+
+    # Constructor
+    # * The header comes from columns, or from the first batch when the query selected '*'
+    def __init__(self, path, columns=None, compression=None):
+        self.columns = columns
+        self.stream = openText(path, compression)
+        self.writer = None
+
+    def write(self, batch):
+        if self.writer is None:
+            if not self.columns:
+                self.columns = list(dict.fromkeys(k for session in batch for k in session))
+            self.writer = csv.DictWriter(self.stream, fieldnames=self.columns, extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerows(batch)
+
+    def close(self):
+        self.stream.close()
+
+
+class ParquetWriter:
+
+    # Constructor
+    # * One Parquet row group is written per batch. The schema is inferred from the first batch (columns without values there become strings) and later batches are coerced to it.
+    # @param path Output file path
+    # @param columns Column names, taken from the first batch when None
+    # @param compression Parquet codec, e.g. 'snappy', 'gzip' or 'zstd'
+    def __init__(self, path, columns=None, compression=None):
+        if pa is None:
+            raise ImportError('Parquet export requires pyarrow')
+        self.path = path
+        self.columns = columns
+        self.compression = compression or 'snappy'
+        self.schema = None
+        self.writer = None
+
+    def write(self, batch):
+        if self.writer is None:
+            if not self.columns:
+                self.columns = list(dict.fromkeys(k for session in batch for k in session))
+            inferred = pa.Table.from_pylist([{ c: s.get(c) for c in self.columns } for s in batch]).schema
+            self.schema = pa.schema([pa.field(f.name, pa.string() if pa.types.is_null(f.type) else f.type) for f in inferred])
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        rows = [{ c: s.get(c) for c in self.columns } for s in batch]
+        try:
+            table = pa.Table.from_pylist(rows, schema=self.schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            table = pa.Table.from_pylist(self.coerce(rows), schema=self.schema)
+        self.writer.write_table(table)
+
+    # coerce
+    # Convert values that don't match the schema: strings for string columns, None for unparseable numbers
+    def coerce(self, rows):
+        for f in self.schema:
+            if pa.types.is_string(f.type):
+                convert = str
+            elif pa.types.is_integer(f.type):
+                convert = int
+            elif pa.types.is_floating(f.type):
+                convert = float
+            else:
+                continue
+            for row in rows:
+                value = row[f.name]
+                if value is not None:
+                    try:
+                        row[f.name] = convert(value)
+                    except (TypeError, ValueError):
+                        row[f.name] = None
+        return rows
+
+    def close(self):
+        if self.writer is None and self.columns:
+            self.writer = pq.ParquetWriter(self.path, pa.schema([pa.field(c, pa.string()) for c in self.columns]), compression=self.compression)
+        if self.writer is not None:
+            self.writer.close()
+
+
+EXPORT_WRITERS = { 'parquet': ParquetWriter, 'csv': CSVWriter, 'ndjson': NDJSONWriter }
@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWGraph.py:
+
+  Communication graphs for NWHandler: sessions streamed from NWDB are folded batch by batch into an integer-indexed edge table (source node, destination node, session count, byte sum), so memory grows with the number of unique edges rather than sessions.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
+try:
+    from .NWQuery import NWQueryError
+except ImportError:
+    from NWQuery import NWQueryError
+
+# Defaults applied when the 'graph' section of nwhandler_config.yaml omits a setting
+GRAPH_DEFAULTS = {
+    'page_size': 10000,
+    'batch_sessions': 50000,
+    'max_edges': 1000000
+}
+
+GRAPHML_MIMETYPE = 'application/graphml+xml'
+
+# Edge keys pack the source node id in the high and the destination node id in the low 32 bits
+NODE_BITS = 32
+
+
+class NWEdgeTable:
+
+    # Constructor
+    # * Node values are interned to integer ids; a value is one node whatever side of an edge it appears on, so ip.src -> ip.dst graphs join up. Sessions are buffered as id arrays and merged into the edge table every batch_sessions sessions with numpy unique/bincount, or a dictionary when numpy isn't installed.
+    # @param src Sanitized session key of the source meta, e.g. 'ip_src'
+    # @param dst Sanitized session key of the destination meta
+    # @param weight Sanitized session key summed per edge as bytes, e.g. 'size'; None to only count sessions
+    # @param batch_sessions Sessions buffered between merges
+    # @param max_edges Max unique edges, 0 for no limit; more raise NWQueryError
+    def __init__(self, src, dst, weight=None, batch_sessions=50000, max_edges=0):
+        self.src = src
+        self.dst = dst
+        self.weight = weight
+        self.batch_sessions = max(int(batch_sessions), 1)
+        self.max_edges = int(max_edges)
+        # Node value -> id, and id -> value
+        self.index = {}
+        self.nodes = []
+        self.sessions = 0
+        self.skipped = 0
+        self.pending = ([], [], [])
+        if np is not None:
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.counts = np.zeros(0, dtype=np.int64)
+            self.bytes = np.zeros(0, dtype=np.float64)
+        else:
+            # Edge key -> [count, bytes]
+            self.edges = {}
+
+    # node
+    # Id of a node value, interning it on first sight
+    def node(self, value):
+        nid = self.index.get(value)
+        if nid is None:
+            nid = self.index[value] = len(self.nodes)
+            self.nodes.append(value)
+        return nid
+
+    # add
+    # Add a session; sessions without both endpoints are skipped
+    def add(self, session):
+        a = session.get(self.src)
+        b = session.get(self.dst)
+        if a is None or b is None:
+            self.skipped += 1
+            return
+        srcIds, dstIds, weights = self.pending
+        srcIds.append(self.node(a))
+        dstIds.append(self.node(b))
+        w = session.get(self.weight) if self.weight else None
+        weights.append(w if isinstance(w, (int, float)) else 0)
+        self.sessions += 1
+        if len(srcIds) >= self.batch_sessions:
+            self.flush()
+
+    def extend(self, sessions):
+        for session in sessions:
+            self.add(session)
+        return self
+
+    # flush
+    # Merge the buffered sessions into the edge table
+    def flush(self):
+        srcIds, dstIds, weights = self.pending
+        if not srcIds:
+            return
+        self.pending = ([], [], [])
+        if np is None:
+            for a, b, w in zip(srcIds, dstIds, weights):
+                edge = self.edges.get((a << NODE_BITS) | b)
+                if edge is None:
+                    edge = self.edges[(a << NODE_BITS) | b] = [0, 0]
+                edge[0] += 1
+                edge[1] += w
+            self.checkEdges(len(self.edges))
+            return
+        keys = (np.asarray(srcIds, dtype=np.int64) << NODE_BITS) | np.asarray(dstIds, dtype=np.int64)
+        keys, inverse = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate((self.counts, np.ones(len(srcIds), dtype=np.int64))), minlength=len(keys)).astype(np.int64)
+        self.bytes = np.bincount(inverse, weights=np.concatenate((self.bytes, np.asarray(weights, dtype=np.float64))), minlength=len(keys))
+        self.keys = keys
+        self.checkEdges(len(keys))
+
+    def checkEdges(self, count):
+        if self.max_edges and count > self.max_edges:
+            raise NWQueryError('More than ' + str(self.max_edges) + ' edges, narrow the where clause')
+
+    # table
+    # Flush and return the edge table as (source ids, destination ids, counts, bytes): numpy arrays, or lists without numpy
+    def table(self):
+        self.flush()
+        if np is None:
+            keys = sorted(self.edges)
+            return ([k >> NODE_BITS for k in keys], [k & ((1 << NODE_BITS) - 1) for k in keys], [self.edges[k][0] for k in keys], [self.edges[k][1] for k in keys])
+        return (self.keys >> NODE_BITS, self.keys & ((1 << NODE_BITS) - 1), self.counts, self.bytes.astype(np.int64))
+
+    # prune
+    # Return the edge table (as table() does) after dropping edges below min_count sessions or min_bytes, keeping the top_edges heaviest (by sessions, then bytes), then dropping nodes with fewer than min_degree edges together with their edges
+    def prune(self, min_count=0, min_bytes=0, min_degree=0, top_edges=0):
+        src, dst, counts, sizes = self.table()
+        if np is None:
+            edges = [e for e in zip(src, dst, counts, sizes) if e[2] >= min_count and e[3] >= min_bytes]
+            if top_edges and len(edges) > top_edges:
+                edges = sorted(edges, key=lambda e: (e[2], e[3]), reverse=True)[:top_edges]
+            if min_degree:
+                degree = {}
+                for a, b, count, size in edges:
+                    degree[a] = degree.get(a, 0) + 1
+                    degree[b] = degree.get(b, 0) + 1
+                edges = [e for e in edges if degree[e[0]] >= min_degree and degree[e[1]] >= min_degree]
+            return tuple(list(column) for column in zip(*edges)) if edges else ([], [], [], [])
+        keep = (counts >= min_count) & (sizes >= min_bytes)
+        src, dst, counts, sizes = src[keep], dst[keep], counts[keep], sizes[keep]
+        if top_edges and len(src) > top_edges:
+            top = np.lexsort((sizes, counts))[::-1][:top_edges]
+            src, dst, counts, sizes = src[top], dst[top], counts[top], sizes[top]
+        if min_degree:
+            degree = np.bincount(np.concatenate((src, dst)), minlength=len(self.nodes))
+            keep = (degree[src] >= min_degree) & (degree[dst] >= min_degree)
+            src, dst, counts, sizes = src[keep], dst[keep], counts[keep], sizes[keep]
+        return (src, dst, counts, sizes)
+
+    # toNetworkx
+    # Build a networkx DiGraph of an edge table returned by prune(), with 'sessions' and 'bytes' on every edge and the totals of their edges on every node
+    def toNetworkx(self, edges):
+        src, dst, counts, sizes = (list(column.tolist() if np is not None else column) for column in edges)
+        totals = {}
+        for a, b, count, size in zip(src, dst, counts, sizes):
+            for nid in ((a,) if a == b else (a, b)):
+                total = totals.setdefault(nid, [0, 0])
+                total[0] += count
+                total[1] += size
+        graph = nx.DiGraph(src=self.src.replace('_', '.'), dst=self.dst.replace('_', '.'), sessions=self.sessions)
+        for nid, (count, size) in totals.items():
+            graph.add_node(self.nodes[nid], sessions=count, bytes=size)
+        for a, b, count, size in zip(src, dst, counts, sizes):
+            graph.add_edge(self.nodes[a], self.nodes[b], sessions=count, bytes=size)
+        return graph
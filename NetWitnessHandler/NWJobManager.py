@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWJobManager.py:
+
+  Background jobs for long running NWDB queries: a bounded worker pool runs queries through NWHandler and spools the sessions to local disk in NDJSON chunks that clients poll or stream.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Defaults applied when the 'jobs' section of nwhandler_config.yaml omits a setting
+JOBS_DEFAULTS = {
+    'max_workers': 4,
+    'max_jobs': 100,
+    'spool_path': '',
+    'chunk_sessions': 5000,
+    'page_size': 1000,
+    'ttl': 3600
+}
+
+JOB_ACTIVE = ('queued', 'running')
+
+
+class NWJobLimitError(RuntimeError):
+    pass
+
+
+class NWJob:
+
+    # Constructor
+    # @param query Validated NWDB query
+    # @param records Max number of sessions to fetch, None for all
+    # @param spool_path Directory under which the job's result chunks are spooled
+    def __init__(self, query, records, spool_path):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.records = records
+        self.spool = os.path.join(spool_path, self.id)
+        self.status = 'queued'
+        self.error = None
+        self.fetched = 0
+        # Per service watermark, service name -> { 'id2': last meta id consumed }, advanced by NWHandler.iterServiceSessions()
+        self.cursors = {}
+        self.chunks = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.future = None
+
+    # toDict
+    # Job status as returned by the REST API
+    def toDict(self):
+        return {
+            'id': self.id,
+            'query': self.query,
+            'records': self.records,
+            'status': self.status,
+            'error': self.error,
+            'fetched': self.fetched,
+            'cursor': { name: cursor.get('id2') for name, cursor in list(self.cursors.items()) },
+            'chunks': len(self.chunks),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class NWJobManager:
+
+    # Constructor
+    # * Jobs live in this process; with several Flask worker processes a job is only visible to the worker that accepted it
+    # @param handler NWHandler used to run the queries
+    # @param settings 'jobs' section of nwhandler_config.yaml (may be None)
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, handler, settings=None, debug=0):
+        self.handler = handler
+        self.debug = debug
+        self.settings = dict(JOBS_DEFAULTS)
+        self.settings.update(settings or {})
+        self.spool_path = self.settings['spool_path'] or os.path.join(tempfile.gettempdir(), 'nwapi-jobs')
+        os.makedirs(self.spool_path, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=int(self.settings['max_workers']), thread_name_prefix='NWJob')
+        self.jobs = {}
+        # Guards self.jobs and job state; waiters on it are woken whenever a chunk lands or a job ends
+        self.cond = threading.Condition()
+
+    # submit
+    # Validate a query and queue it. Returns the NWJob; raises NWQueryError for rejected queries and NWJobLimitError when max_jobs jobs are already queued or running.
+    # @param query NWDB query
+    # @param records Max number of sessions to fetch, None for all (capped by validation.max_records)
+    def submit(self, query, records=None):
+        query, records = self.handler.checkQuery(query, records)
+        self.expire()
+        with self.cond:
+            if sum(1 for job in self.jobs.values() if job.status in JOB_ACTIVE) >= int(self.settings['max_jobs']):
+                raise NWJobLimitError('Too many active jobs, try again later')
+            job = NWJob(query, records, self.spool_path)
+            self.jobs[job.id] = job
+        os.makedirs(job.spool, exist_ok=True)
+        job.future = self.pool.submit(self.run, job)
+        return job
+
+    # run
+    # Worker body: stream the query's sessions from every configured service (tagged with nw_service when there are several) and spool them in chunks of chunk_sessions, checking for cancellation between sessions
+    # @param job NWJob to run
+    def run(self, job):
+        with self.cond:
+            if job.cancelled.is_set():
+                job.status = 'cancelled'
+                job.finished = time.time()
+                self.cond.notify_all()
+                return
+            job.status = 'running'
+            job.started = time.time()
+        chunkSize = int(self.settings['chunk_sessions'])
+        batch = []
+        try:
+            pageSize = self.handler.sessionWindow(job.records, min(chunkSize, int(self.settings['page_size'])))
+            for session in self.handler.iterServiceSessions(job.query, pageSize, job.cursors):
+                if job.cancelled.is_set():
+                    break
+                batch.append(session)
+                if len(batch) >= chunkSize:
+                    self.spoolChunk(job, batch)
+                    batch = []
+                if job.records is not None and job.fetched + len(batch) >= job.records:
+                    break
+            if batch and not job.cancelled.is_set():
+                self.spoolChunk(job, batch)
+            status = 'cancelled' if job.cancelled.is_set() else 'done'
+            error = None
+        except Exception as e:
+            status = 'failed'
+            error = str(e)
+            if self.debug:
+                print('NWJobManager::run() Exception => ' + str(e) + '\n')
+        with self.cond:
+            job.status = status
+            job.error = error
+            job.finished = time.time()
+            self.cond.notify_all()
+
+    # spoolChunk
+    # Write a batch of sessions as the job's next NDJSON chunk. The file is renamed into place, so readers only ever see complete chunks.
+    def spoolChunk(self, job, batch):
+        path = os.path.join(job.spool, str(len(job.chunks)).zfill(6) + '.ndjson')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for session in batch:
+                f.write(json.dumps(session) + '\n')
+        os.replace(path + '.tmp', path)
+        with self.cond:
+            job.chunks.append(path)
+            job.fetched += len(batch)
+            self.cond.notify_all()
+
+    # get
+    # Return the NWJob with job_id, or None when it doesn't exist or has expired
+    def get(self, job_id):
+        self.expire()
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        self.expire()
+        with self.cond:
+            return list(self.jobs.values())
+
+    # cancel
+    # Stop a queued or running job; its spooled chunks stay readable until it expires. Returns the job, or None when unknown.
+    def cancel(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status in JOB_ACTIVE:
+                job.cancelled.set()
+                if job.future is not None and job.future.cancel():
+                    job.status = 'cancelled'
+                    job.finished = time.time()
+                self.cond.notify_all()
+        return job
+
+    # delete
+    # Cancel a job and remove it with its spooled results. Returns False when the job is unknown.
+    def delete(self, job_id):
+        job = self.cancel(job_id)
+        if job is None:
+            return False
+        with self.cond:
+            self.jobs.pop(job_id, None)
+        if job.future is not None and not job.future.done():
+            job.future.add_done_callback(lambda f: shutil.rmtree(job.spool, ignore_errors=True))
+        else:
+            shutil.rmtree(job.spool, ignore_errors=True)
+        return True
+
+    # expire
+    # Drop finished jobs, and their spool directories, once they are older than ttl seconds
+    def expire(self):
+        cutoff = time.time() - float(self.settings['ttl'])
+        with self.cond:
+            expired = [job for job in self.jobs.values() if job.finished is not None and job.finished < cutoff]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            shutil.rmtree(job.spool, ignore_errors=True)
+
+    # results
+    # Generator over the job's spooled NDJSON lines from chunk offset onward. With follow set it keeps waiting for new chunks until the job ends; otherwise only the chunks written so far are returned.
+    # @param job NWJob to read
+    # @param offset Index of the first chunk to return
+    # @param follow Keep streaming chunks as they are written
+    # @param poll Max seconds to wait for a chunk before rechecking the job
+    def results(self, job, offset=0, follow=False, poll=1.0):
+        index = offset
+        while True:
+            with self.cond:
+                while follow and index >= len(job.chunks) and job.status in JOB_ACTIVE:
+                    self.cond.wait(poll)
+                chunks = job.chunks[index:]
+            for path in chunks:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            yield line
+                except FileNotFoundError:
+                    return
+            index += len(chunks)
+            if not follow or (not chunks and job.status not in JOB_ACTIVE):
+                return
+
+    def shutdown(self):
+        for job in self.list():
+            job.cancelled.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,215 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWMetrics.py:
+
+  Process wide instrumentation for NWHandler, SparkHandler and the REST app: latency histograms per operation and phase, NWDB response size and meta count histograms, and cache/pool gauges, rendered in the Prometheus text format.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+# Defaults applied when the 'metrics' section of nwhandler_config.yaml omits a setting
+METRICS_DEFAULTS = {
+    'enabled': True,
+    'server_timing': False
+}
+
+# Histogram bucket upper bounds: seconds, response bytes and meta rows
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+BYTES_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Phase totals of the request being served in this context, None outside of a timed request
+_request_phases = contextvars.ContextVar('nwapi_request_phases', default=None)
+
+
+class Histogram:
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PhaseTimer:
+
+    __slots__ = ('metrics', 'op', 'phase', 'start')
+
+    def __init__(self, metrics, op, phase):
+        self.metrics = metrics
+        self.op = op
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.phase(self.op, self.phase, time.perf_counter() - self.start)
+
+
+class NWMetrics:
+
+    # Constructor
+    # * Recording is a dictionary lookup and a bisect under one lock, a handful of times per NWDB page and never per meta row. Collectors (cache, pool stats) and rendering only run when /metrics is scraped.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = dict(METRICS_DEFAULTS)
+        self.enabled = True
+        self.server_timing = False
+        # (name, labels) -> Histogram / float; labels is a sorted tuple of (key, value) pairs
+        self.histograms = {}
+        self.counters = {}
+        # (name, labels) -> callable returning a dictionary of numeric stats
+        self.collectors = {}
+
+    # configure
+    # Apply the 'metrics' section of nwhandler_config.yaml
+    # @param settings 'metrics' section (may be None)
+    def configure(self, settings=None):
+        self.settings = dict(METRICS_DEFAULTS)
+        self.settings.update(settings or {})
+        self.enabled = bool(self.settings['enabled'])
+        self.server_timing = self.enabled and bool(self.settings['server_timing'])
+
+    # observe
+    # Record value in the histogram name{labels}
+    # @param name Metric name
+    # @param value Observed value
+    # @param buckets Bucket upper bounds used when the histogram is created
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    # phase
+    # Record the duration of one phase (connect, first_byte, download, decode, pivot, serialize) of an operation, also adding it to the Server-Timing totals of the current request
+    # @param op Operation, e.g. the NWDB msg ('query', 'values') or REST endpoint
+    # @param phase Phase name
+    # @param seconds Duration in seconds
+    def phase(self, op, phase, seconds):
+        if not self.enabled:
+            return
+        self.observe('nwapi_phase_seconds', seconds, op=op, phase=phase)
+        phases = _request_phases.get()
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    # timer
+    # Context manager recording the duration of its block with phase()
+    def timer(self, op, phase):
+        return PhaseTimer(self, op, phase)
+
+    # inc
+    # Add value to the counter name{labels}
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # collector
+    # Register a callable whose numeric stats are exported as nwapi_<name>_<stat> gauges when metrics are rendered, e.g. NWQueryCache.stats()
+    # @param name Gauge name prefix
+    # @param fn Callable returning a dictionary of numeric stats
+    def collector(self, name, fn, **labels):
+        with self.lock:
+            self.collectors[(name, tuple(sorted(labels.items())))] = fn
+
+    # startRequest
+    # Begin collecting phase totals for the request served in the current context. Returns a token for endRequest(), or None when Server-Timing is disabled.
+    def startRequest(self):
+        if not self.server_timing:
+            return None
+        return _request_phases.set({ '_start': time.perf_counter() })
+
+    # endRequest
+    # Stop collecting for the request and return its Server-Timing header value, or None
+    # @param token Token returned by startRequest()
+    def endRequest(self, token):
+        if token is None:
+            return None
+        phases = _request_phases.get() or {}
+        _request_phases.reset(token)
+        total = time.perf_counter() - phases.pop('_start', time.perf_counter())
+        entries = [name + ';dur=' + format(seconds * 1000, '.1f') for name, seconds in phases.items()]
+        entries.append('total;dur=' + format(total * 1000, '.1f'))
+        return ', '.join(entries)
+
+    # render
+    # Return every metric in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            histograms = sorted((key, list(h.counts), h.sum, h.count, h.bounds) for key, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+            collectors = list(self.collectors.items())
+        lines = []
+        typed = set()
+        for (name, labels), counts, total, count, bounds in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE ' + name + ' histogram')
+            cumulative = 0
+            for bound, n in zip(list(bounds) + ['+Inf'], counts):
+                cumulative += n
+                lines.append(name + '_bucket' + formatLabels(labels + (('le', bound if bound == '+Inf' else repr(float(bound))),)) + ' ' + str(cumulative))
+            lines.append(name + '_sum' + formatLabels(labels) + ' ' + repr(total))
+            lines.append(name + '_count' + formatLabels(labels) + ' ' + str(count))
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE ' + name + ' counter')
+            lines.append(name + formatLabels(labels) + ' ' + str(value))
+        for (name, labels), fn in sorted(collectors, key=lambda item: item[0]):
+            try:
+                stats = fn()
+            except Exception as e:
+                print('NWMetrics::render() collector ' + name + ' Exception => ' + str(e) + '\n')
+                continue
+            for stat, value in sorted(stats.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = 'nwapi_' + name + '_' + stat
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append('# TYPE ' + metric + ' gauge')
+                lines.append(metric + formatLabels(labels) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+
+# formatLabels
+# Render a label tuple as {k="v",...}, escaping quotes and backslashes
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels) + '}'
+
+
+# Registry shared by every handler, transport and the REST app in the process
+METRICS = NWMetrics()
@@ -0,0 +1,490 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWQuery.py:
+
+  Helpers for inspecting, normalizing and validating NWDB query strings.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import calendar
+import re
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+# NWDB time literal format, e.g. "2020-jan-01 00:00:00" (UTC)
+NW_TIME_FORMAT = '%Y-%b-%d %H:%M:%S'
+
+# time="<start>"-"<end>" or time="<start>"-u (open ended, until now)
+TIME_RANGE = re.compile(r'(?<![\w.])time\s*=\s*"([^"]+)"\s*-\s*(?:"([^"]+)"|(u)\b)', re.IGNORECASE)
+
+# Field list of a select clause
+SELECT_CLAUSE = re.compile(r'^\s*select\s+(.*?)(?:\s+where\s+.*)?$', re.IGNORECASE | re.DOTALL)
+
+
+# selectFields
+# Return the meta keys in the query's select list, or None for 'select *' and queries without a select clause
+# @param query NWDB query
+def selectFields(query):
+    match = SELECT_CLAUSE.match(query or '')
+    if not match or match.group(1).strip() == '*':
+        return None
+    return [f.strip() for f in match.group(1).split(',') if f.strip()]
+
+
+# parseTime
+# Convert a NWDB time literal to epoch seconds, also accepting bare epoch seconds
+# @param value Time literal, e.g. "2020-jan-01 00:00:00"
+def parseTime(value):
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    return calendar.timegm(time.strptime(value, NW_TIME_FORMAT))
+
+
+# formatTime
+# Convert epoch seconds to a NWDB time literal
+# @param epoch Seconds since the epoch (UTC)
+def formatTime(epoch):
+    return time.strftime(NW_TIME_FORMAT, time.gmtime(int(epoch))).lower()
+
+
+# timeRange
+# Return the (start, end) epoch seconds of the query's time="A"-"B" clause, with end None for open ended ranges, or None when the query has no time range
+# @param query NWDB query or where clause
+def timeRange(query):
+    match = TIME_RANGE.search(query or '')
+    if not match:
+        return None
+    try:
+        start = parseTime(match.group(1))
+        end = None if match.group(3) else parseTime(match.group(2))
+    except ValueError:
+        return None
+    return (start, end)
+
+
+# replaceTimeRange
+# Return the canonical query with its top level time range conjunct replaced by time="start"-"end"; a range ANDed from inside parentheses is narrowed by ANDing the new range instead. Raises NWQueryError when the query has no top level time range, e.g. one under || or !.
+# @param query NWDB query or where clause containing a time range
+# @param start Range start in epoch seconds
+# @param end Range end in epoch seconds
+def replaceTimeRange(query, start, end):
+    parsed = parseQuery(query)
+    if parsed.time_range is None:
+        raise NWQueryError('Query has no top level time range')
+    clause = 'time="' + formatTime(start) + '"-"' + formatTime(end) + '"'
+    terms = topLevelTerms(parsed.where)
+    for i, term in enumerate(terms):
+        if term.startswith('time=') and timeRange(term) == parsed.time_range:
+            terms[i] = clause
+            return replaceWhere(parsed, ' && '.join(terms))
+    return addCondition(parsed, clause)
+
+
+# topLevelTerms
+# Split a canonical where clause on the && connectors outside parentheses and quoted values
+# @param where Canonical where clause without top level ||
+def topLevelTerms(where):
+    terms = []
+    depth = 0
+    quoted = False
+    start = 0
+    i = 0
+    while i < len(where):
+        c = where[i]
+        if quoted and c == '\\':
+            i += 1
+        elif c == '"':
+            quoted = not quoted
+        elif not quoted and c in '()':
+            depth += 1 if c == '(' else -1
+        elif not quoted and depth == 0 and where.startswith(' && ', i):
+            terms.append(where[start:i])
+            start = i + 4
+            i = start
+            continue
+        i += 1
+    terms.append(where[start:])
+    return terms
+
+
+# isImmutable
+# True when the query's top level time range ended more than settle seconds ago, so its results can no longer change. A time clause under || or ! doesn't bound the query, and malformed queries are never immutable.
+# @param query NWDB query or where clause
+# @param now Reference epoch seconds, defaults to the current time
+# @param settle Seconds after the end of the range during which late arriving sessions may still be added
+def isImmutable(query, now=None, settle=0):
+    try:
+        rng = parseQuery(query).time_range
+    except NWQueryError:
+        return False
+    if rng is None or rng[1] is None:
+        return False
+    return rng[1] < (now if now is not None else time.time()) - settle
+
+
+# normalizeQuery
+# Collapse whitespace outside quoted values and lower-case the select/where keywords, so trivially different spellings of a query compare equal
+# @param query NWDB query or where clause
+def normalizeQuery(query):
+    if not query:
+        return ''
+    out = []
+    for piece in re.split(r'("(?:[^"\\]|\\.)*")', query.strip()):
+        if piece.startswith('"'):
+            out.append(piece)
+        else:
+            piece = re.sub(r'\s+', ' ', piece)
+            piece = re.sub(r'\b(select|where)\b', lambda m: m.group(1).lower(), piece, flags=re.IGNORECASE)
+            out.append(piece)
+    return ''.join(out)
+
+
+# * Parser Section
+# Defaults applied when the 'validation' section of nwhandler_config.yaml omits a setting
+VALIDATION_DEFAULTS = {
+    'enabled': True,
+    'require_time': False,
+    'default_span': 0,
+    'max_span': 0,
+    'allowed_fields': [],
+    'allow_select_all': True,
+    'max_records': 0,
+    'max_size': 0
+}
+
+# Tokens of the NWDB select/where grammar: quoted values, operators, and bare words (meta keys, keywords, numbers, IPs, CIDRs, ranges)
+QUERY_TOKEN = re.compile(r'''\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<op>&&|\|\||!=|<=|>=|=|<|>|\(|\)|,|!|-)
+  | (?P<word>[A-Za-z0-9_.:/*][A-Za-z0-9_.:/*\-]*)
+)''', re.VERBOSE)
+
+META_KEY = re.compile(r'^[a-z][a-z0-9_.]*$')
+COMPARE_OPS = ('=', '!=', '<', '<=', '>', '>=')
+WORD_OPS = ('contains', 'begins', 'ends', 'regex')
+RESERVED = ('select', 'where', 'group', 'order', 'by', 'exists', 'asc', 'desc', '&&', '||') + WORD_OPS
+
+# Result of parseQuery(): canonical query text, select list (None for '*' or a bare where clause), canonical where clause, meta keys referenced by the where clause, and the top level time range (start, end) or None
+ParsedQuery = namedtuple('ParsedQuery', ['canonical', 'fields', 'where', 'keys', 'time_range'])
+
+
+class NWQueryError(ValueError):
+
+    # Constructor
+    # @param message Description of what is wrong with the query
+    # @param position Character offset in the query where the problem was found, if known
+    def __init__(self, message, position=None):
+        if position is not None:
+            message = message + ' at position ' + str(position)
+        super().__init__(message)
+        self.position = position
+
+
+class QueryParser:
+
+    # Constructor
+    # * Recursive descent parser over the NWDB grammar: select <fields|*> [where <condition>] [group by ...] [order by ...], or a bare where clause. Conditions are <key> <op> <value>[,<value>...], <key> exists / !exists, combined with &&, ||, ! and parentheses.
+    # @param query Query text
+    def __init__(self, query):
+        self.query = query
+        self.tokens = []
+        pos = 0
+        text = query.rstrip()
+        while pos < len(text):
+            match = QUERY_TOKEN.match(text, pos)
+            if not match or match.end() == pos:
+                rest = text[pos:].lstrip()
+                pos = len(text) - len(rest)
+                raise NWQueryError('Unterminated quoted value' if rest.startswith('"') else 'Unexpected character ' + repr(rest[:1]), pos)
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind), match.start(kind)))
+            pos = match.end()
+        self.index = 0
+        self.keys = set()
+
+    def peek(self, offset=0):
+        i = self.index + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None, len(self.query))
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise NWQueryError('Unexpected end of query', token[2])
+        self.index += 1
+        return token
+
+    def isWord(self, value, offset=0):
+        kind, text, pos = self.peek(offset)
+        return kind == 'word' and text.lower() == value
+
+    def expect(self, kind, value=None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1].lower() != value):
+            raise NWQueryError('Expected ' + repr(value or kind) + ' but found ' + repr(token[1]), token[2])
+        return token
+
+    # parse
+    # Parse the whole query. Returns (canonical, fields, where, conjuncts) where conjuncts are the (key, condition text) pairs ANDed at the top level of the where clause.
+    def parse(self):
+        fields = None
+        if not self.tokens:
+            raise NWQueryError('Empty query', 0)
+        if self.isWord('select'):
+            self.next()
+            fields = self.fieldList()
+            where, conjuncts = '', []
+            if self.isWord('where'):
+                self.next()
+                where, conjuncts = self.expression()
+            tail = self.trailer()
+            canonical = 'select ' + (','.join(fields) if fields else '*') + (' where ' + where if where else '') + tail
+        else:
+            where, conjuncts = self.expression()
+            canonical = where
+        if self.peek()[0] is not None:
+            raise NWQueryError('Unexpected ' + repr(self.peek()[1]), self.peek()[2])
+        return (canonical, fields, where, conjuncts)
+
+    # fieldList
+    # '*' or a comma separated list of meta keys; duplicates are dropped. Returns None for '*'.
+    def fieldList(self):
+        kind, text, pos = self.next()
+        if kind == 'word' and text == '*':
+            return None
+        fields = [self.metaKey((kind, text, pos))]
+        while self.peek()[1] == ',':
+            self.next()
+            fields.append(self.metaKey(self.next()))
+        return list(dict.fromkeys(fields))
+
+    # trailer
+    # Optional 'group by <keys>' and 'order by <key> [asc|desc]' clauses
+    def trailer(self):
+        tail = ''
+        for clause in ('group', 'order'):
+            if self.isWord(clause):
+                self.next()
+                self.expect('word', 'by')
+                keys = [self.orderKey() if clause == 'order' else self.metaKey(self.next())]
+                while self.peek()[1] == ',':
+                    self.next()
+                    keys.append(self.orderKey() if clause == 'order' else self.metaKey(self.next()))
+                tail += ' ' + clause + ' by ' + ','.join(keys)
+        return tail
+
+    def orderKey(self):
+        key = self.metaKey(self.next())
+        if self.isWord('asc') or self.isWord('desc'):
+            key += ' ' + self.next()[1].lower()
+        return key
+
+    def metaKey(self, token):
+        kind, text, pos = token
+        key = (text or '').lower()
+        if kind != 'word' or not META_KEY.match(key) or key in RESERVED:
+            raise NWQueryError('Expected a meta key but found ' + repr(text), pos)
+        return key
+
+    # expression
+    # term (('&&' | '||') term)*. Returns (canonical text, top level conjuncts); an expression containing '||' has no conjuncts.
+    def expression(self):
+        text, conjuncts = self.unary()
+        parts = [text]
+        anyOr = False
+        while self.peek()[1] in ('&&', '||'):
+            connector = self.next()[1]
+            anyOr = anyOr or connector == '||'
+            text, more = self.unary()
+            parts.append(connector)
+            parts.append(text)
+            conjuncts = conjuncts + more
+        return (' '.join(parts), [] if anyOr else conjuncts)
+
+    def unary(self):
+        kind, text, pos = self.peek()
+        if text == '!' and not self.isWord('exists', 1):
+            self.next()
+            inner, conjuncts = self.unary()
+            return ('!' + inner, [])
+        if text == '(':
+            self.next()
+            inner, conjuncts = self.expression()
+            self.expect('op', ')')
+            return ('(' + inner + ')', conjuncts)
+        return self.condition()
+
+    # condition
+    # <key> exists | <key> !exists | <key> <op> <values>
+    def condition(self):
+        key = self.metaKey(self.next())
+        self.keys.add(key)
+        kind, text, pos = self.peek()
+        if kind == 'word' and text.lower() == 'exists':
+            self.next()
+            return (key + ' exists', [])
+        if text == '!' and self.isWord('exists', 1):
+            self.next()
+            self.next()
+            return (key + ' !exists', [])
+        if kind == 'op' and text in COMPARE_OPS:
+            self.next()
+            clause = key + text + self.values()
+        elif kind == 'word' and text.lower() in WORD_OPS:
+            self.next()
+            clause = key + ' ' + text.lower() + ' ' + self.values()
+        else:
+            raise NWQueryError('Expected an operator after ' + repr(key) + ' but found ' + repr(text), pos)
+        return (clause, [(key, clause)])
+
+    def values(self):
+        out = [self.value()]
+        while self.peek()[1] == ',':
+            self.next()
+            out.append(self.value())
+        return ','.join(out)
+
+    # value
+    # A quoted string or bare word, optionally a range 'a-b' (either end may be 'u' or 'l' for the upper/lower bound of the database)
+    def value(self):
+        text = self.atom()
+        if self.peek()[1] == '-':
+            self.next()
+            text += '-' + self.atom()
+        return text
+
+    def atom(self):
+        kind, text, pos = self.next()
+        if kind == 'string':
+            return text
+        if kind == 'word' and text.lower() not in RESERVED:
+            return text.lower() if text.lower() in ('u', 'l') else text
+        raise NWQueryError('Expected a value but found ' + repr(text), pos)
+
+
+# parseQuery
+# Parse a query or bare where clause into a ParsedQuery, raising NWQueryError for malformed input. Results are cached per query string, so repeated queries are parsed once.
+# @param query NWDB query or where clause
+@lru_cache(maxsize=4096)
+def parseQuery(query):
+    if not query or not query.strip():
+        raise NWQueryError('No query provided')
+    parser = QueryParser(query)
+    canonical, fields, where, conjuncts = parser.parse()
+    rng = None
+    for key, clause in conjuncts:
+        if key == 'time':
+            rng = timeRange(clause)
+            if rng is not None:
+                break
+    return ParsedQuery(canonical, tuple(fields) if fields else None, where, frozenset(parser.keys), rng)
+
+
+# canonicalQuery
+# Canonical text of a query (lower-cased keywords and meta keys, single spacing, operators without padding), usable as a cache or dedup key. Queries the parser rejects fall back to normalizeQuery().
+# @param query NWDB query or where clause
+def canonicalQuery(query):
+    try:
+        return parseQuery(query).canonical
+    except NWQueryError:
+        return normalizeQuery(query)
+
+
+# validateQuery
+# Parse a query and apply the cost policies of the 'validation' config section. Returns (query, records) with the query text to send to NWDB, which is the query as written (with a time range ANDed on when require_time and default_span ask for it), and records capped to max_records (or max_size for aggregations); raises NWQueryError when the query is malformed or violates a policy. The canonical form is only used for checking here and for cache and single-flight keys (canonicalQuery()). With validation disabled the query is passed through untouched.
+# @param query NWDB query, or a where clause when where_only is set
+# @param settings Validation settings, VALIDATION_DEFAULTS plus the 'validation' config section
+# @param records Number of records (or values, for aggregations) requested, None for no limit (replaced by the cap when one is configured)
+# @param where_only The query is a bare where clause (queryNWDBAggregate)
+# @param fields Additional meta keys subject to allowed_fields, e.g. the fields being aggregated
+# @param now Reference epoch seconds, defaults to the current time
+def validateQuery(query, settings, records=None, where_only=False, fields=None, now=None):
+    if not settings.get('enabled', True):
+        if not query or not query.strip():
+            raise NWQueryError('No query provided')
+        return (query, records)
+    parsed = parseQuery(query)
+    if where_only and parsed.canonical.startswith('select '):
+        raise NWQueryError('Expected a where clause, not a select query')
+    if not where_only and not parsed.canonical.startswith('select '):
+        raise NWQueryError("Query must start with 'select'")
+    now = int(now if now is not None else time.time())
+    query = query.strip()
+    rng = parsed.time_range
+
+    allowed = settings.get('allowed_fields') or []
+    if not where_only and parsed.fields is None and (allowed or not settings.get('allow_select_all', True)):
+        raise NWQueryError("'select *' is not allowed, list the meta keys to return")
+    if allowed:
+        denied = [f for f in (parsed.fields or ()) + tuple(fields or ()) if f not in allowed]
+        if denied:
+            raise NWQueryError('Meta keys not allowed: ' + ', '.join(denied))
+
+    if rng is None and settings.get('require_time'):
+        span = int(settings.get('default_span') or 0)
+        if not span:
+            raise NWQueryError('Query requires a time="start"-"end" range')
+        rng = (now - span, now)
+        query = injectCondition(query, parsed, 'time="' + formatTime(rng[0]) + '"-"' + formatTime(rng[1]) + '"')
+
+    maxSpan = int(settings.get('max_span') or 0)
+    if maxSpan and rng is not None:
+        end = rng[1] if rng[1] is not None else now
+        if end - rng[0] > maxSpan:
+            raise NWQueryError('Time range of ' + str(end - rng[0]) + ' seconds exceeds the maximum of ' + str(maxSpan))
+
+    cap = int(settings.get('max_size' if where_only else 'max_records') or 0)
+    if cap:
+        records = cap if records is None else min(int(records), cap)
+    return (query, records)
+
+
+# injectCondition
+# Return the query text as written with condition ANDed onto its where clause (or added as the where clause), leaving the rest of the text untouched
+# @param query Stripped query text
+# @param parsed parseQuery() result of query
+# @param condition Canonical condition to add
+def injectCondition(query, parsed, condition):
+    if not parsed.canonical.startswith('select '):
+        return ('(' + query + ')' if ' || ' in parsed.where else query) + ' && ' + condition
+    tokens = QueryParser(query).tokens
+    words = [(i, text.lower(), pos) for i, (kind, text, pos) in enumerate(tokens) if kind == 'word']
+    wherePos = next((pos for i, text, pos in words if text == 'where'), None)
+    tailPos = next((pos for i, text, pos in words if text in ('group', 'order') and i + 1 < len(tokens) and tokens[i + 1][1].lower() == 'by' and (wherePos is None or pos > wherePos)), len(query))
+    tail = (' ' + query[tailPos:]) if tailPos < len(query) else ''
+    if wherePos is None:
+        return query[:tailPos].rstrip() + ' where ' + condition + tail
+    where = query[wherePos + len('where'):tailPos].strip()
+    if ' || ' in parsed.where:
+        where = '(' + where + ')'
+    return query[:wherePos].rstrip() + ' where ' + where + ' && ' + condition + tail
+
+
+# addCondition
+# Return the parsed query's canonical text with condition ANDed onto its where clause
+def addCondition(parsed, condition):
+    where = parsed.where
+    if where and ' || ' in where:
+        where = '(' + where + ')'
+    where = where + ' && ' + condition if where else condition
+    return replaceWhere(parsed, where)
+
+
+# replaceWhere
+# Return the parsed query's canonical text with its where clause replaced by where
+def replaceWhere(parsed, where):
+    if not parsed.canonical.startswith('select '):
+        return where
+    head = 'select ' + (','.join(parsed.fields) if parsed.fields else '*')
+    tail = parsed.canonical[len(head) + (len(' where ' + parsed.where) if parsed.where else 0):]
+    return head + ' where ' + where + tail
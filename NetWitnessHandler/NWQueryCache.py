@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWQueryCache.py:
+
+  Query result cache for NWHandler with a memory budget, LRU eviction, TTL expiry and an optional on-disk tier.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+# Defaults applied when the 'cache' section of nwhandler_config.yaml omits a setting
+CACHE_DEFAULTS = {
+    'enabled': True,
+    'max_bytes': 256 * 1024 * 1024,
+    'ttl': 60,
+    'settle': 60,
+    'disk_path': '',
+    'disk_max_bytes': 4 * 1024 * 1024 * 1024
+}
+
+
+class NWQueryCache:
+
+    # Constructor
+    # @param settings 'cache' section of nwhandler_config.yaml (may be None)
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, settings=None, debug=0):
+        self.settings = dict(CACHE_DEFAULTS)
+        self.settings.update(settings or {})
+        self.debug = debug
+        self.enabled = bool(self.settings['enabled'])
+        self.max_bytes = int(self.settings['max_bytes'])
+        self.ttl = float(self.settings['ttl'])
+        self.settle = float(self.settings['settle'])
+        self.disk_path = self.settings['disk_path'] or None
+        self.disk_max_bytes = int(self.settings['disk_max_bytes'])
+        if self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+        # key -> (expires, size, pickled value); expires None never expires. Values are kept pickled so every hit gets its own copy and callers cannot alter the cached result.
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = { 'hits': 0, 'misses': 0, 'disk_hits': 0, 'stores': 0, 'evictions': 0, 'expired': 0 }
+
+    # key
+    # Build the cache key for an operation from its normalized query, parameters and target host
+    # @param op Operation name, e.g. 'queryNWDB'
+    # @param query Normalized query string
+    # @param params Dictionary of result shaping parameters (records, size, field, ...)
+    # @param host NWDB service URL
+    def key(self, op, query, params, host):
+        raw = json.dumps([op, query, params, host], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    # get
+    # Return (True, value) on a hit and (False, None) on a miss, promoting disk hits into memory. The value is unpickled afresh on every hit.
+    # @param key Cache key from key()
+    def get(self, key):
+        if not self.enabled:
+            return (False, None)
+        now = time.time()
+        data = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] is not None and entry[0] <= now:
+                    self.drop(key)
+                    self.counters['expired'] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    data = entry[2]
+        if data is not None:
+            return (True, pickle.loads(data))
+        if self.disk_path:
+            found, expires, data = self.diskGet(key, now)
+            if found:
+                with self.lock:
+                    self.counters['hits'] += 1
+                    self.counters['disk_hits'] += 1
+                self.store(key, data, expires)
+                return (True, pickle.loads(data))
+        with self.lock:
+            self.counters['misses'] += 1
+        return (False, None)
+
+    # put
+    # Store a result. immutable results (time range fully in the past) never expire; everything else lives for the configured ttl.
+    # @param key Cache key from key()
+    # @param value Result to cache
+    # @param immutable True when the result can no longer change
+    def put(self, key, value, immutable=False):
+        if not self.enabled:
+            return
+        expires = None if immutable else time.time() + self.ttl
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.store(key, data, expires)
+        if self.disk_path:
+            self.diskPut(key, expires, data)
+
+    # store
+    # Insert into the memory tier and evict least recently used entries until back under max_bytes
+    # @param data Pickled result
+    def store(self, key, data, expires):
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (expires, size, data)
+            self.bytes += size
+            self.counters['stores'] += 1
+            while self.bytes > self.max_bytes and self.entries:
+                self.drop(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    # drop
+    # Remove an entry from the memory tier, caller holds the lock
+    def drop(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry[1]
+
+    def diskFile(self, key):
+        return os.path.join(self.disk_path, key + '.cache')
+
+    # diskGet
+    # Each disk entry is the pickled expiry followed by the pickled value
+    def diskGet(self, key, now):
+        try:
+            with open(self.diskFile(key), 'rb') as f:
+                expires = pickle.load(f)
+                data = None if expires is not None and expires <= now else f.read()
+        except FileNotFoundError:
+            return (False, None, None)
+        except Exception as e:
+            print('NWQueryCache::diskGet() Exception => ' + str(e) + '\n')
+            return (False, None, None)
+        if data is None:
+            try:
+                os.remove(self.diskFile(key))
+            except OSError:
+                pass
+            return (False, None, None)
+        return (True, expires, data)
+
+    def diskPut(self, key, expires, data):
+        try:
+            tmp = self.diskFile(key) + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(expires, f, pickle.HIGHEST_PROTOCOL)
+                f.write(data)
+            os.replace(tmp, self.diskFile(key))
+            self.diskEvict()
+        except Exception as e:
+            print('NWQueryCache::diskPut() Exception => ' + str(e) + '\n')
+
+    # diskEvict
+    # Remove the least recently written files until the disk tier is back under disk_max_bytes
+    def diskEvict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.disk_path):
+            if entry.name.endswith('.cache'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        files.sort()
+        while total > self.disk_max_bytes and files:
+            mtime, size, path = files.pop(0)
+            try:
+                os.remove(path)
+                total -= size
+                with self.lock:
+                    self.counters['evictions'] += 1
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # stats
+    # Return hit/miss/eviction counters with the current entry count and memory usage
+    def stats(self):
+        with self.lock:
+            ret = dict(self.counters)
+            ret['entries'] = len(self.entries)
+            ret['bytes'] = self.bytes
+        lookups = ret['hits'] + ret['misses']
+        ret['hit_ratio'] = ret['hits'] / lookups if lookups else 0.0
+        return ret
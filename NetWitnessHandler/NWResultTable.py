@@ -0,0 +1,244 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWResultTable.py:
+
+  Columnar result engine pivoting the NWDB per-metavalue 'fields' stream into typed per-field column buffers.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import sys
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Buffer type codes of the typed column kinds; 'str' columns hold int32 codes into their dictionary
+BUFFER_TYPES = { int: 'q', float: 'd', str: 'i' }
+
+# Distinct strings after which a column that is more than half distinct values stops dictionary-encoding (e.g. ip.src on a large result)
+DICTIONARY_MIN = 1024
+
+
+# columnName
+# Sanitize a NWDB meta type into an interned column name ('ip.src' -> 'ip_src')
+# @param metaType NWDB meta key as returned in the 'type' of a meta row
+def columnName(metaType):
+    return sys.intern(str(metaType).replace('.', '_'))
+
+
+class NWColumn:
+
+    # Constructor
+    # * A column is a pair of parallel buffers: the row indexes it has values for and the values. The value buffer is typed from the first value: 64-bit ints and floats go in array('q') / array('d'), strings are dictionary-encoded as array('i') codes into the list of distinct strings until they prove mostly distinct. A value that does not fit (mixed types, bools, ints beyond 64 bits) turns the column into a plain list.
+    def __init__(self):
+        self.rows = array('q')
+        self.kind = None
+        self.values = None
+        self.dictionary = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    # append
+    # Store value for the session at rowIndex
+    def append(self, rowIndex, value):
+        kind = self.kind
+        vtype = type(value)
+        if kind is str and vtype is str:
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.dictionary)
+                self.dictionary.append(value)
+                if code >= DICTIONARY_MIN and code * 2 > len(self.values):
+                    self.demote()
+                    code = value
+            value = code
+        elif kind is not vtype and kind is not object:
+            if kind is None and vtype in BUFFER_TYPES:
+                self.kind = vtype
+                self.values = array(BUFFER_TYPES[vtype])
+                return self.append(rowIndex, value)
+            self.demote()
+        try:
+            self.values.append(value)
+        except OverflowError:
+            self.demote()
+            self.values.append(value)
+        self.rows.append(rowIndex)
+
+    # demote
+    # Convert the value buffer to a plain list
+    def demote(self):
+        self.values = self.decoded() if self.values is not None else []
+        self.kind = object
+        self.dictionary = []
+        self.codes = {}
+
+    # decoded
+    # Values as a list, strings decoded from the dictionary
+    def decoded(self):
+        if self.kind is str:
+            dictionary = self.dictionary
+            return [dictionary[code] for code in self.values]
+        return list(self.values)
+
+    # dense
+    # numpy array of the values with one slot per session (0 where missing) and the mask of missing sessions, None when every session has a value. Strings give their dictionary codes.
+    # @param length Number of sessions in the table
+    def dense(self, length):
+        values = np.frombuffer(self.values, dtype={ 'q': np.int64, 'd': np.float64, 'i': np.int32 }[self.values.typecode]) if len(self.values) else np.empty(0, dtype=np.int64)
+        if len(self.rows) == length:
+            return values.copy(), None
+        out = np.zeros(length, dtype=values.dtype)
+        rows = np.frombuffer(self.rows, dtype=np.int64) if len(self.rows) else np.empty(0, dtype=np.int64)
+        out[rows] = values
+        missing = np.ones(length, dtype=bool)
+        missing[rows] = False
+        return out, missing
+
+
+class NWResultTable:
+
+    # Constructor
+    # * Every column is an NWColumn: sparse row indexes and typed values. Memory grows with the number of meta values, not sessions x fields, and numbers and repeated strings are not stored as Python objects.
+    # @param limit Max number of sessions to hold, further sessions are rejected by append()
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.groups = array('q')
+        self.columns = {}
+        self.names = {}
+        self.multi = set()
+        self.current_group = None
+        self.meta_count = 0
+
+    def __len__(self):
+        return len(self.groups)
+
+    # append
+    # Fold one NWDB meta row into the table. Returns False (without storing the row) once the row would start a session beyond limit.
+    # @param row NWDB meta row (dict with group, type and value)
+    def append(self, row):
+        group = row['group']
+        if group != self.current_group:
+            if self.limit is not None and len(self.groups) >= self.limit:
+                return False
+            self.current_group = group
+            self.groups.append(group)
+        metaType = row['type']
+        name = self.names.get(metaType)
+        if name is None:
+            name = self.names[metaType] = columnName(metaType)
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = NWColumn()
+        rowIndex = len(self.groups) - 1
+        if column.rows and column.rows[-1] == rowIndex:
+            self.multi.add(name)
+        column.append(rowIndex, row['value'])
+        self.meta_count += 1
+        return True
+
+    # extend
+    # Fold an iterable of NWDB meta rows into the table, stopping at limit. Returns False once the limit is reached.
+    # @param rows Iterable of NWDB meta rows
+    def extend(self, rows):
+        for row in rows:
+            if not self.append(row):
+                return False
+        return True
+
+    # column
+    # Materialize a dense column as a list with None for sessions missing the field. Multi-valued columns hold a list of values per session.
+    # @param name Sanitized column name
+    def column(self, name):
+        rows = self.columns[name].rows
+        values = self.columns[name].decoded()
+        out = [None] * len(self.groups)
+        if name in self.multi:
+            for r, v in zip(rows, values):
+                if out[r] is None:
+                    out[r] = [v]
+                else:
+                    out[r].append(v)
+        else:
+            for r, v in zip(rows, values):
+                out[r] = v
+        return out
+
+    # iter_dicts
+    # Lazily yield one {column: value} dictionary per session in NWDB order, using the same sanitized keys as NWHandler.queryNWDB()
+    def iter_dicts(self):
+        cursors = [(name, column.rows, column.values, column.dictionary if column.kind is str else None, name in self.multi) for name, column in self.columns.items()]
+        positions = [0] * len(cursors)
+        for rowIndex in range(len(self.groups)):
+            d = {}
+            for i, (name, rows, values, dictionary, multi) in enumerate(cursors):
+                p = positions[i]
+                while p < len(rows) and rows[p] == rowIndex:
+                    value = values[p] if dictionary is None else dictionary[values[p]]
+                    if multi:
+                        d.setdefault(name, []).append(value)
+                    else:
+                        d[name] = value
+                    p += 1
+                positions[i] = p
+            yield d
+
+    # to_numpy
+    # Return {column: numpy array}. Single valued, fully populated int and float columns are copied straight from their buffers; everything else is an object array.
+    def to_numpy(self):
+        if np is None:
+            raise ImportError('NWResultTable::to_numpy() requires numpy')
+        ret = { 'group': np.array(self.groups, dtype=np.int64) }
+        for name, column in self.columns.items():
+            if name not in self.multi and column.kind in (int, float) and len(column) == len(self.groups):
+                ret[name] = column.dense(len(self.groups))[0]
+            elif name not in self.multi and column.kind is str:
+                codes, missing = column.dense(len(self.groups))
+                arr = np.array(column.dictionary + [None], dtype=object)[codes if missing is None else np.where(missing, len(column.dictionary), codes)]
+                ret[name] = arr
+            else:
+                values = self.column(name)
+                arr = np.empty(len(values), dtype=object)
+                arr[:] = values
+                ret[name] = arr
+        return ret
+
+    # to_arrow
+    # Return the table as a pyarrow Table. Int and float columns are built from their buffers, string columns stay dictionary-encoded and multi-valued columns become list columns.
+    def to_arrow(self):
+        if pa is None:
+            raise ImportError('NWResultTable::to_arrow() requires pyarrow')
+        names = ['group'] + list(self.columns)
+        arrays = [pa.array(self.groups, type=pa.int64())]
+        for name, column in self.columns.items():
+            if name in self.multi or column.kind is object or np is None:
+                arrays.append(pa.array(self.column(name)))
+                continue
+            values, missing = column.dense(len(self.groups))
+            if column.kind is str:
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, mask=missing), pa.array(column.dictionary, type=pa.string())))
+            else:
+                arrays.append(pa.array(values, mask=missing))
+        return pa.Table.from_arrays(arrays, names=names)
+
+    # record_batches
+    # Yield the table as pyarrow RecordBatches of at most batch_size sessions
+    # @param batch_size Number of sessions per batch
+    def record_batches(self, batch_size=65536):
+        return self.to_arrow().to_batches(max_chunksize=batch_size)
@@ -0,0 +1,577 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWSessionStore.py:
+
+  Local materialized session store for NWHandler: the sessions of configured hunt queries are synced incrementally by meta id into SQLite, with indexes on common meta keys, so queries that fall inside a synced query's time range and field set are answered locally instead of by NWDB.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from functools import lru_cache
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from .NWMetrics import METRICS
+    from .NWQuery import QueryParser, NWQueryError, parseQuery, parseTime, formatTime, addCondition
+except ImportError:
+    from NWMetrics import METRICS
+    from NWQuery import QueryParser, NWQueryError, parseQuery, parseTime, formatTime, addCondition
+
+# Defaults applied when the 'store' section of nwhandler_config.yaml omits a setting
+STORE_DEFAULTS = {
+    'enabled': False,
+    'path': '',
+    'queries': [],
+    'indexes': ['ip.src', 'ip.dst', 'alias.host', 'time'],
+    'sync_interval': 300,
+    'page_size': 1000,
+    'settle': 60,
+    'retention': 7 * 86400,
+    'max_bytes': 4 * 1024 * 1024 * 1024,
+    'busy_timeout': 30
+}
+
+NUMBER = re.compile(r'^\d+$')
+DECIMAL = re.compile(r'^\d+\.\d+$')
+
+# Translation of a select query for the store: select list (None for '*'), meta keys of the where clause, top level (key, condition) terms ANDed by the where clause (key None for compound terms), SQL condition and parameters, time range and whether it has group/order by clauses
+StorePlan = namedtuple('StorePlan', ['fields', 'keys', 'terms', 'sql', 'params', 'time_range', 'trailer'])
+
+
+# column
+# Name of the indexed column of a meta key
+# @param key Meta key, e.g. 'ip.src'
+def column(key):
+    return '"m_' + key.replace('.', '_') + '"'
+
+
+# jsonPath
+# JSON path of a meta key in the session data
+def jsonPath(key):
+    return "'$." + key.replace('.', '_') + "'"
+
+
+# anyValue
+# SQL matching sessions where some value of a meta key satisfies a condition, NWDB style. Sessions keep multi-valued meta as JSON arrays in their data, walked with json_each (which yields a scalar as a single value). An indexed column holds the value of single-valued sessions and is NULL otherwise, so the index still narrows the search.
+# @param key Meta key, e.g. 'ip.dst'
+# @param indexed Meta keys with their own column
+# @param condition Function returning (sql, params) of the condition on a value expression
+def anyValue(key, indexed, condition):
+    sql, params = condition('value')
+    each = 'EXISTS (SELECT 1 FROM json_each(data, ' + jsonPath(key) + ') WHERE ' + sql + ')'
+    if key not in indexed:
+        return (each, params)
+    col = column(key)
+    colSql, colParams = condition(col)
+    return ('(' + colSql + ' OR (' + col + ' IS NULL AND ' + each + '))', colParams + params)
+
+
+# likePattern
+# Escape a value for use in a LIKE pattern with ESCAPE '\'
+def likePattern(value):
+    return str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class StoreTranslator(QueryParser):
+
+    # Constructor
+    # * Reuses the QueryParser tokenizer and grammar, translating the where clause to SQL over the sessions table instead of canonical text. Text is compared case-insensitively and a condition matches when any value of a multi-valued key does, as NWDB evaluates them. Conditions SQLite can't evaluate like NWDB (regex, CIDR and wildcard values) raise NWQueryError, which makes the query go to NWDB.
+    # @param query Canonical select query
+    # @param indexed Meta keys with their own column
+    def __init__(self, query, indexed):
+        super().__init__(query)
+        self.indexed = indexed
+
+    # translate
+    # Translate the whole query into a StorePlan
+    def translate(self):
+        if not self.isWord('select'):
+            raise NWQueryError("Query must start with 'select'")
+        self.next()
+        fields = self.fieldList()
+        text, sql, params, terms = ('', '1', [], [])
+        if self.isWord('where'):
+            self.next()
+            text, sql, params, terms = self.sqlExpression()
+            if terms is None:
+                terms = [(None, text)]
+        trailer = self.trailer()
+        if self.peek()[0] is not None:
+            raise NWQueryError('Unexpected ' + repr(self.peek()[1]), self.peek()[2])
+        return StorePlan(tuple(fields) if fields else None, frozenset(self.keys), tuple(terms), sql, tuple(params), parseQuery(self.query).time_range, bool(trailer))
+
+    # sqlExpression
+    # unary (('&&' | '||') unary)*. Returns (text, sql, params, terms); terms is None when the expression contains '||'.
+    def sqlExpression(self):
+        text, sql, params, terms = self.sqlUnary()
+        texts = [text]
+        sqls = [sql]
+        params = list(params)
+        anyOr = False
+        while self.peek()[1] in ('&&', '||'):
+            connector = self.next()[1]
+            anyOr = anyOr or connector == '||'
+            text, sql, more, moreTerms = self.sqlUnary()
+            texts += [connector, text]
+            sqls += ['OR' if connector == '||' else 'AND', sql]
+            params += more
+            terms = terms + moreTerms
+        if len(texts) == 1:
+            return (texts[0], sqls[0], params, terms)
+        return (' '.join(texts), '(' + ' '.join(sqls) + ')', params, None if anyOr else terms)
+
+    def sqlUnary(self):
+        kind, text, pos = self.peek()
+        if text == '!' and not self.isWord('exists', 1):
+            self.next()
+            inner, sql, params, terms = self.sqlUnary()
+            return ('!' + inner, 'NOT coalesce(' + sql + ', 0)', params, [(None, '!' + inner)])
+        if text == '(':
+            self.next()
+            inner, sql, params, terms = self.sqlExpression()
+            self.expect('op', ')')
+            return ('(' + inner + ')', sql, params, terms if terms is not None else [(None, '(' + inner + ')')])
+        return self.sqlCondition()
+
+    # sqlCondition
+    # <key> exists | <key> !exists | <key> <op> <values>, as (text, sql, params, [(key, text)])
+    def sqlCondition(self):
+        key = self.metaKey(self.next())
+        self.keys.add(key)
+        kind, text, pos = self.peek()
+        if kind == 'word' and text.lower() == 'exists':
+            self.next()
+            clause = key + ' exists'
+            return (clause, self.present(key), [], [(key, clause)])
+        if text == '!' and self.isWord('exists', 1):
+            self.next()
+            self.next()
+            clause = key + ' !exists'
+            return (clause, 'NOT ' + self.present(key), [], [(key, clause)])
+        if kind == 'op' and text in ('=', '!=', '<', '<=', '>', '>='):
+            op = self.next()[1]
+            values = self.sqlValues(key)
+            clause = key + op + ','.join(v[0] for v in values)
+            condition = lambda col: self.compare(col, op, values)
+        elif kind == 'word' and text.lower() in ('contains', 'begins', 'ends'):
+            op = self.next()[1].lower()
+            values = self.sqlValues(key)
+            clause = key + ' ' + op + ' ' + ','.join(v[0] for v in values)
+            if any(v[3] for v in values):
+                raise NWQueryError('Ranges are not supported with ' + op)
+            pattern = { 'contains': '%{}%', 'begins': '{}%', 'ends': '%{}' }[op]
+            # LIKE is case-insensitive
+            condition = lambda col: ('(' + ' OR '.join([col + " LIKE ? ESCAPE '\\'"] * len(values)) + ')', [pattern.format(likePattern(v[1])) for v in values])
+        else:
+            raise NWQueryError('Operator ' + repr(text) + ' is not supported by the session store', pos)
+        # Sessions have a single time, kept in m_time
+        sql, params = condition('m_time') if key == 'time' else anyValue(key, self.indexed, condition)
+        return (clause, sql, params, [(key, clause)])
+
+    # present
+    # SQL testing whether a session has a meta key
+    def present(self, key):
+        if key == 'time':
+            return '(m_time IS NOT NULL)'
+        return '(json_type(data, ' + jsonPath(key) + ') IS NOT NULL)'
+
+    # compare
+    # SQL for a comparison of a value expression against values; '=' and '!=' take several values and ranges, the others a single value. Text compares case-insensitively.
+    def compare(self, col, op, values):
+        col += ' COLLATE NOCASE'
+        if op in ('=', '!='):
+            parts = []
+            params = []
+            for text, lo, hi, isRange in values:
+                if not isRange:
+                    parts.append(col + ' = ?')
+                    params.append(lo)
+                elif lo is None and hi is None:
+                    parts.append(col + ' IS NOT NULL')
+                elif lo is None or hi is None:
+                    parts.append(col + (' <= ?' if lo is None else ' >= ?'))
+                    params.append(hi if lo is None else lo)
+                else:
+                    parts.append(col + ' BETWEEN ? AND ?')
+                    params += [lo, hi]
+            sql = '(' + ' OR '.join(parts) + ')'
+            if op == '!=':
+                sql = '(' + col + ' IS NOT NULL AND NOT ' + sql + ')'
+            return (sql, params)
+        if len(values) != 1 or values[0][3]:
+            raise NWQueryError(op + ' takes a single value')
+        return (col + ' ' + op + ' ?', [values[0][1]])
+
+    # sqlValues
+    # Comma separated values as (text, low, high, is_range) tuples; low/high are None for the open 'l'/'u' ends of a range
+    def sqlValues(self, key):
+        out = [self.sqlValue(key)]
+        while self.peek()[1] == ',':
+            self.next()
+            out.append(self.sqlValue(key))
+        return out
+
+    def sqlValue(self, key):
+        first = self.atom()
+        if self.peek()[1] == '-':
+            self.next()
+            second = self.atom()
+            return (first + '-' + second, self.literal(key, first, True), self.literal(key, second, True), True)
+        if not first.startswith('"') and '-' in first:
+            lo, hi = first.split('-', 1)
+            if all(NUMBER.match(v) or v in ('u', 'l') for v in (lo, hi)):
+                return (first, self.literal(key, lo, True), self.literal(key, hi, True), True)
+        value = self.literal(key, first)
+        return (first, value, value, False)
+
+    # literal
+    # Python value of a query value: time literals become epoch seconds, bare integers and decimals numbers, quoted values unescaped strings
+    def literal(self, key, text, bound=False):
+        if bound and text in ('u', 'l'):
+            return None
+        quoted = text.startswith('"')
+        if quoted:
+            text = re.sub(r'\\(.)', r'\1', text[1:-1])
+        if key == 'time':
+            try:
+                return parseTime(text)
+            except ValueError:
+                raise NWQueryError('Unsupported time value ' + repr(text))
+        if quoted:
+            return text
+        if NUMBER.match(text):
+            return int(text)
+        if DECIMAL.match(text):
+            return float(text)
+        if '/' in text or '*' in text:
+            raise NWQueryError('CIDR and wildcard values are not supported by the session store')
+        return text
+
+
+# storePlan
+# Translate a query for the store, None when it can't be answered locally. Cached per query, like parseQuery().
+# @param query Canonical select query
+# @param indexed Frozenset of meta keys with their own column
+@lru_cache(maxsize=1024)
+def storePlan(query, indexed):
+    try:
+        return StoreTranslator(query, indexed).translate()
+    except NWQueryError:
+        return None
+
+
+class NWSessionStore:
+
+    # Constructor
+    # * Every configured query gets a coverage window [since, watermark]: since starts retention seconds before the query was first synced and moves up as sessions are evicted; the watermark is the start of the last complete sync minus settle seconds, so sessions NWDB is still receiving aren't assumed complete. A query is answered locally when its where clause ANDs every condition of a synced query, the synced query returns every meta key it uses, and its time range lies inside that window; anything else goes to NWDB.
+    # * The database is shared by every process on the host (WAL mode); a lock file next to it lets only one process sync at a time.
+    # @param handler NWHandler used to sync from NWDB
+    # @param settings 'store' section of nwhandler_config.yaml (may be None)
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, handler, settings=None, debug=0):
+        self.handler = handler
+        self.debug = debug
+        self.settings = dict(STORE_DEFAULTS)
+        self.settings.update(settings or {})
+        self.path = self.settings['path'] or os.path.join(tempfile.gettempdir(), 'nwapi-store.sqlite')
+        self.indexed = frozenset(k for k in self.settings['indexes'] if k != 'time')
+        self.columns = sorted(self.indexed)
+        self.local = threading.local()
+        self.syncLock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.counters = { 'hits': 0, 'misses': 0, 'syncs': 0, 'sync_errors': 0, 'synced_sessions': 0, 'evicted_sessions': 0 }
+        self.lock = threading.Lock()
+        self.createSchema()
+        # Synced queries: dictionaries with id, query, initial (first sync query, limited to the retention window), fields and terms
+        self.queries = self.registerQueries(self.settings['queries'] or [])
+
+    # connect
+    # Per-thread SQLite connection
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=float(self.settings['busy_timeout']))
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    # createSchema
+    # Create the tables and one case-insensitive index per indexed meta key. Columns for keys added to 'indexes' later are added and backfilled from the stored session data.
+    def createSchema(self):
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS queries (id INTEGER PRIMARY KEY, query TEXT UNIQUE NOT NULL, since INTEGER NOT NULL, watermark INTEGER, synced REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS cursors (q INTEGER NOT NULL, service TEXT NOT NULL, meta_id INTEGER NOT NULL, PRIMARY KEY (q, service))')
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions (q INTEGER NOT NULL, service TEXT NOT NULL, id INTEGER NOT NULL, m_time INTEGER, data TEXT NOT NULL, PRIMARY KEY (q, service, id))')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_m_time ON sessions (m_time)')
+        existing = set(row[1] for row in conn.execute('PRAGMA table_info(sessions)'))
+        for key in self.columns:
+            name = 'm_' + key.replace('.', '_')
+            if name not in existing:
+                conn.execute('ALTER TABLE sessions ADD COLUMN "' + name + '"')
+                conn.execute('UPDATE sessions SET "' + name + '" = CASE json_type(data, ' + jsonPath(key) + ") WHEN 'array' THEN NULL ELSE json_extract(data, " + jsonPath(key) + ') END')
+            # Older stores indexed the columns case-sensitively
+            conn.execute('DROP INDEX IF EXISTS "sessions_' + name + '"')
+            conn.execute('CREATE INDEX IF NOT EXISTS "sessions_' + name + '_nocase" ON sessions ("' + name + '" COLLATE NOCASE)')
+        conn.commit()
+        names = ', '.join(column(k) for k in self.columns)
+        updates = ''.join(', ' + column(k) + ' = CASE WHEN json_type(excluded.data, ' + jsonPath(k) + ') IS NULL THEN ' + column(k) + ' ELSE excluded.' + column(k) + ' END' for k in self.columns)
+        # Meta of a session can arrive over two syncs; the second part is merged into the stored session
+        self.upsert = ('INSERT INTO sessions (q, service, id, m_time' + (', ' + names if names else '') + ', data) VALUES (' + ', '.join(['?'] * (len(self.columns) + 5)) + ') '
+                       'ON CONFLICT (q, service, id) DO UPDATE SET data = json_patch(data, excluded.data), m_time = coalesce(excluded.m_time, m_time)' + updates)
+
+    # registerQueries
+    # Canonicalize the configured queries, register new ones and drop the stored sessions of queries no longer configured. 'time' is added to select lists that lack it, since coverage is tracked by session time.
+    def registerQueries(self, configured):
+        conn = self.connect()
+        now = int(time.time())
+        ret = []
+        for query in configured:
+            try:
+                parsed = parseQuery(query)
+                if not parsed.canonical.startswith('select '):
+                    raise NWQueryError("Query must start with 'select'")
+                if 'time' in parsed.keys:
+                    raise NWQueryError('Synced queries must not have a time condition')
+                canonical = parsed.canonical
+                if parsed.fields and 'time' not in parsed.fields:
+                    canonical = 'select ' + ','.join(parsed.fields + ('time',)) + canonical[len('select ' + ','.join(parsed.fields)):]
+                plan = storePlan(canonical, self.indexed)
+                if plan is None or plan.trailer:
+                    raise NWQueryError('Query is not supported by the session store')
+            except NWQueryError as e:
+                print('NWSessionStore::registerQueries() skipping ' + repr(query) + ' => ' + str(e) + '\n')
+                continue
+            conn.execute('INSERT OR IGNORE INTO queries (query, since) VALUES (?, ?)', (canonical, now - int(self.settings['retention'])))
+            qid, since = conn.execute('SELECT id, since FROM queries WHERE query = ?', (canonical,)).fetchone()
+            initial = addCondition(parseQuery(canonical), 'time="' + formatTime(since) + '"-u')
+            ret.append({ 'id': qid, 'query': canonical, 'initial': initial, 'fields': frozenset(plan.fields) if plan.fields else None, 'terms': frozenset(t for t in plan.terms if t[0] != 'time') })
+        ids = [q['id'] for q in ret]
+        stale = [row[0] for row in conn.execute('SELECT id FROM queries') if row[0] not in ids]
+        for qid in stale:
+            conn.execute('DELETE FROM sessions WHERE q = ?', (qid,))
+            conn.execute('DELETE FROM cursors WHERE q = ?', (qid,))
+            conn.execute('DELETE FROM queries WHERE id = ?', (qid,))
+        conn.commit()
+        return ret
+
+    # start
+    # Start the background thread syncing every sync_interval seconds
+    def start(self):
+        if self.thread is None and self.queries:
+            self.thread = threading.Thread(target=self.run, name='NWSessionStore', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sync()
+            self.stopped.wait(float(self.settings['sync_interval']))
+
+    def shutdown(self):
+        self.stopped.set()
+
+    # sync
+    # Sync every configured query, then evict. Returns False without doing anything when a sync is already running in this or another process.
+    def sync(self):
+        if not self.syncLock.acquire(blocking=False):
+            return False
+        try:
+            with open(self.path + '.lock', 'a+b') as f:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return False
+                for entry in self.queries:
+                    try:
+                        self.syncQuery(entry)
+                    except Exception as e:
+                        with self.lock:
+                            self.counters['sync_errors'] += 1
+                        print('NWSessionStore::sync() ' + entry['query'] + ' Exception => ' + str(e) + '\n')
+                self.evict()
+            return True
+        finally:
+            self.syncLock.release()
+
+    # syncQuery
+    # Fetch the sessions of a synced query whose meta arrived after each service's cursor. The first sync of a service walks the whole retention window. The watermark only advances once every service is synced.
+    def syncQuery(self, entry):
+        conn = self.connect()
+        started = time.time()
+        cursors = dict(conn.execute('SELECT service, meta_id FROM cursors WHERE q = ?', (entry['id'],)))
+        pageSize = int(self.settings['page_size'])
+        count = 0
+        for svc in self.handler.services:
+            mid2 = self.handler.metaIdBounds(svc['url'])[1]
+            last = cursors.get(svc['name'])
+            if last is not None and last > mid2:
+                # Meta ids went backwards: the service's database was reset
+                last = None
+            window = { 'id2': last or 0 }
+            batch = []
+            for group, session in self.handler.iterGroups(entry['query'] if last is not None else entry['initial'], pageSize, last + 1 if last is not None else 0, svc['url'], window, multi=True):
+                batch.append(self.row(entry['id'], svc['name'], group, session))
+                if len(batch) >= pageSize:
+                    conn.executemany(self.upsert, batch)
+                    conn.commit()
+                    count += len(batch)
+                    batch = []
+            conn.executemany(self.upsert, batch)
+            count += len(batch)
+            conn.execute('INSERT OR REPLACE INTO cursors (q, service, meta_id) VALUES (?, ?, ?)', (entry['id'], svc['name'], max(window['id2'], mid2)))
+            conn.commit()
+        conn.execute('UPDATE queries SET watermark = max(coalesce(watermark, 0), ?), synced = ? WHERE id = ?', (int(started) - int(self.settings['settle']), started, entry['id']))
+        conn.commit()
+        with self.lock:
+            self.counters['syncs'] += 1
+            self.counters['synced_sessions'] += count
+        METRICS.observe('nwapi_operation_seconds', time.time() - started, op='storeSync', cache='none')
+        if self.debug:
+            print('NWSessionStore::syncQuery(): ' + str(count) + ' sessions synced for ' + entry['query'])
+
+    # row
+    # Upsert parameters of a session: indexed columns (NULL for multi-valued keys, which are matched in the data), then the session as JSON
+    def row(self, qid, service, group, session):
+        values = [qid, service, group, self.timeValue(self.lastValue(session.get('time')))]
+        for key in self.columns:
+            value = session.get(key.replace('.', '_'))
+            values.append(value if isinstance(value, (str, int, float)) else None)
+        values.append(json.dumps(session))
+        return values
+
+    # lastValue
+    # Value of a meta key as queryNWDB() reports it: the last one when it has several
+    def lastValue(self, value):
+        return value[-1] if isinstance(value, list) else value
+
+    def timeValue(self, value):
+        if value is None or isinstance(value, (int, float)):
+            return value
+        try:
+            return parseTime(str(value))
+        except ValueError:
+            return None
+
+    # evict
+    # Drop sessions older than retention seconds, then the oldest tenth of the sessions until the store fits in max_bytes. Coverage windows start after the evicted sessions. Freed pages are reused rather than returned to the filesystem.
+    def evict(self):
+        conn = self.connect()
+        horizon = int(time.time()) - int(self.settings['retention'])
+        evicted = conn.execute('DELETE FROM sessions WHERE m_time < ?', (horizon,)).rowcount
+        conn.execute('UPDATE queries SET since = max(since, ?)', (horizon,))
+        conn.commit()
+        while self.usedBytes(conn) > int(self.settings['max_bytes']):
+            row = conn.execute('SELECT m_time FROM sessions WHERE m_time IS NOT NULL ORDER BY m_time LIMIT 1 OFFSET (SELECT count(*) / 10 FROM sessions)').fetchone()
+            if row is None:
+                break
+            evicted += conn.execute('DELETE FROM sessions WHERE m_time <= ?', (row[0],)).rowcount
+            conn.execute('UPDATE queries SET since = max(since, ?)', (row[0] + 1,))
+            conn.commit()
+        with self.lock:
+            self.counters['evicted_sessions'] += evicted
+
+    def usedBytes(self, conn):
+        pageSize, = conn.execute('PRAGMA page_size').fetchone()
+        pages, = conn.execute('PRAGMA page_count').fetchone()
+        free, = conn.execute('PRAGMA freelist_count').fetchone()
+        return pageSize * (pages - free)
+
+    # match
+    # Return the synced query covering a plan, or None
+    def match(self, plan):
+        rng = plan.time_range
+        if rng is None or rng[1] is None or plan.trailer:
+            return None
+        needed = set(plan.fields or ()) | plan.keys
+        terms = set(plan.terms)
+        windows = dict((row[0], row[1:]) for row in self.connect().execute('SELECT id, since, watermark FROM queries'))
+        for entry in self.queries:
+            since, watermark = windows.get(entry['id'], (None, None))
+            if watermark is None or rng[0] < since or rng[1] > watermark:
+                continue
+            if entry['fields'] is not None and (plan.fields is None or not needed <= entry['fields']):
+                continue
+            if entry['terms'] <= terms:
+                return entry
+        return None
+
+    # answer
+    # Answer a query from the store, or return None when it isn't covered by a synced query
+    # @param query Validated select query
+    # @param records Max number of sessions, None for all
+    # @param op Operation name for the latency metric
+    # @param raw Key sessions by meta key (as NWGenerate() does) instead of the sanitized names; needs an explicit select list
+    def answer(self, query, records=None, op='queryNWDB', raw=False):
+        if not self.queries:
+            return None
+        startTime = time.perf_counter()
+        plan = storePlan(query, self.indexed)
+        entry = self.match(plan) if plan is not None and (plan.fields or not raw) else None
+        if entry is None:
+            with self.lock:
+                self.counters['misses'] += 1
+            return None
+        multi = len(self.handler.services) > 1
+        sql = 'SELECT service, data FROM sessions WHERE q = ? AND ' + plan.sql + (' ORDER BY m_time, service, id' if multi else ' ORDER BY id')
+        params = [entry['id']] + list(plan.params)
+        if records:
+            sql += ' LIMIT ?'
+            params.append(int(records))
+        sessions = []
+        keys = [(f if raw else f.replace('.', '_'), f.replace('.', '_')) for f in plan.fields] if plan.fields else None
+        for service, data in self.connect().execute(sql, params):
+            session = json.loads(data)
+            if keys is not None:
+                session = dict((out, self.lastValue(session[key])) for out, key in keys if key in session)
+            else:
+                session = dict((key, self.lastValue(value)) for key, value in session.items())
+            if multi:
+                session['nw_service'] = service
+            sessions.append(session)
+        with self.lock:
+            self.counters['hits'] += 1
+        METRICS.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op=op, cache='store')
+        return sessions
+
+    # status
+    # Coverage window, last sync and session count of every synced query, as returned by the REST API
+    def status(self):
+        conn = self.connect()
+        ret = []
+        for entry in self.queries:
+            since, watermark, synced = conn.execute('SELECT since, watermark, synced FROM queries WHERE id = ?', (entry['id'],)).fetchone()
+            count, = conn.execute('SELECT count(*) FROM sessions WHERE q = ?', (entry['id'],)).fetchone()
+            ret.append({ 'query': entry['query'], 'since': since, 'watermark': watermark, 'synced': synced, 'sessions': count })
+        return ret
+
+    # stats
+    # Hit/miss, sync and eviction counters plus the store size and the age of the stalest watermark, for the metrics collector
+    def stats(self):
+        with self.lock:
+            ret = dict(self.counters)
+        conn = self.connect()
+        ret['bytes'] = self.usedBytes(conn)
+        oldest, = conn.execute('SELECT min(coalesce(watermark, 0)) FROM queries').fetchone()
+        if oldest is not None:
+            ret['staleness_seconds'] = int(time.time()) - oldest
+        return ret
@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWSingleFlight.py:
+
+  Request coalescing for NWHandler: concurrent identical calls share one upstream execution, across threads and optionally across processes on the same host.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import os
+import pickle
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from .NWMetrics import METRICS
+except ImportError:
+    from NWMetrics import METRICS
+
+# Defaults applied when the 'singleflight' section of nwhandler_config.yaml omits a setting
+SINGLEFLIGHT_DEFAULTS = {
+    'enabled': True,
+    'cross_process': False,
+    'lock_path': '',
+    'wait_timeout': 300,
+    'result_ttl': 60
+}
+
+
+class Flight:
+
+    __slots__ = ('done', 'value', 'error', 'followers', 'pickled')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.followers = 0
+        self.pickled = False
+
+
+class NWSingleFlight:
+
+    # Constructor
+    # * In process, the first caller for a key runs the call and later callers wait on its Event. With cross_process, the leaders of each process also serialize on an fcntl lock file per key; whoever runs the call leaves the pickled result next to the lock for the processes that waited on it.
+    # @param settings 'singleflight' section of nwhandler_config.yaml (may be None)
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, settings=None, debug=0):
+        self.settings = dict(SINGLEFLIGHT_DEFAULTS)
+        self.settings.update(settings or {})
+        self.debug = debug
+        self.enabled = bool(self.settings['enabled'])
+        self.cross_process = bool(self.settings['cross_process']) and fcntl is not None
+        self.wait_timeout = float(self.settings['wait_timeout'])
+        self.result_ttl = float(self.settings['result_ttl'])
+        self.lock_path = self.settings['lock_path'] or os.path.join(tempfile.gettempdir(), 'nwapi-singleflight')
+        if self.cross_process:
+            os.makedirs(self.lock_path, exist_ok=True)
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.last_sweep = 0.0
+
+    # do
+    # Run fn() once for all concurrent callers with the same key and return its result (or raise its exception) to each of them. Each caller gets its own copy: the leader keeps the object fn() returned and, when others waited, the result is pickled once and unpickled per follower, so mutating one caller's result never shows in another's.
+    # @param key Key identifying the request, e.g. NWQueryCache.key()
+    # @param fn Callable performing the upstream call
+    # @param store Optional callable handed a result that was computed by another process, e.g. to cache it locally as fn() would have
+    def do(self, key, fn, store=None):
+        if not self.enabled:
+            return fn()
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.followers += 1
+        if not leader:
+            METRICS.inc('nwapi_singleflight_total', role='follower')
+            if not flight.done.wait(self.wait_timeout):
+                raise TimeoutError('Timed out waiting for an identical in-flight request')
+            if flight.error is not None:
+                raise flight.error
+            return pickle.loads(flight.value) if flight.pickled else flight.value
+        METRICS.inc('nwapi_singleflight_total', role='leader')
+        try:
+            flight.value = self.acrossProcesses(key, fn, store) if self.cross_process else fn()
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            if flight.followers and flight.error is None:
+                self.share(flight)
+            flight.done.set()
+
+    # share
+    # Pickle a finished flight's value for its followers; a value that can't be pickled is handed over as is
+    def share(self, flight):
+        try:
+            flight.value = pickle.dumps(flight.value, pickle.HIGHEST_PROTOCOL)
+            flight.pickled = True
+        except Exception as e:
+            if self.debug:
+                print('NWSingleFlight::share() Exception => ' + str(e) + '\n')
+
+    # acrossProcesses
+    # Coalesce with other processes: take the key's lock file without blocking and run fn(), or, when another process holds it, wait for the lock and reuse the result it left behind. Falls back to running fn() when no fresh result is found (e.g. the other process failed).
+    def acrossProcesses(self, key, fn, store=None):
+        lockFile = os.path.join(self.lock_path, key + '.lock')
+        resultFile = os.path.join(self.lock_path, key + '.result')
+        waitStart = time.time()
+        with open(lockFile, 'a+b') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                METRICS.inc('nwapi_singleflight_total', role='process_follower')
+                self.waitLock(f)
+                found, value = self.readResult(resultFile, waitStart)
+                if found:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    if store is not None:
+                        store(value)
+                    return value
+            try:
+                value = fn()
+                self.writeResult(resultFile, value)
+                return value
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                self.sweep()
+
+    # waitLock
+    # Block until the lock file is free, giving up after wait_timeout seconds
+    def waitLock(self, f):
+        deadline = time.time() + self.wait_timeout
+        delay = 0.005
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise TimeoutError('Timed out waiting for an identical in-flight request in another process')
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+    # readResult
+    # Load the result another process left for the key, provided it was written after since
+    def readResult(self, resultFile, since):
+        try:
+            if os.path.getmtime(resultFile) < since:
+                return (False, None)
+            with open(resultFile, 'rb') as f:
+                return (True, pickle.load(f))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return (False, None)
+
+    def writeResult(self, resultFile, value):
+        try:
+            tmp = resultFile + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, resultFile)
+        except Exception as e:
+            print('NWSingleFlight::writeResult() Exception => ' + str(e) + '\n')
+
+    # sweep
+    # Remove result files older than result_ttl, at most once per result_ttl. Lock files are left alone: removing one another process has open would let a third process lock a fresh file under the same name.
+    def sweep(self):
+        now = time.time()
+        if now - self.last_sweep < self.result_ttl:
+            return
+        self.last_sweep = now
+        for entry in os.scandir(self.lock_path):
+            try:
+                if entry.name.endswith('.result') and entry.stat().st_mtime < now - self.result_ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
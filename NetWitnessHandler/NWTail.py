@@ -0,0 +1,233 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWTail.py:
+
+  Continuous queries for the REST app: one background poller per distinct query follows NWDB with NWHandler.tail() and pushes new sessions to every subscriber as Server-Sent Events.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+try:
+    from .NWQuery import canonicalQuery
+except ImportError:
+    from NWQuery import canonicalQuery
+
+# Defaults applied when the 'tail' section of nwhandler_config.yaml omits a setting
+TAIL_DEFAULTS = {
+    'interval': 5,
+    'page_size': 1000,
+    'max_pollers': 50,
+    'idle_timeout': 30,
+    'backlog': 100,
+    'queue_size': 1000,
+    'heartbeat': 15,
+    'max_lag': 0
+}
+
+
+class NWTailLimitError(RuntimeError):
+    pass
+
+
+# sseEvent
+# Format one Server-Sent Event
+# @param event Event name
+# @param data Event data, a single line
+# @param event_id Optional event id, sent back by clients as Last-Event-ID when they reconnect
+def sseEvent(event, data, event_id=None):
+    return ('id: ' + event_id + '\n' if event_id is not None else '') + 'event: ' + event + '\ndata: ' + data + '\n\n'
+
+
+# parseCursor
+# Decode a Last-Event-ID (the JSON { service: meta_id } cursor of an event), None when absent or malformed
+def parseCursor(event_id):
+    try:
+        cursor = json.loads(event_id) if event_id else None
+    except ValueError:
+        return None
+    if not isinstance(cursor, dict) or not all(isinstance(v, int) for v in cursor.values()):
+        return None
+    return cursor
+
+
+# isAfter
+# True when cursor a is past cursor b for some service
+def isAfter(a, b):
+    return any(value > b.get(name, -1) for name, value in a.items())
+
+
+class TailSubscription:
+
+    __slots__ = ('poller', 'events', 'closed')
+
+    def __init__(self, poller, size):
+        self.poller = poller
+        # Pre-formatted SSE events; bounded so a stalled client can't grow it without limit
+        self.events = queue.Queue(maxsize=size)
+        self.closed = False
+
+
+class TailPoller:
+
+    # Constructor
+    # @param manager NWTailManager owning the poller
+    # @param key Canonical query the poller is registered under
+    # @param query Validated query followed by the poller
+    # @param cursor Cursor to start from, None to start now
+    def __init__(self, manager, key, query, cursor=None):
+        self.manager = manager
+        self.key = key
+        self.query = query
+        self.cursor = cursor
+        self.subscribers = set()
+        # (cursor, event) of the last events sent, replayed to clients reconnecting with Last-Event-ID
+        self.backlog = deque(maxlen=int(manager.settings['backlog']))
+        self.idle_since = time.time()
+        self.polls = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='NWTail', daemon=True)
+
+    # run
+    # Poll NWDB every interval seconds and publish new sessions, until stopped or without subscribers for idle_timeout seconds
+    def run(self):
+        settings = self.manager.settings
+        while not self.stopped.is_set():
+            try:
+                result = self.manager.handler.tail(self.query, self.cursor, int(settings['page_size']), int(settings['max_lag']))
+                self.cursor = result['cursor']
+                self.polls += 1
+                if result['reset']:
+                    self.publish('reset', json.dumps({ 'services': result['reset'] }))
+                if result['sessions']:
+                    self.publish('sessions', json.dumps(result['sessions']))
+            except Exception as e:
+                if self.manager.debug:
+                    print('NWTailPoller::run() Exception => ' + str(e) + '\n')
+                self.publish('error', json.dumps({ 'error': str(e) }), False)
+            if self.manager.retire(self):
+                return
+            self.stopped.wait(float(settings['interval']))
+
+    # publish
+    # Serialize an event once and queue it for every subscriber. Subscribers whose queue is full are dropped; their stream ends with an overflow event and they can resume from their Last-Event-ID.
+    # @param event Event name
+    # @param data JSON event data
+    # @param keep Add the event to the replay backlog and tag it with the cursor as its id
+    def publish(self, event, data, keep=True):
+        cursor = dict(self.cursor or {})
+        message = sseEvent(event, data, json.dumps(cursor, sort_keys=True) if keep else None)
+        with self.manager.lock:
+            if keep:
+                self.backlog.append((cursor, message))
+            for sub in list(self.subscribers):
+                try:
+                    sub.events.put_nowait(message)
+                except queue.Full:
+                    sub.closed = True
+                    self.subscribers.discard(sub)
+                    if not self.subscribers:
+                        self.idle_since = time.time()
+
+
+class NWTailManager:
+
+    # Constructor
+    # * Pollers live in this process; with several Flask worker processes each worker runs its own poller per query
+    # @param handler NWHandler used to poll NWDB
+    # @param settings 'tail' section of nwhandler_config.yaml (may be None)
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, handler, settings=None, debug=0):
+        self.handler = handler
+        self.debug = debug
+        self.settings = dict(TAIL_DEFAULTS)
+        self.settings.update(settings or {})
+        # Canonical query -> TailPoller
+        self.pollers = {}
+        self.lock = threading.Lock()
+
+    # subscribe
+    # Subscribe to the new sessions of a query, sharing the query's poller with other subscribers. Raises NWQueryError for rejected queries and NWTailLimitError when max_pollers other queries are already followed.
+    # @param query Query to follow
+    # @param last_event_id Last-Event-ID of a reconnecting client: backlog events after it are replayed, and a new poller starts from it
+    def subscribe(self, query, last_event_id=None):
+        query, records = self.handler.checkQuery(query)
+        key = canonicalQuery(query)
+        since = parseCursor(last_event_id)
+        with self.lock:
+            poller = self.pollers.get(key)
+            start = poller is None
+            if start:
+                if len(self.pollers) >= int(self.settings['max_pollers']):
+                    raise NWTailLimitError('Too many continuous queries, try again later')
+                poller = self.pollers[key] = TailPoller(self, key, query, since)
+            sub = TailSubscription(poller, int(self.settings['queue_size']))
+            if since is not None:
+                replay = [message for cursor, message in poller.backlog if isAfter(cursor, since)]
+                for message in replay[-int(self.settings['queue_size']):]:
+                    sub.events.put_nowait(message)
+            poller.subscribers.add(sub)
+        if start:
+            poller.thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in sub.poller.subscribers:
+                sub.poller.subscribers.discard(sub)
+                if not sub.poller.subscribers:
+                    sub.poller.idle_since = time.time()
+
+    # retire
+    # Called by a poller after each poll: removes it when it has had no subscribers for idle_timeout seconds. Returns True when the poller should stop.
+    def retire(self, poller):
+        with self.lock:
+            if poller.subscribers or time.time() - poller.idle_since < float(self.settings['idle_timeout']):
+                return poller.stopped.is_set()
+            if self.pollers.get(poller.key) is poller:
+                del self.pollers[poller.key]
+            poller.stopped.set()
+            return True
+
+    # events
+    # Generator over a subscription's SSE stream: queued events, a comment every heartbeat seconds while idle (which also detects gone clients), and a final overflow event when the subscriber fell too far behind
+    def events(self, sub):
+        heartbeat = float(self.settings['heartbeat'])
+        try:
+            yield 'retry: ' + str(int(float(self.settings['interval']) * 1000)) + '\n\n'
+            while True:
+                try:
+                    yield sub.events.get(timeout=heartbeat)
+                except queue.Empty:
+                    if sub.closed or sub.poller.stopped.is_set():
+                        yield sseEvent('overflow' if sub.closed else 'end', '{}')
+                        return
+                    yield ': keepalive\n\n'
+        finally:
+            self.unsubscribe(sub)
+
+    # stats
+    # Number of followed queries, subscribers and polls, for the metrics collector
+    def stats(self):
+        with self.lock:
+            pollers = list(self.pollers.values())
+            return { 'pollers': len(pollers), 'subscribers': sum(len(p.subscribers) for p in pollers), 'polls': sum(p.polls for p in pollers) }
+
+    def shutdown(self):
+        with self.lock:
+            pollers = list(self.pollers.values())
+            self.pollers.clear()
+        for poller in pollers:
+            poller.stopped.set()
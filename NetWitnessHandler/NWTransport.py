@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  NWTransport.py:
+
+  Shared, pooled HTTP transport for all NWDB RESTful API calls.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.request import ACCEPT_ENCODING
+import urllib3
+try:
+    from .NWMetrics import METRICS, BYTES_BUCKETS
+except ImportError:
+    from NWMetrics import METRICS, BYTES_BUCKETS
+
+# Defaults applied when the 'transport' section of nwhandler_config.yaml omits a setting
+TRANSPORT_DEFAULTS = {
+    'pool_connections': 4,
+    'pool_maxsize': 16,
+    'pool_block': False,
+    'connect_timeout': 5.0,
+    'read_timeout': 300.0,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'status_forcelist': [500, 502, 503, 504],
+    'verify': False,
+    'hosts': {},
+    'accept_encoding': ['zstd', 'gzip', 'deflate']
+}
+
+# NWDB msg of the request in flight on this thread, used to label connect timings
+_inflight = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+    def connect(self):
+        startTime = time.perf_counter()
+        super().connect()
+        METRICS.phase(getattr(_inflight, 'msg', 'nwdb'), 'connect', time.perf_counter() - startTime)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+
+    def connect(self):
+        startTime = time.perf_counter()
+        super().connect()
+        METRICS.phase(getattr(_inflight, 'msg', 'nwdb'), 'connect', time.perf_counter() - startTime)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+
+    # init_poolmanager
+    # Build the pool manager with connection pools whose connections record connect time (TCP and TLS handshake)
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = { 'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool }
+
+
+class NWTransport:
+
+    # Process wide transports keyed by configuration, used where a transport can't be handed over (e.g. Spark executors)
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    # Constructor
+    # * Builds one keep-alive requests.Session with retrying connection pools for every NWDB host
+    # @param config Parsed nwhandler_config.yaml object
+    # @param debug Debug set to 1 will activate the debug print() statements
+    def __init__(self, config, debug=0):
+        self.debug = debug
+        self.settings = dict(TRANSPORT_DEFAULTS)
+        self.settings.update(config['netwitness'].get('transport') or {})
+        self.timeout = (float(self.settings['connect_timeout']), float(self.settings['read_timeout']))
+        self.verify = self.settings['verify']
+        if not self.verify:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(config['netwitness']['auth']['user'], config['netwitness']['auth']['pass'])
+        self.session.verify = self.verify
+        # Ask NWDB for a compressed body in the encodings urllib3 can decode here (zstd needs zstandard); bodies are decoded as they are read, streamed or not
+        self.session.headers['Accept-Encoding'] = acceptEncoding(self.settings['accept_encoding'])
+        self.adapters = []
+        self.session.mount('http://', self.buildAdapter(self.settings['pool_maxsize']))
+        self.session.mount('https://', self.buildAdapter(self.settings['pool_maxsize']))
+        # Per host pool sizes, e.g. hosts: { '10.0.0.5': 32 }
+        for host, maxsize in (self.settings['hosts'] or {}).items():
+            self.session.mount('http://' + str(host) + ':', self.buildAdapter(maxsize))
+            self.session.mount('https://' + str(host) + ':', self.buildAdapter(maxsize))
+
+        self.lock = threading.Lock()
+        self.counters = { 'requests': 0, 'errors': 0, 'latency_total': 0.0, 'latency_max': 0.0 }
+
+    # shared
+    # Return the transport shared by every caller in this process for the given config, building it on first use
+    # @param config Parsed nwhandler_config.yaml object
+    @classmethod
+    def shared(cls, config):
+        key = repr(sorted((k, repr(v)) for k, v in config['netwitness'].items()))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(config)
+            return cls._shared[key]
+
+    # buildAdapter
+    # Create a mounted HTTPAdapter holding keep-alive pools of maxsize connections per host, retrying connection resets and 5xx with exponential backoff
+    # @param maxsize Max number of pooled connections kept per host
+    def buildAdapter(self, maxsize):
+        retry = Retry(
+            total=int(self.settings['retries']),
+            connect=int(self.settings['retries']),
+            read=int(self.settings['retries']),
+            status=int(self.settings['retries']),
+            backoff_factor=float(self.settings['backoff_factor']),
+            status_forcelist=self.settings['status_forcelist'],
+            allowed_methods=frozenset(['GET', 'POST']),
+            raise_on_status=False
+        )
+        adapter = TimedHTTPAdapter(pool_connections=int(self.settings['pool_connections']), pool_maxsize=int(maxsize), max_retries=retry, pool_block=bool(self.settings['pool_block']))
+        self.adapters.append(adapter)
+        return adapter
+
+    # request
+    # Issue a request through the pooled session, recording latency. Time to the response headers is recorded as the first_byte phase and, unless stream is set, the body transfer as download; streamed bodies are timed by their reader.
+    # @param verb HTTP verb, 'get' or 'post'
+    # @param url NWDB service URL
+    # @param params Query string arguments
+    # @param stream Defer downloading the body until it is iterated
+    # @param op Metric label for requests without a msg parameter, e.g. 'packets'
+    def request(self, verb, url, params=None, stream=False, op=None, **kwargs):
+        msg = str((params.get('msg') if params else None) or op or 'nwdb')
+        _inflight.msg = msg
+        startTime = time.perf_counter()
+        try:
+            response = self.session.request(verb.upper(), url, params=params, stream=stream, timeout=kwargs.pop('timeout', self.timeout), **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.counters['errors'] += 1
+            METRICS.inc('nwapi_nwdb_errors_total', msg=msg, host=urlsplit(url).netloc)
+            raise
+        elapsed = time.perf_counter() - startTime
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['latency_total'] += elapsed
+            self.counters['latency_max'] = max(self.counters['latency_max'], elapsed)
+        firstByte = min(response.elapsed.total_seconds(), elapsed)
+        METRICS.phase(msg, 'first_byte', firstByte)
+        if not stream:
+            METRICS.phase(msg, 'download', elapsed - firstByte)
+            METRICS.observe('nwapi_nwdb_response_bytes', len(response.content), BYTES_BUCKETS, msg=msg)
+            METRICS.observe('nwapi_nwdb_wire_bytes', wireBytes(response), BYTES_BUCKETS, msg=msg, encoding=response.headers.get('Content-Encoding', 'identity'))
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('get', url, params, **kwargs)
+
+    def post(self, url, params=None, **kwargs):
+        return self.request('post', url, params, **kwargs)
+
+    # stats
+    # Return request, latency and connection reuse counters. Connections are counted from the urllib3 pools, so reused = requests - connections opened.
+    def stats(self):
+        connections = 0
+        pools = 0
+        for adapter in self.adapters:
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    pools += 1
+                    connections += pool.num_connections
+        with self.lock:
+            ret = dict(self.counters)
+        ret['pools'] = pools
+        ret['connections'] = connections
+        ret['reused'] = max(ret['requests'] - connections, 0)
+        ret['latency_avg'] = ret['latency_total'] / ret['requests'] if ret['requests'] else 0.0
+        return ret
+
+    def close(self):
+        self.session.close()
+
+
+# acceptEncoding
+# Accept-Encoding header value for the wanted encodings urllib3 is able to decode, 'identity' when there are none
+# @param wanted Encodings in preference order
+def acceptEncoding(wanted):
+    supported = set(ACCEPT_ENCODING.split(','))
+    return ','.join(e for e in wanted or [] if e in supported) or 'identity'
+
+
+# wireBytes
+# Bytes of a response body as received on the wire, i.e. before content decoding, once the body has been read
+def wireBytes(response):
+    try:
+        return response.raw.tell()
+    except (AttributeError, OSError):
+        return len(response.content)
@@ -17,14 +17,91 @@ __status__ = "Development"
 
 # Handler Module for NetWitness Database Communication
 import json
-import requests
-from requests.auth import HTTPBasicAuth
 from collections import defaultdict
 import time
+import itertools
+import heapq
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
 import yaml
 import io
-import pyodbc
-import unicodecsv
+import os
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    from .NWTransport import NWTransport, wireBytes
+    from .NWResultTable import NWResultTable
+    from .NWQueryCache import NWQueryCache
+    from .NWQuery import canonicalQuery, validateQuery, isImmutable, parseQuery, replaceTimeRange, selectFields, parseTime, formatTime, NWQueryError, VALIDATION_DEFAULTS, META_KEY
+    from .NWExport import EXPORT_WRITERS, exportFormat
+    from .NWMetrics import METRICS, BYTES_BUCKETS, COUNT_BUCKETS
+    from .NWSingleFlight import NWSingleFlight
+    from .NWSessionStore import NWSessionStore
+    from .NWGraph import NWEdgeTable, GRAPH_DEFAULTS
+except ImportError:
+    from NWTransport import NWTransport, wireBytes
+    from NWResultTable import NWResultTable
+    from NWQueryCache import NWQueryCache
+    from NWQuery import canonicalQuery, validateQuery, isImmutable, parseQuery, replaceTimeRange, selectFields, parseTime, formatTime, NWQueryError, VALIDATION_DEFAULTS, META_KEY
+    from NWExport import EXPORT_WRITERS, exportFormat
+    from NWMetrics import METRICS, BYTES_BUCKETS, COUNT_BUCKETS
+    from NWSingleFlight import NWSingleFlight
+    from NWSessionStore import NWSessionStore
+    from NWGraph import NWEdgeTable, GRAPH_DEFAULTS
+
+# Assumed number of meta fields per session when sizing pages for 'select *' queries
+SELECT_ALL_FIELD_ESTIMATE = 32
+# Bytes read from the NWDB response per chunk when stream decoding
+STREAM_CHUNK_SIZE = 64 * 1024
+# ijson prefixes of the meta rows and the window's last meta id, for both the list and single object response shapes
+STREAM_FIELD_PREFIXES = ('item.results.fields.item', 'results.fields.item')
+STREAM_ID2_PREFIXES = ('item.results.id2', 'results.id2')
+# Defaults applied when the 'sharding' section of nwhandler_config.yaml omits a setting
+SHARDING_DEFAULTS = { 'shards': 4, 'max_workers': 4 }
+# Defaults applied when the 'distrib' section of nwhandler_config.yaml omits a setting
+DISTRIB_DEFAULTS = { 'timeout': 60, 'max_workers': 8 }
+# Defaults applied when the 'aggregate' section of nwhandler_config.yaml omits a setting
+AGGREGATE_DEFAULTS = { 'overfetch': 2, 'max_rounds': 3, 'max_workers': 16 }
+# Defaults applied when the 'timeline' section of nwhandler_config.yaml omits a setting
+TIMELINE_DEFAULTS = { 'target_buckets': 200, 'max_buckets': 1000, 'settle': 60, 'max_workers': 8 }
+# Bucket widths in seconds picked from by adaptive timelines; buckets are aligned to multiples of their width so they line up across refreshes
+TIMELINE_BUCKETS = (1, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400, 604800)
+# Closed buckets kept per (where, width, service) in the timeline cache entry
+TIMELINE_CACHED_BUCKETS = 10000
+# Service breakdown of the last distributed query run from the current context, see NWHandler.serviceReport()
+SERVICE_REPORT = contextvars.ContextVar('nwapi_service_report', default=None)
+
+
+class ChunkReader:
+
+  # Constructor
+  # * Minimal file-like wrapper over response.iter_content() so ijson can pull from it. Time spent waiting on the network and bytes received are tallied in download and bytes.
+  # @param chunks Iterator of bytes chunks
+  def __init__(self, chunks):
+      self.chunks = chunks
+      self.buffer = b''
+      self.download = 0.0
+      self.bytes = 0
+
+  def read(self, size=-1):
+      while not self.buffer:
+          startTime = time.perf_counter()
+          try:
+              self.buffer = next(self.chunks)
+          except StopIteration:
+              return b''
+          finally:
+              self.download += time.perf_counter() - startTime
+          self.bytes += len(self.buffer)
+      if size is None or size < 0:
+          size = len(self.buffer)
+      data = self.buffer[:size]
+      self.buffer = self.buffer[size:]
+      return data
+
 
 class NWHandler:
 
@@ -35,11 +112,48 @@ class NWHandler:
   def __init__(self, confloc, debug=0):
       self.config = self.readConfig(confloc)
       self.debug = debug
-      if self.config['netwitness']['settings']['ssl'] == 'enabled':
-          self.url = 'https://' + self.config['netwitness']['settings']['host'] + ':' + self.config['netwitness']['settings']['port'] + '/' + self.config['netwitness']['settings']['path']
-      else:
-          self.url = 'http://' + self.config['netwitness']['settings']['host'] + ':' + self.config['netwitness']['settings']['port'] + '/' + self.config['netwitness']['settings']['path']
+      self.url = self.serviceUrl(self.config['netwitness']['settings'])
+      # Services queried by distributed queries, defaults to the single service in settings
+      self.services = [{ 'name': str(svc.get('name') or svc['host']), 'url': self.serviceUrl(svc) } for svc in (self.config['netwitness'].get('services') or [])]
+      if not self.services:
+          self.services = [{ 'name': str(self.config['netwitness']['settings']['host']), 'url': self.url }]
+      self.distrib = dict(DISTRIB_DEFAULTS)
+      self.distrib.update(self.config['netwitness'].get('distrib') or {})
+      self.aggregate = dict(AGGREGATE_DEFAULTS)
+      self.aggregate.update(self.config['netwitness'].get('aggregate') or {})
+      self.timeline_settings = dict(TIMELINE_DEFAULTS)
+      self.timeline_settings.update(self.config['netwitness'].get('timeline') or {})
+      self.graph_settings = dict(GRAPH_DEFAULTS)
+      self.graph_settings.update(self.config['netwitness'].get('graph') or {})
+      self.transport = NWTransport(self.config, debug)
+      self.cache = NWQueryCache(self.config['netwitness'].get('cache'), debug)
+      # Concurrent identical calls share one upstream execution
+      self.flight = NWSingleFlight(self.config['netwitness'].get('singleflight'), debug)
+      self.sharding = dict(SHARDING_DEFAULTS)
+      self.sharding.update(self.config['netwitness'].get('sharding') or {})
+      # Query parser and cost policies applied before anything is sent to NWDB
+      self.validation = dict(VALIDATION_DEFAULTS)
+      self.validation.update(self.config['netwitness'].get('validation') or {})
+      # Incremental decode of NWDB responses, falls back to json.loads() when ijson isn't installed
+      self.stream_decode = ijson is not None and self.config['netwitness']['settings'].get('stream_decode', 'enabled') == 'enabled'
+      # Process wide metrics registry; cache and pool stats are only collected when metrics are rendered
+      self.metrics = METRICS
+      self.metrics.configure(self.config['netwitness'].get('metrics'))
+      self.metrics.collector('cache', self.cache.stats, handler=type(self).__name__)
+      self.metrics.collector('transport', self.transport.stats, handler=type(self).__name__)
+      # Optional local store answering queries covered by its synced hunt queries; syncing starts with store.start()
+      self.store = None
+      if (self.config['netwitness'].get('store') or {}).get('enabled'):
+        self.store = NWSessionStore(self, self.config['netwitness'].get('store'), debug)
+        self.metrics.collector('store', self.store.stats, handler=type(self).__name__)
    
+  # serviceUrl
+  # Build the NWDB RESTful API URL of a service from its host, port, path and ssl settings
+  # @param settings Dictionary with host, port, path and ssl keys (the 'settings' section or a 'services' entry)
+  def serviceUrl(self, settings):
+      scheme = 'https://' if settings.get('ssl', 'enabled') == 'enabled' else 'http://'
+      return scheme + str(settings['host']) + ':' + str(settings['port']) + '/' + str(settings.get('path', 'sdk'))
+
   # Read nwhandler_config.yaml config file and return parsed object
   # * Reads provided YAML config file and loads into parsed object to return
   # readConfig
@@ -72,198 +186,936 @@ class NWHandler:
           return unicode(obj).encode('latin-1')
 
     
+  # * Cache Function Section
+  # checkQuery
+  # Parse a query and apply the 'validation' cost policies (see NWQuery.validateQuery()). Returns (query, records) with the query as written (plus any injected time range) and capped records; raises NWQueryError when the query is malformed or too expensive.
+  # @param query Query, or WHERE clause when where_only is set
+  # @param records Records (or aggregate size) requested
+  # @param where_only The query is a bare WHERE clause
+  # @param fields Aggregated meta keys, also checked against allowed_fields
+  def checkQuery(self, query, records=None, where_only=False, fields=None):
+    return validateQuery(query, self.validation, records, where_only, fields)
+
+  # inputError
+  # Build the input error list returned by the query methods for a rejected query
+  # @param error NWQueryError raised by checkQuery()
+  def inputError(self, error):
+    return [{ 'error': str(error), 'type': 'input' }]
+
+  # cached
+  # Serve an operation from the query cache, calling fn() and caching its result on a miss. The key is the canonical query, the result shaping params and the target host; results for top level time ranges that ended more than cache.settle seconds ago never expire.
+  # Misses go through the single-flight group under the same key, so concurrent identical calls share one NWDB execution and one decoded result.
+  # @param op Operation name
+  # @param query Query or where clause the operation runs
+  # @param params Dictionary of result shaping parameters (records, size, field, ...)
+  # @param fn Callable producing the result on a miss
+  # @param cacheable Optional predicate on the result, False keeps it out of the cache (e.g. partial results)
+  def cached(self, op, query, params, fn, cacheable=None):
+    startTime = time.perf_counter()
+    key = self.cacheKey(op, query, params)
+    found, value = self.cache.get(key)
+    if found:
+      if self.debug:
+        print('NetWitnessHandler - NWHandler:cached(): cache hit for ' + op)
+      self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op=op, cache='hit')
+      return value
+    def store(result):
+      if cacheable is None or cacheable(result):
+        self.cache.put(key, result, isImmutable(query, settle=self.cache.settle))
+
+    def fill():
+      result = fn()
+      store(result)
+      return result
+
+    value = self.flight.do(key, fill, store)
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op=op, cache='miss')
+    return value
+
+  # cacheKey
+  # Cache (and single-flight) key of an operation: the canonical query, the result shaping params and the services it runs against
+  def cacheKey(self, op, query, params):
+    return self.cache.key(op, canonicalQuery(query), params, [svc['url'] for svc in self.services])
+
+  # cachedDistributed
+  # Run queryDistributed() through cached(), keeping partial results out of the cache, and record its service breakdown for serviceReport(). Returns the sessions.
+  # @param op Per-service operation, 'queryNWDB' or 'NWGenerate'
+  # @param query Query to send to NWDB
+  # @param params Dictionary of result shaping parameters
+  # @param records Max number of merged records to return
+  def cachedDistributed(self, op, query, params, records):
+    result = self.cached(op, query, params, lambda: self.queryDistributed(query, records, op=op), cacheable=lambda result: not result['partial'])
+    SERVICE_REPORT.set({ 'services': result['services'], 'partial': result['partial'] })
+    return result['sessions']
+
+  # serviceReport
+  # Service breakdown { 'services': { name: { 'status', 'latency', 'sessions', 'error' } }, 'partial': bool } of the last distributed queryNWDB()/NWGenerate() made from the current context (thread or request), None when there was none
+  # @param clear Reset it afterwards, e.g. at the start of a request on a reused thread
+  def serviceReport(self, clear=False):
+    report = SERVICE_REPORT.get()
+    if clear:
+      SERVICE_REPORT.set(None)
+    return report
+
   # * Single Query Function Section (Current/Common Use Case)
   # NWGenerate
-  # Execute NWDB query directly against NWDB and parse the results to group by group identifier (effectively session ID). Returns list of dictionaries containing requested session meta in form of metaKey: metaValue.
+  # Execute NWDB query directly against NWDB and parse the results to group by group identifier (effectively session ID). Returns list of dictionaries containing requested session meta in form of metaKey: metaValue. Queries covered by the local session store are answered from it.
   # @param query Query to execute against Netwitness NWDB directly
   def NWGenerate(self, query):
+      try:
+          query, records = self.checkQuery(query)
+      except NWQueryError as e:
+          return self.inputError(e)
+      local = self.store.answer(query, records, 'NWGenerate', raw=True) if self.store else None
+      if local is not None:
+          return local
+      if len(self.services) > 1:
+          return self.cachedDistributed('NWGenerate', query, {}, records or 1000)
+      return self.cached('NWGenerate', query, {}, lambda: self.generateFrom(query, self.url, records))
+
+  # generateFrom
+  # Run the NWGenerate() query against a single service
+  # @param query Query to execute against Netwitness NWDB directly
+  # @param url NWDB service URL
+  # @param records Max number of sessions, also bounding the meta NWDB returns; None for no limit
+  def generateFrom(self, query, url, records=None):
       queryArgs = { 'msg': 'query', 'query': query, 'force-content-type': 'application/json' }
-      nwResult = requests.get(self.url, params=queryArgs, auth=HTTPBasicAuth(self.config['netwitness']['auth']['user'], self.config['netwitness']['auth']['pass']), verify=False).json()
+      if records:
+          queryArgs['size'] = self.metaPageSize(query, records)
+      response = self.transport.get(url, params=queryArgs)
+      with self.metrics.timer('query', 'decode'):
+        nwResult = response.json()
+      with self.metrics.timer('query', 'pivot'):
+        sessions = self.processNWGenerate(nwResult)
+      return sessions[:records] if records else sessions
+
+  # processNWGenerate
+  # Group the per-metavalue NWDB results returned to NWGenerate() by group identifier
+  # @param nwResult JSON marshalled NWDB query results
+  def processNWGenerate(self, nwResult):
       resultParsed = []
-      recordDict = {}
-      cur_group = 0
+      recordDict = None
+      cur_group = None
       if isinstance(nwResult, dict):
           nwResult = [nwResult]
 
       for result in nwResult:
           for fields in result['results']['fields']:
-              if cur_group == 0:
-                  cur_group = fields['group']
-                  recordDict[fields['type']] = fields['value']
-              elif cur_group == fields['group']:
-                  recordDict[fields['type']] = fields['value']
-              else:
+              if recordDict is None or cur_group != fields['group']:
                   cur_group = fields['group']
-                  resultParsed.append(recordDict.copy())
-                  recordDict[fields['type']] = fields['value']
+                  recordDict = {}
+                  resultParsed.append(recordDict)
+              recordDict[fields['type']] = fields['value']
 
       if self.debug:
          print(f"NWGenerate: resultParsed length = {str(len(resultParsed))}")
          print(f"NWGenerate: resultParsed type = {str(type(resultParsed))}")
 
       return resultParsed
-  
+
   # processNetwitnessMeta
+  # Convert NWDB per-metavalue results into per-session records with the keys queryNWDB() uses, appending at most page_size sessions to sessions. The pivot is the pageFields()/pivotRows() one iterGroups() runs for every page.
   # @param meta JSON marshalled Netwitness HTTP API results in per-metavalue record format
-  # @param sessions sessions Empty list for storing processed session/event records, using Python's default pass-by-reference as to not unnecessarily duplicate data in memory
-  # @param page_size Page size requested by user. Actual size of returned Netwitness results are page_size * (len(requested_field_list) + 3), as Netwitness counts per-metavalue in its pagination
+  # @param sessions List the processed session records are appended to
+  # @param page_size Max number of sessions to append
   def processNetwitnessMeta(self, meta, sessions, page_size=1000):
-    """processNetwitnessMeta - Method to convert the Netwitness HTTP API results of per-metavalue records to a per-session/per-event record in keeping with the session/event abstraction
-    
-    Arguments:
-        meta {dict} -- JSON marshalled Netwitness HTTP API results in per-metavalue record format
-        sessions {list} -- Empty list for storing processed session/event records, using Python's default pass-by-reference as to not unnecessarily duplicate data in memory
-        page_size {int} -- Page size requested by user. Actual size of returned Netwitness results are page_size * (len(requested_field_list) + 3), as Netwitness counts per-metavalue in its pagination
-    
-    Returns:
-        none -- Resulting data is stored in sessions list of calling function via pass-by-reference of that argument
-    """
-    if self.debug:
-      print('NetWitnessHandler - NWHandler:processNetwitnessMeta(): meta type: ' + str(type(meta)) + ', length: ' + str(len(meta)) + ', beginning record processing...')
-      startTime = time.time()
-      print(meta)
+    if isinstance(meta, dict):
+      meta = [meta]
+    state = {}
+    completed = self.pivotRows(self.pageFields(meta, {}), state)
+    if state.get('group') is not None:
+      completed.append((state['group'], state['session']))
+    sessions.extend(session for group, session in completed[:page_size])
+
+  # * Paginated Query Function Section
+  # sessionWindow
+  # Number of sessions per NWDB window for a query capped at records: page_size (default records, or 1000) never exceeds the cap, so NWDB is not asked for meta past the sessions that will be returned
+  # @param records Max number of sessions wanted, None for all
+  # @param page_size Optional number of sessions per NWDB window
+  def sessionWindow(self, records, page_size=None):
+    size = page_size or records or 1000
+    return min(size, records) if records else size
+
+  # metaPageSize
+  # Translate a session page size into the per-metavalue size NWDB paginates on. NWDB counts every meta value returned, so a page of page_size sessions is roughly page_size * (len(requested_field_list) + 3) meta items.
+  # @param query Query to execute against NWDB, used to count the requested fields in the select clause
+  # @param page_size Number of sessions wanted per page
+  def metaPageSize(self, query, page_size):
+    fields = selectFields(query)
+    field_count = len(fields) if fields else SELECT_ALL_FIELD_ESTIMATE
+    return page_size * (field_count + 3)
+
+  # fetchMetaPage
+  # Fetch a single window of meta from NWDB starting at meta id id1 and return the JSON marshalled response as a list of result records
+  # @param query Query to send to NWDB
+  # @param id1 First meta id of the window
+  # @param size Max number of meta values NWDB should return for this window
+  # @param url NWDB service URL, defaults to the configured service
+  def fetchMetaPage(self, query, id1=0, size=0, url=None):
+    query_args = { 'msg': 'query', 'query': query, 'id1': id1, 'id2': 0, 'size': size, 'force-content-type': 'application/json' }
+    response = self.transport.get(url or self.url, params=query_args)
+    with self.metrics.timer('query', 'decode'):
+      meta = json.loads(response.text)
+    if type(meta) == dict:
+      meta = [meta]
+    self.metrics.observe('nwapi_nwdb_meta_rows', sum(len(rec['results'].get('fields', [])) for rec in meta if 'results' in rec), COUNT_BUCKETS, msg='query')
+    return meta
+
+  # pageFields
+  # Generator over the per-metavalue rows of a fetched page. The last meta id covered by the page is stored in cursor['id2'] so the caller can start the next window after it.
+  # @param meta JSON marshalled NWDB results as returned by fetchMetaPage()
+  # @param cursor Dictionary updated in place with the last meta id seen
+  def pageFields(self, meta, cursor):
+    for rec in meta:
+      if 'results' not in rec:
+        continue
+      row = None
+      for row in rec['results'].get('fields', []):
+        yield row
+      last_id = rec['results'].get('id2') or (row['id2'] if row else 0)
+      if last_id:
+        cursor['id2'] = max(cursor.get('id2', 0), int(last_id))
+
+  # streamFields
+  # Generator over the per-metavalue rows of a streamed NWDB response, decoded incrementally with ijson so only the current row is materialized. Updates cursor['id2'] like pageFields().
+  # Network waits are recorded as the download phase; the rest is recorded as decode, which here includes the pivot consuming the rows since the two run interleaved.
+  # @param response requests response opened with stream=True
+  # @param cursor Dictionary updated in place with the last meta id seen
+  def streamFields(self, response, cursor):
+    builder = None
+    last_id = 0
+    rows = 0
+    reader = ChunkReader(response.iter_content(STREAM_CHUNK_SIZE))
+    startTime = time.perf_counter()
     try:
-      d = {}
-      rec_count = 0
-      i = 0
-      current_group = 'NOT_SET'
-      window_start_meta_id =  0
-      window_end_meta_id = 0
-
-      ## Process each disparate meta field result into coherent session
-      for rec in meta:
-        i += 1
-        if self.debug:
-          if i == len(meta):
-            sessions.append(d)
-            window_end_meta_id = row['id2']
-            print("End Meta ID: " + str(row['id2']))
-            return
-
-        if 'results' in rec:
-          #print(group)
-          for row in rec['results']['fields']:
-            if rec_count == page_size:
-              if self.debug:
-                print("NetWitnessHandler - NWHandler:processNetwitnessMeta(): End Meta for Window Tracking: "+ str(window_end_meta_id))
-                endTime = time.time()
-                print('NetWitnessHandler - NWHandler:processNetwitnessMeta(): Processing time: ' + str(endTime - startTime))
-              return
-            group = str(row['group'])
-
-            ## Initial condition (first session processing starts)
-            if current_group == 'NOT_SET':
-              current_group = group
-              d = {}
-              window_start_meta_id = row['id1']
-              if self.debug:
-                print("First Meta ID" + str(row['id1']))
-              fixedVal = str(row['type']).replace('.', '_')
-              d[fixedVal] = row['value']
-            ## Intermediate condition (continue processing current session)
-            elif (current_group == group):
-              fixedVal = str(row['type']).replace('.', '_')
-              d[fixedVal] = row['value']
-             
-            ## End condition (store processed session, create new empty session, inc session counter (rec_count), begin processing new session)
-            else:
-              current_group = group
-              sessions.append(d)
-              window_end_meta_id = row['id2']
-              rec_count += 1
-              d = {}
-              fixedVal = str(row['type']).replace('.', '_')
-              d[fixedVal] = row['value']
-
-    except Exception as e:
-      print(e)
+      for prefix, event, value in ijson.parse(reader, use_float=True):
+        if builder is not None:
+          builder.event(event, value)
+          if event == 'end_map' and prefix in STREAM_FIELD_PREFIXES:
+            row = builder.value
+            builder = None
+            last_id = row.get('id2', last_id)
+            rows += 1
+            yield row
+        elif event == 'start_map' and prefix in STREAM_FIELD_PREFIXES:
+          builder = ijson.ObjectBuilder()
+          builder.event(event, value)
+        elif event == 'number' and prefix in STREAM_ID2_PREFIXES and value:
+          last_id = max(last_id, int(value))
+          cursor['id2'] = max(cursor.get('id2', 0), int(value))
+    finally:
+      response.close()
+      self.metrics.phase('query', 'download', reader.download)
+      self.metrics.phase('query', 'decode', time.perf_counter() - startTime - reader.download)
+      self.metrics.observe('nwapi_nwdb_response_bytes', reader.bytes, BYTES_BUCKETS, msg='query')
+      self.metrics.observe('nwapi_nwdb_wire_bytes', wireBytes(response), BYTES_BUCKETS, msg='query', encoding=response.headers.get('Content-Encoding', 'identity'))
+      self.metrics.observe('nwapi_nwdb_meta_rows', rows, COUNT_BUCKETS, msg='query')
+    if last_id:
+      cursor['id2'] = max(cursor.get('id2', 0), int(last_id))
+
+  # fetchMetaRows
+  # Fetch a window of meta from NWDB and return an iterator over its rows, stream decoded when available
+  # @param query Query to send to NWDB
+  # @param id1 First meta id of the window
+  # @param size Max number of meta values NWDB should return for this window
+  # @param url NWDB service URL, defaults to the configured service
+  # @param cursor Dictionary updated in place with the last meta id seen
+  def fetchMetaRows(self, query, id1, size, url, cursor):
+    if not self.stream_decode:
+      return self.pageFields(self.fetchMetaPage(query, id1, size, url), cursor)
+    query_args = { 'msg': 'query', 'query': query, 'id1': id1, 'id2': 0, 'size': size, 'force-content-type': 'application/json' }
+    response = self.transport.get(url or self.url, params=query_args, stream=True)
+    return self.streamFields(response, cursor)
 
+  # pivotRows
+  # Fold per-metavalue rows into sessions. The session being built is kept in state between calls so a session can continue across pages; sessions completed by these rows are returned as (group, session) tuples.
+  # A meta key with several values in a session keeps its last value, unless state['multi'] is set, in which case the values are collected in a list.
+  # @param rows Iterable of NWDB meta rows (dicts with group, type and value)
+  # @param state Dictionary holding the in-progress 'group', the meta id it 'start'ed at and its 'session' between calls, plus the number of 'rows' folded by the last call
+  def pivotRows(self, rows, state):
+    completed = []
+    current_group = state.get('group')
+    d = state.get('session', {})
+    multi = state.get('multi', False)
+    count = 0
+    for row in rows:
+      count += 1
+      group = row['group']
+      if group != current_group:
+        if current_group is not None:
+          completed.append((current_group, d))
+        current_group = group
+        state['start'] = row.get('id1')
+        d = {}
+      key = str(row['type']).replace('.', '_')
+      if multi and key in d:
+        if not isinstance(d[key], list):
+          d[key] = [d[key]]
+        d[key].append(row['value'])
+      else:
+        d[key] = row['value']
+    state['group'] = current_group
+    state['session'] = d
+    state['rows'] = count
+    return completed
+
+  # iterGroups
+  # Walk NWDB in meta id windows of metaPageSize(query, page_size) meta values and yield (group, session) tuples as each session completes. A session whose meta straddles a window boundary is held back until the next window finishes it, so only a single page is ever held in memory.
+  # @param query Query to send to NWDB
+  # @param page_size Number of sessions to request per window
+  # @param id1 Meta id to start from (0 starts at the beginning of the database)
+  # @param url NWDB service URL, defaults to the configured service
+  # @param cursor Optional dictionary updated in place with the last meta id consumed ('id2')
+  # @param multi Collect the values of multi-valued meta keys in lists instead of keeping the last one
+  # @param hold Don't yield the last session, whose meta may still be arriving; the cursor is left just before its first meta id so the next walk reads it whole
+  def iterGroups(self, query, page_size=1000, id1=0, url=None, cursor=None, multi=False, hold=False):
+    if cursor is None:
+      cursor = {}
+    cursor.setdefault('id2', id1 - 1 if id1 else 0)
+    size = self.metaPageSize(query, page_size)
+    state = { 'multi': multi }
+    while True:
+      last_id = cursor['id2']
+      rows = self.fetchMetaRows(query, id1, size, url, cursor)
+      startTime = time.perf_counter()
+      completed = self.pivotRows(rows, state)
+      if not self.stream_decode:
+        self.metrics.phase('query', 'pivot', time.perf_counter() - startTime)
+      for item in completed:
+        yield item
+      if not state['rows'] or cursor['id2'] <= last_id:
+        break
+      id1 = cursor['id2'] + 1
+    if state.get('group') is not None:
+      if hold and state.get('start'):
+        cursor['id2'] = state['start'] - 1
+      else:
+        yield (state['group'], state['session'])
+
+  # iter_sessions
+  # Generator API over a query's results, yielding completed session dictionaries page by page as they arrive from NWDB
+  # @param query Query to send to NWDB
+  # @param page_size Number of sessions to request from NWDB per meta id window
+  def iter_sessions(self, query, page_size=1000):
+    for group, session in self.iterGroups(query, page_size):
+      yield session
+
+  # iterServiceSessions
+  # Walk every configured service in turn with iterGroups() and yield its completed sessions, tagged with the 'nw_service' they came from when more than one service is configured (as queryDistributed() does). Services are read one after another, not interleaved.
+  # @param query Query to send to NWDB
+  # @param page_size Number of sessions to request from NWDB per meta id window
+  # @param cursors Optional dictionary of service name -> { 'id2': last meta id consumed }, updated in place; a service resumes after the meta id its cursor holds
+  def iterServiceSessions(self, query, page_size=1000, cursors=None):
+    tag = len(self.services) > 1
+    for svc in self.services:
+      cursor = cursors.setdefault(svc['name'], {}) if cursors is not None else None
+      id1 = cursor['id2'] + 1 if cursor and cursor.get('id2') else 0
+      for group, session in self.iterGroups(query, page_size, id1, svc['url'], cursor):
+        if tag:
+          session['nw_service'] = svc['name']
+        yield session
+
+  # metaIdBounds
+  # Ask NWDB for the first and last meta id in the database (msg=summary mid1/mid2)
+  # @param url NWDB service URL, defaults to the configured service
+  def metaIdBounds(self, url=None):
+    res = self.transport.get(url or self.url, params={ 'msg': 'summary', 'flags': 0, 'force-content-type': 'application/json' }).json()
+    summary = {}
+    if isinstance(res, dict) and isinstance(res.get('params'), dict):
+      summary.update(res['params'])
+    if isinstance(res, dict) and isinstance(res.get('string'), str):
+      for pair in res['string'].split():
+        if '=' in pair:
+          key, value = pair.split('=', 1)
+          summary[key] = value
+    return (int(summary['mid1']), int(summary['mid2']))
+
+  # tail
+  # Continuous query: return the sessions matching query whose meta arrived after cursor, and the cursor to pass to the next call. The cursor holds the last meta id consumed per service, so each call only fetches newer meta. The last session of each service is held back (see iterGroups() hold) and returned whole by the call after the one that sees a later session, so a session still being ingested is never returned twice. Services missing from the cursor start at their current last meta id, i.e. from now. Raises NWQueryError for rejected queries.
+  # Returns { 'sessions': [...], 'cursor': { service: meta_id }, 'reset': [service, ...] }
+  # @param query Query to send to NWDB
+  # @param cursor Cursor returned by the previous call, None to start now
+  # @param page_size Number of sessions per NWDB window
+  # @param max_lag Max meta ids a service's cursor may be behind before it is reset to now (listed in 'reset'), 0 for no limit
+  def tail(self, query, cursor=None, page_size=1000, max_lag=0):
+    query, records = self.checkQuery(query)
+    startTime = time.perf_counter()
+    cursor = dict(cursor or {})
+    sessions = []
+    reset = []
+    for svc in self.services:
+      last = cursor.get(svc['name'])
+      if last is None or max_lag:
+        mid2 = self.metaIdBounds(svc['url'])[1]
+        if last is None or mid2 - int(last) > int(max_lag):
+          if last is not None:
+            reset.append(svc['name'])
+          cursor[svc['name']] = mid2
+          continue
+      window = { 'id2': int(last) }
+      for group, session in self.iterGroups(query, page_size, int(last) + 1, svc['url'], window, hold=True):
+        if len(self.services) > 1:
+          session['nw_service'] = svc['name']
+        sessions.append(session)
+      cursor[svc['name']] = window['id2']
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op='tail', cache='none')
+    return { 'sessions': sessions, 'cursor': cursor, 'reset': reset }
+
+  # queryNWDBTable
+  # Columnar alternative to queryNWDB(). Meta rows are pivoted straight into an NWResultTable (sparse per-field buffers keyed by interned column names, with multi-value support) instead of one dictionary per session; use iter_dicts(), to_numpy() or to_arrow() on the result. A rejected query returns the same input error list as queryNWDB().
+  # @param query Query to send to NWDB
+  # @param records Max number of sessions to return, None for all (up to validation.max_records when set)
+  # @param page_size Number of sessions per NWDB window, at most records
+  def queryNWDBTable(self, query, records=None, page_size=1000):
+    if not query:
+      return NWResultTable(records)
+    try:
+      query, records = self.checkQuery(query, records)
+    except NWQueryError as e:
+      return self.inputError(e)
+    table = NWResultTable(records)
+    cursor = { 'id2': 0 }
+    id1 = 0
+    size = self.metaPageSize(query, self.sessionWindow(records, page_size))
+    opStart = time.perf_counter()
+    while True:
+      last_id = cursor['id2']
+      before = table.meta_count
+      rows = self.fetchMetaRows(query, id1, size, None, cursor)
+      startTime = time.perf_counter()
+      more = table.extend(rows)
+      if not self.stream_decode:
+        self.metrics.phase('query', 'pivot', time.perf_counter() - startTime)
+      if not more or table.meta_count == before or cursor['id2'] <= last_id:
+        break
+      id1 = cursor['id2'] + 1
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - opStart, op='queryNWDBTable', cache='none')
+    return table
 
   # queryNWDB
-  # Method to query NWDB directly. This method doesn't parse the data returned from NWDB to expected JSON itself, it passes to the processNetwitnessMeta() method to do the parsing.
+  # Method to query NWDB directly. Sessions are pulled through iter_sessions() in meta id windows sized to the number of records requested, so NWDB is never asked for more meta than needed to build them. Queries covered by the local session store are answered from it.
   # @param query Query to send to NWDB
-  # @param records Max number of records to return. This references the full parsed session records, the actual max records returned by NWDB is unconstrained, so will actually pull back more data from NWDB that will return.
-  def queryNWDB(self, query, records=1000):
+  # @param records Max number of records to return. This references the full parsed session records, which are paged from NWDB in windows of at most records sessions.
+  # @param page_size Optional number of sessions per NWDB window (defaults to records, never more)
+  def queryNWDB(self, query, records=1000, page_size=None):
     # Example query: 'select sessionid, event.time, alias.host, user.src, directory.src, filename.src, param.src, action, directory.dst, filename.dst, param.dst, checksum.src, checksum.dst where device.type="nwendpoint" && action exists '
     if self.debug:
        print(query)
-    if not query:
-      ret = []
-      error = { 'error': 'No query provided', 'type': 'input' }
-      ret.append(error)
-      return ret
+    try:
+      query, records = self.checkQuery(query, records)
+    except NWQueryError as e:
+      return self.inputError(e)
 
-    if self.debug:
-      print(query)
-    query_args = { 'msg': 'query', 'query': query, 'id1': 0, 'id2': 0, 'force-content-type': 'application/json' }
-    if self.debug:
-      print(query_args)
-    startTime = time.time()
-    if self.debug:
-       print(self.url)
-    response = requests.get( self.url, params=query_args, auth=HTTPBasicAuth(self.config['netwitness']['auth']['user'], self.config['netwitness']['auth']['pass']), verify=False)
-    endTime = time.time()
-    if self.debug:
-      print('NetWitnessHandler - NWHandler:queryNWDB(): nwdb query completed in: ' + str(endTime - startTime))
-    
-    sessions = []
-    startTime = time.time()
-    meta = json.loads(response.text)
-    endTime = time.time()
-    if self.debug:
-        print('NetWitnessHandler - NWHandler:queryNWDB(): results loaded in: ' + str(endTime - startTime))
-    if type(meta) == dict:
-      if self.debug:
-        print('NetWitnessHandler - NWHandler:queryNWDB(): Response from nwdb is of type: ' + str(type(meta)) + ', inserting to list for some consistency...')
-      data = []
-      data.append(meta)
-      self.processNetwitnessMeta(data, sessions, records)
-    elif type(meta) == list:
-      if self.debug:
-        print('NetWitnessHandler - NWHandler:queryNWDB(): Response from nwdb is of type: ' + str(type(meta)) + ', sending along...')
-      self.processNetwitnessMeta(meta, sessions, records)
+    local = self.store.answer(query, records) if self.store else None
+    if local is not None:
+      return local
+    if len(self.services) > 1:
+      sessions = self.cachedDistributed('queryNWDB', query, { 'records': records }, records)
+    else:
+      sessions = self.cached('queryNWDB', query, { 'records': records }, lambda: list(itertools.islice(self.iter_sessions(query, self.sessionWindow(records, page_size)), records)))
 
     return sessions
-    
+
+
+  # * Export Function Section
+  # selectColumns
+  # Return the sanitized session keys of the query's select list, or None for 'select *'
+  # @param query Query to send to NWDB
+  def selectColumns(self, query):
+    fields = selectFields(query)
+    return [f.replace('.', '_') for f in fields] if fields else None
+
+  # export
+  # Stream a query's sessions to a Parquet, CSV or NDJSON file in fixed size batches, so memory stays constant regardless of the result size. Parquet gets one row group per batch; CSV and NDJSON can be gzip or zstd compressed. With several services configured every service is exported in turn (see iterServiceSessions()) and the file gets an nw_service column. Returns the number of sessions written.
+  # @param query Query to send to NWDB
+  # @param path Output file path
+  # @param format 'parquet', 'csv' or 'ndjson', inferred from path when None
+  # @param compression 'gzip' or 'zstd' for CSV/NDJSON, a Parquet codec for Parquet
+  # @param batch_size Sessions per written batch and per NWDB window (smaller windows when records is smaller)
+  # @param records Max number of sessions to export, None for all (up to validation.max_records when set)
+  def export(self, query, path, format=None, compression=None, batch_size=10000, records=None):
+    query, records = self.checkQuery(query, records)
+    columns = self.selectColumns(query)
+    if columns and len(self.services) > 1:
+      columns.append('nw_service')
+    writer = EXPORT_WRITERS[exportFormat(path, format)](path, columns, compression)
+    written = 0
+    startTime = time.perf_counter()
+    try:
+      sessions = self.iterServiceSessions(query, self.sessionWindow(records, batch_size))
+      if records is not None:
+        sessions = itertools.islice(sessions, records)
+      while True:
+        batch = list(itertools.islice(sessions, batch_size))
+        if not batch:
+          break
+        writer.write(batch)
+        written += len(batch)
+        if self.debug:
+          print('NetWitnessHandler - NWHandler:export(): ' + str(written) + ' sessions written to ' + path)
+    finally:
+      writer.close()
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op='export', cache='none')
+    return written
+
+
+  # * Distributed Query Function Section
+  # querySessionsFrom
+  # Run the queryNWDB() session query against a single service
+  # @param query Query to send to NWDB
+  # @param url NWDB service URL
+  # @param records Max number of records to return, None for all
+  # @param stop Optional threading.Event; once set, no further NWDB window is fetched and the sessions so far are returned
+  def querySessionsFrom(self, query, url, records=1000, stop=None):
+    sessions = []
+    for group, session in self.iterGroups(query, records or 1000, 0, url):
+      if stop is not None and stop.is_set():
+        break
+      sessions.append(session)
+      if records is not None and len(sessions) >= records:
+        break
+    return sessions
+
+  # queryDistributed
+  # Scatter a query to every configured service concurrently and gather the results. Each session is tagged with the 'nw_service' it came from; services that fail or miss the distrib timeout are reported and the rest are returned as a partial result. Services that miss the timeout are told to stop, so they give their NWDB connection back once the window in flight arrives. See mergeDistributed() for how the records cut is shared between services.
+  # Returns { 'sessions': [...], 'services': { name: { 'status', 'latency', 'sessions', 'error' } }, 'partial': bool }
+  # @param query Query to send to NWDB
+  # @param records Max number of merged records to return
+  # @param op Per-service operation, 'queryNWDB' or 'NWGenerate'
+  # @param timeout Seconds to wait for the slowest service, defaults to distrib.timeout
+  def queryDistributed(self, query, records=1000, op='queryNWDB', timeout=None):
+    stop = threading.Event()
+    timings = {}
+
+    def runService(svc):
+      startTime = time.perf_counter()
+      try:
+        if op == 'NWGenerate':
+          return self.generateFrom(query, svc['url'], records)
+        return self.querySessionsFrom(query, svc['url'], records, stop)
+      finally:
+        timings[svc['name']] = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=min(len(self.services), int(self.distrib['max_workers'])))
+    futures = [(svc, pool.submit(contextvars.copy_context().run, runService, svc)) for svc in self.services]
+    wait([f for svc, f in futures], timeout=float(timeout or self.distrib['timeout']))
+    stop.set()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    outcomes = []
+    for svc, future in futures:
+      latency = timings.get(svc['name'], time.perf_counter() - startTime)
+      if not future.done():
+        outcomes.append((svc, 'timeout', latency, None, None))
+      elif future.cancelled():
+        outcomes.append((svc, 'cancelled', latency, None, None))
+      elif future.exception() is not None:
+        outcomes.append((svc, 'error', latency, None, str(future.exception())))
+      else:
+        outcomes.append((svc, 'ok', latency, future.result(), None))
+    return self.mergeDistributed(outcomes, records)
+
+  # mergeDistributed
+  # Tag and merge the per-service results of a distributed query into the queryDistributed() return value. Every service returns its first sessions in its own meta id (arrival) order, which says nothing about how their times compare across services, so the records cut takes an even share from each service, handing shares a service can't fill to the others, rather than the earliest sessions of the union. The kept sessions are ordered by time when they all carry one.
+  # @param outcomes List of (service, status, latency, sessions, error) tuples, sessions None unless status is 'ok'
+  # @param records Max number of merged records to return
+  def mergeDistributed(self, outcomes, records):
+    results = [result or [] for svc, status, latency, result, error in outcomes]
+    kept = [0] * len(results)
+    left = sum(len(result) for result in results) if records is None else records
+    while left > 0:
+      filling = [i for i, result in enumerate(results) if kept[i] < len(result)]
+      if not filling:
+        break
+      share = max(left // len(filling), 1)
+      for i in filling:
+        take = min(share, len(results[i]) - kept[i], left)
+        kept[i] += take
+        left -= take
+
+    sessions = []
+    services = {}
+    for (svc, status, latency, result, error), count in zip(outcomes, kept):
+      report = { 'status': status, 'latency': latency, 'sessions': 0, 'error': error }
+      if result is not None:
+        for session in result[:count]:
+          session['nw_service'] = svc['name']
+        report['sessions'] = count
+        sessions.extend(result[:count])
+      services[svc['name']] = report
+
+    if sessions and all('time' in session for session in sessions):
+      sessions.sort(key=lambda session: session['time'])
+    for name, report in services.items():
+      self.metrics.observe('nwapi_service_seconds', report['latency'], service=name, status=report['status'])
+    return { 'sessions': sessions, 'services': services, 'partial': any(r['status'] != 'ok' for r in services.values()) }
+
+
+  # * Sharded Query Function Section
+  # shardQuery
+  # Split the query's top level time="A"-"B" range into shards contiguous, non-overlapping sub-ranges (open ended ranges end now), rewriting only that conjunct. Returns a list of queries in time order, or None when the query has no top level time range (e.g. one under || or !) and can't be sharded.
+  # @param query Query containing a time range
+  # @param shards Number of sub-ranges to split into
+  def shardQuery(self, query, shards):
+    try:
+      rng = parseQuery(query).time_range
+    except NWQueryError:
+      return None
+    if rng is None:
+      return None
+    start, end = rng
+    if end is None:
+      end = int(time.time())
+    shards = max(1, min(int(shards), end - start + 1))
+    step = (end - start + 1) / shards
+    bounds = [start + int(round(step * i)) for i in range(shards)] + [end + 1]
+    return [replaceTimeRange(query, bounds[i], bounds[i + 1] - 1) for i in range(shards)]
+
+  # querySharded
+  # Run a time ranged query as parallel time shards on a thread pool and merge the sessions back in time order. Shards cover disjoint, ascending time windows, so merging is a concatenation in shard order; once records sessions are collected the remaining shards are cancelled or told to stop.
+  # @param query Query to send to NWDB, must contain a top level time="A"-"B" range (falls back to queryNWDB() otherwise)
+  # @param records Max number of records to return
+  # @param shards Number of time shards, defaults to sharding.shards
+  # @param max_workers Max shards in flight, defaults to sharding.max_workers
+  # @param urls NWDB service URLs to spread the shards across, defaults to the configured service
+  def querySharded(self, query, records=1000, shards=None, max_workers=None, urls=None):
+    try:
+      query, records = self.checkQuery(query, records)
+    except NWQueryError as e:
+      return self.inputError(e)
+    subqueries = self.shardQuery(query, shards or self.sharding['shards']) if query else None
+    if not subqueries:
+      return self.queryNWDB(query, records)
+    urls = urls or [self.url]
+    stop = threading.Event()
+
+    def runShard(index):
+      sessions = []
+      if stop.is_set():
+        return sessions
+      for group, session in self.iterGroups(subqueries[index], min(records, 1000), 0, urls[index % len(urls)]):
+        sessions.append(session)
+        if len(sessions) >= records or stop.is_set():
+          break
+      return sessions
+
+    startTime = time.perf_counter()
+    merged = []
+    with ThreadPoolExecutor(max_workers=int(max_workers or self.sharding['max_workers'])) as pool:
+      futures = [pool.submit(contextvars.copy_context().run, runShard, i) for i in range(len(subqueries))]
+      for future in futures:
+        merged.extend(future.result())
+        if len(merged) >= records:
+          stop.set()
+          for pending in futures:
+            pending.cancel()
+          break
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op='querySharded', cache='none')
+    return merged[:records]
+
 
   # * Aggregation Function Section
   # processNetwirntessMetaAggregate
-  # @param meta 
-  # @param results
+  # @param meta JSON marshalled NWDB msg=values results
+  # @param results Empty list for storing { metaKey: value, 'count': count } records via pass-by-reference
   def processNetwitnessMetaAggregate(self, meta, results):
       try:
-          d = {}
-          rec_count = 0
-          current_group = 'NOT_SET'
-          window_start_meta_id = 0
-          window_end_meta_id = 0
-          
-          print(meta)
-          print('-------------------')
-          
+          if isinstance(meta, list):
+              meta = meta[0] if meta else {}
+          if self.debug:
+              print('NWHandler:processNetwitnessMetaAggregate(): ' + str(len(meta['results']['fields'])) + ' values')
           for field in meta['results']['fields']:
-              print(field)
-              print(results)
-              d[field['type']] = field['value']
-              d['count'] = field['count']
-              results.append(d.copy())
+              results.append({ field['type']: field['value'], 'count': field['count'] })
 
       except Exception as e:
-          print('NWHandler:processNetwitnessMetaAggregate(): Exception => ' + e + '\n')
+          print('NWHandler:processNetwitnessMetaAggregate(): Exception => ' + str(e) + '\n')
+
+  # fetchValues
+  # Run a msg=values call for one field against one service, sorted by descending count. Returns ([(value, count), ...], complete) where complete is True when the service returned fewer than size values, i.e. nothing was cut off.
+  # @param query WHERE clause selecting the sessions to aggregate across
+  # @param field Meta field to aggregate
+  # @param size Max number of values the service should return
+  # @param url NWDB service URL
+  def fetchValues(self, query, field, size, url):
+      query_args = { 'msg': 'values', 'size': size, 'fieldName': field, 'where': query, 'flags': 'sort-total,order-descending', 'force-content-type': 'application/json' }
+      response = self.transport.get(url, params=query_args)
+      results = []
+      with self.metrics.timer('values', 'decode'):
+        meta = json.loads(response.text)
+      self.processNetwitnessMetaAggregate(meta, results)
+      pairs = [(rec[field], int(rec['count'])) for rec in results if field in rec]
+      return (pairs, len(pairs) < size)
+
+  # mergeTopK
+  # Merge per-service descending (value, count) lists into a global top-k with heapq. A service that was cut off may still hold up to its smallest returned count for any value it didn't return; those thresholds give an upper bound for every value. Returns (top, error_bound, exact): the top-k list, the largest possible undercount of any value, and whether the top-k (membership and counts) is provably exact.
+  # @param lists List of (pairs, complete) tuples, one per service
+  # @param size Number of values to return
+  def mergeTopK(self, lists, size):
+      totals = defaultdict(int)
+      for pairs, complete in lists:
+          for value, count in pairs:
+              totals[value] += count
+      top = heapq.nlargest(size, totals.items(), key=lambda item: item[1])
+      truncated = [(dict(pairs), pairs[-1][1]) for pairs, complete in lists if not complete and pairs]
+      error_bound = sum(threshold for seen, threshold in truncated)
+      if not truncated:
+          return (top, 0, True)
+      if len(top) < size:
+          return (top, error_bound, False)
+      kth = top[-1][1]
+      topValues = set(value for value, count in top)
+      exact = error_bound <= kth and all(value in seen for seen, threshold in truncated for value in topValues)
+      if exact:
+          for value, count in totals.items():
+              if value not in topValues and count + sum(threshold for seen, threshold in truncated if value not in seen) > kth:
+                  exact = False
+                  break
+      return (top, error_bound, exact)
+
+  # aggregateNWDB
+  # Aggregation engine behind queryNWDBAggregate(). Every (field, service) values call runs concurrently and per-service counts are merged into a global top-k per field. With exact set, services that were cut off are re-queried with a larger size until the top-k is provably exact or aggregate.max_rounds is reached.
+  # Returns { 'results': { field: [(value, count), ...] }, 'error_bound': { field: n }, 'exact': { field: bool } }
+  # @param query WHERE clause selecting the sessions to aggregate across
+  # @param size Number of values to return per field
+  # @param fields Meta field or list of meta fields to aggregate
+  # @param exact Keep re-querying until the top-k is exact instead of returning a bounded-error result
+  def aggregateNWDB(self, query, size, fields, exact=False):
+      if isinstance(fields, str):
+          fields = [f.strip() for f in fields.split(',') if f.strip()]
+      fetch = { (field, svc['url']): max(int(size * float(self.aggregate['overfetch'])), size) for field in fields for svc in self.services }
+      lists = {}
+      pending = list(fetch)
+      rounds = 0
+      ret = { 'results': {}, 'error_bound': {}, 'exact': {} }
+      with ThreadPoolExecutor(max_workers=min(len(fetch), int(self.aggregate['max_workers'])) or 1) as pool:
+          while pending:
+              rounds += 1
+              futures = { key: pool.submit(contextvars.copy_context().run, self.fetchValues, query, key[0], fetch[key], key[1]) for key in pending }
+              for key, future in futures.items():
+                  lists[key] = future.result()
+              ret = { 'results': {}, 'error_bound': {}, 'exact': {} }
+              pending = []
+              for field in fields:
+                  top, bound, isExact = self.mergeTopK([lists[(field, svc['url'])] for svc in self.services], size)
+                  ret['results'][field] = top
+                  ret['error_bound'][field] = bound
+                  ret['exact'][field] = isExact
+                  if exact and not isExact and rounds < int(self.aggregate['max_rounds']):
+                      for svc in self.services:
+                          key = (field, svc['url'])
+                          if not lists[key][1]:
+                              fetch[key] *= 4
+                              pending.append(key)
+      self.metrics.observe('nwapi_aggregate_rounds', rounds, COUNT_BUCKETS)
+      return ret
+
+  # checkAggregate
+  # Validate the arguments of an aggregation like checkQuery(). Returns (query, size, fields); raises NWQueryError when there is no field to aggregate, size isn't a positive integer or the where clause is rejected.
+  # @param query WHERE clause selecting the sessions to aggregate across
+  # @param size Records to return per field
+  # @param field Comma separated string or list of fields
+  def checkAggregate(self, query, size, field):
+      fields = [f.strip() for f in field.split(',') if f.strip()] if isinstance(field, str) else list(field or [])
+      if not fields:
+          raise NWQueryError('No field to aggregate')
+      try:
+          size = int(size)
+      except (TypeError, ValueError):
+          raise NWQueryError('size must be an integer')
+      if size < 1:
+          raise NWQueryError('size must be at least 1')
+      query, size = self.checkQuery(query, size, where_only=True, fields=fields)
+      return (query, size, fields)
 
   # queryNWDBAggregate
   # @param query Query to select sessions to aggregate across
-  # @param size Records to return
-  # @param field Fields to aggregate across
-  def queryNWDBAggregate(self, query, size, field):
-      translated_size = size * 8
-      print('translated_size: ' + str(translated_size) + '\n')
-      query_args = { 'msg': 'values', 'size': translated_size, 'fieldName': field, 'where': query, 'force-content-type': 'application/json' }
-      print(query_args)
-      response = requests.get( self.url, params=query_args, auth=HTTPBasicAuth(self.config['netwitness']['auth']['user'], self.config['netwitness']['auth']['pass']), verify=False )
-      results = []
-      self.processNetwitnessMetaAggregate(json.loads(response.text), results)
-      return results
+  # @param size Records to return per field
+  # @param field Field or list of fields to aggregate across
+  # @param exact Require an exact global top-k across services (see aggregateNWDB())
+  # Returns { field: [(value, count), ...] }
+  def queryNWDBAggregate(self, query, size, field, exact=False):
+      try:
+          query, size, fields = self.checkAggregate(query, size, field)
+      except NWQueryError as e:
+          return self.inputError(e)
+      return self.cached('queryNWDBAggregate', query, { 'size': size, 'field': fields, 'exact': exact }, lambda: self.aggregateNWDB(query, size, fields, exact)['results'])
+
+
+  # * Timeline Function Section
+  # timelineBucket
+  # Pick the bucket width in seconds for a timeline of [start, end]: the smallest TIMELINE_BUCKETS width giving at most timeline.target_buckets buckets, or the requested width raised until there are at most timeline.max_buckets
+  # @param start First epoch second of the timeline
+  # @param end Last epoch second of the timeline
+  # @param bucket Requested width in seconds, None for adaptive
+  def timelineBucket(self, start, end, bucket=None):
+    span = end - start + 1
+    limit = int(self.timeline_settings['max_buckets'] if bucket else self.timeline_settings['target_buckets'])
+    width = max(int(bucket or 1), 1)
+    if -(-span // width) <= limit:
+      return width
+    for size in TIMELINE_BUCKETS:
+      if size >= width and -(-span // size) <= limit:
+        return size
+    return -(-span // limit)
+
+  # fetchTimeline
+  # Run a msg=timeline call for the buckets first .. last (bucket starts, width bucket seconds) against one service. Returns { bucket_start: count } for the non-empty buckets.
+  # @param where WHERE clause selecting the sessions to count, '' for all
+  # @param first Start of the first bucket
+  # @param last Start of the last bucket
+  # @param bucket Bucket width in seconds
+  # @param url NWDB service URL
+  def fetchTimeline(self, where, first, last, bucket, url):
+    query_args = { 'msg': 'timeline', 'time1': first, 'time2': last + bucket - 1, 'size': (last - first) // bucket + 1, 'flags': 'sessions', 'force-content-type': 'application/json' }
+    if where:
+      query_args['where'] = where
+    response = self.transport.get(url, params=query_args)
+    with self.metrics.timer('timeline', 'decode'):
+      meta = json.loads(response.text)
+    if isinstance(meta, list):
+      meta = meta[0] if meta else {}
+    counts = defaultdict(int)
+    for field in (meta.get('results') or {}).get('fields') or []:
+      value = field['value']
+      epoch = int(value) if isinstance(value, (int, float)) or str(value).isdigit() else parseTime(str(value))
+      if first <= epoch < last + bucket:
+        counts[first + (epoch - first) // bucket * bucket] += int(field['count'])
+    return dict(counts)
+
+  # timelineFrom
+  # Timeline of one service, reusing closed buckets from the cache. Buckets ending more than timeline.settle seconds ago can no longer change and are kept in one cache entry per (where, width, service); only the buckets from the first one not in that entry onward are fetched, which on a refresh is just the open, most recent bucket(s).
+  def timelineFrom(self, where, first, last, bucket, url, now):
+    key = self.cache.key('timeline', where, { 'bucket': bucket }, url)
+    found, closed = self.cache.get(key)
+    closed = dict(closed) if found else {}
+    fetchFrom = next((b for b in range(first, last + 1, bucket) if b not in closed), None)
+    if fetchFrom is None:
+      self.metrics.inc('nwapi_timeline_buckets_total', (last - first) // bucket + 1, source='cache')
+      return { b: closed[b] for b in range(first, last + 1, bucket) }
+    self.metrics.inc('nwapi_timeline_buckets_total', (fetchFrom - first) // bucket, source='cache')
+    self.metrics.inc('nwapi_timeline_buckets_total', (last - fetchFrom) // bucket + 1, source='nwdb')
+    fetchKey = self.cache.key('timeline', where, { 'bucket': bucket, 'first': fetchFrom, 'last': last }, url)
+    fetched = self.flight.do(fetchKey, lambda: self.fetchTimeline(where, fetchFrom, last, bucket, url))
+    settled = now - int(self.timeline_settings['settle'])
+    for b in range(fetchFrom, last + 1, bucket):
+      if b + bucket - 1 < settled:
+        closed[b] = fetched.get(b, 0)
+    if len(closed) > TIMELINE_CACHED_BUCKETS:
+      closed = dict(sorted(closed.items())[-TIMELINE_CACHED_BUCKETS:])
+    self.cache.put(key, closed, True)
+    ret = { b: closed[b] for b in range(first, fetchFrom, bucket) }
+    ret.update((b, fetched.get(b, 0)) for b in range(fetchFrom, last + 1, bucket))
+    return ret
+
+  # timeline
+  # Session counts over time from NWDB's msg=timeline, fanned out to every configured service in parallel and summed per bucket.
+  # Returns { 'bucket': seconds, 'start': epoch, 'end': epoch, 'timeline': [(bucket_start, count), ...] } with every bucket of the range, empty ones included
+  # @param where WHERE clause selecting the sessions to count, None or '' for all
+  # @param start Start of the timeline, epoch seconds or a NWDB time literal
+  # @param end End of the timeline, defaults to now
+  # @param bucket Bucket width in seconds, None to pick one giving about timeline.target_buckets buckets
+  def timeline(self, where, start, end=None, bucket=None):
+    now = int(time.time())
+    try:
+      try:
+        start = parseTime(str(start))
+        end = parseTime(str(end)) if end is not None and str(end).strip() else now
+      except ValueError:
+        raise NWQueryError('Invalid time, expected epoch seconds or "YYYY-mon-DD HH:MM:SS"')
+      if end < start:
+        raise NWQueryError('Timeline end is before its start')
+      if bucket is not None and int(bucket) < 1:
+        raise NWQueryError('Bucket width must be at least one second')
+      rangeClause = 'time="' + formatTime(start) + '"-"' + formatTime(end) + '"'
+      # The range is validated with the where clause so max_span and allowed_fields apply, but sent to NWDB as time1/time2
+      self.checkQuery(where + ' && ' + rangeClause if where else rangeClause, where_only=True)
+      where = canonicalQuery(where) if where else ''
+    except NWQueryError as e:
+      return self.inputError(e)
+    startTime = time.perf_counter()
+    bucket = self.timelineBucket(start, end, bucket)
+    first = start // bucket * bucket
+    last = end // bucket * bucket
+    with ThreadPoolExecutor(max_workers=min(len(self.services), int(self.timeline_settings['max_workers'])) or 1) as pool:
+      futures = [pool.submit(contextvars.copy_context().run, self.timelineFrom, where, first, last, bucket, svc['url'], now) for svc in self.services]
+      totals = defaultdict(int)
+      for future in futures:
+        for b, count in future.result().items():
+          totals[b] += count
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op='timeline', cache='none')
+    return { 'bucket': bucket, 'start': first, 'end': last + bucket - 1, 'timeline': [(b, totals.get(b, 0)) for b in range(first, last + 1, bucket)] }
+
+
+  # * Content Function Section
+  # sessionIds
+  # Resolve a WHERE clause to the ids of the sessions it selects, in NWDB order. Raises NWQueryError for rejected clauses.
+  # @param where WHERE clause selecting the sessions
+  # @param records Max number of session ids, None for all (up to validation.max_records when set)
+  # @param url NWDB service URL, defaults to the configured service
+  def sessionIds(self, where, records=None, url=None):
+    query, records = self.checkQuery('select sessionid where ' + where, records)
+    ids = []
+    for group, session in self.iterGroups(query, min(records or 1000, 1000), 0, url):
+      ids.append(int(group))
+      if records is not None and len(ids) >= records:
+        break
+    return ids
+
+  # fetchPackets
+  # Download the PCAP of a batch of sessions from the service's /packets endpoint, streaming it to path in STREAM_CHUNK_SIZE chunks so a batch is never held in memory. The file is written under a temporary name and renamed once complete.
+  # @param ids Session ids
+  # @param path File to write the PCAP to
+  # @param url NWDB service URL, defaults to the configured service
+  def fetchPackets(self, ids, path, url=None):
+    params = { 'sessions': ','.join(str(i) for i in ids), 'render': 'pcap' }
+    response = self.transport.get((url or self.url) + '/packets', params=params, stream=True, op='packets')
+    tmp = path + '.' + str(threading.get_ident()) + '.tmp'
+    try:
+      response.raise_for_status()
+      reader = ChunkReader(response.iter_content(STREAM_CHUNK_SIZE))
+      with open(tmp, 'wb') as f:
+        while True:
+          chunk = reader.read()
+          if not chunk:
+            break
+          f.write(chunk)
+      os.replace(tmp, path)
+    finally:
+      response.close()
+      if os.path.exists(tmp):
+        os.remove(tmp)
+    self.metrics.phase('packets', 'download', reader.download)
+    self.metrics.observe('nwapi_nwdb_response_bytes', reader.bytes, BYTES_BUCKETS, msg='packets')
+    return path
+
+
+  # * Graph Function Section
+  # graph
+  # Communication graph of the sessions a WHERE clause selects: each session counts once towards its (src value -> dst value) edge and adds its weight meta to the edge's bytes. Sessions are streamed from every configured service and folded into an NWEdgeTable in graph.batch_sessions batches, so memory grows with the number of unique edges, not sessions. Raises NWQueryError for rejected input and when there are more than graph.max_edges edges.
+  # Returns the NWEdgeTable; use prune() and toNetworkx() on it
+  # @param where WHERE clause selecting the sessions, None or '' for all
+  # @param src Source meta key, e.g. 'ip.src' or 'alias.host'
+  # @param dst Destination meta key, e.g. 'ip.dst' or 'user.dst'
+  # @param weight Meta key summed per edge, None to only count sessions
+  # @param records Max number of sessions, None for all (up to validation.max_records when set)
+  def graph(self, where, src='ip.src', dst='ip.dst', weight='size', records=None):
+    keys = [k for k in dict.fromkeys([src, dst, weight]) if k]
+    for key in keys:
+      if not META_KEY.match(key):
+        raise NWQueryError('Invalid meta key ' + repr(key))
+    query, records = self.checkQuery('select ' + ','.join(keys) + (' where ' + where if where else ''), records)
+    startTime = time.perf_counter()
+    table = NWEdgeTable(src.replace('.', '_'), dst.replace('.', '_'), weight.replace('.', '_') if weight else None, self.graph_settings['batch_sessions'], self.graph_settings['max_edges'])
+    pageSize = min(int(self.graph_settings['page_size']), records or int(self.graph_settings['page_size']))
+    sessions = itertools.chain.from_iterable(self.iterGroups(query, pageSize, 0, svc['url']) for svc in self.services)
+    if records is not None:
+      sessions = itertools.islice(sessions, records)
+    for group, session in sessions:
+      table.add(session)
+    table.flush()
+    self.metrics.observe('nwapi_operation_seconds', time.perf_counter() - startTime, op='graph', cache='none')
+    return table
 
 # main
 # Command-line driver method when used as utility rather than module
@@ -277,13 +1129,20 @@ def main():
     parser.add_argument('-f', '--fields', help='Meta Fields to Return as Aggregate Query Result', metavar='<meta field>', nargs='*', required=False)
     parser.add_argument('-w', '--where', help='WHERE Clause for Aggregate Query Filter (single quoted, with values double quoted as necessary - ex: \'action="createprocess" && alias.host="testhost1"\'', metavar='<meta=value OR || OR &&>', default='')
     parser.add_argument('-q', '--query', help='Full NWDB Query String', metavar='<query>')
+    parser.add_argument('-o', '--output', help='Export query results to this file instead of printing them', metavar='<path>')
+    parser.add_argument('--format', help='Export format (defaults to the output file extension)', choices=['parquet', 'csv', 'ndjson'])
+    parser.add_argument('--compression', help='Export compression: gzip/zstd for csv and ndjson, a Parquet codec for parquet', metavar='<codec>')
+    parser.add_argument('--batch-size', help='Sessions per export batch / Parquet row group', metavar='<n>', type=int, default=10000)
     args = parser.parse_args()
 
     nwdb = NetWitnessHandler.NWHandler("nwhandler_config.yaml")
 
     debug = 0
 
-    if args.query:
+    if args.query and args.output:
+        written = nwdb.export(args.query, args.output, args.format, args.compression, args.batch_size)
+        print(f"Exported {written} sessions to {args.output}")
+    elif args.query:
         if debug:
               print(f"query: {args.query}")
         print(json.dumps(nwdb.queryNWDB(args.query), indent=3))
@@ -17,18 +17,67 @@ __status__ = "Development"
 
 
 from pyspark.sql import SparkSession
-import requests
-from requests.auth import HTTPBasicAuth
 import json
 import yaml
 import io
-from pyspark.sql.functions import udf, col, explode, collect_list, explode_outer, first, date_format, to_date, from_unixtime, from_json, schema_of_json
-from pyspark.sql.types import StructType, StructField, IntegerType, StringType, ArrayType, TimestampType, MapType
+from pyspark.sql.functions import udf, col, when, explode, collect_list, explode_outer, first, date_format, to_date, from_unixtime, from_json, schema_of_json
+from pyspark.sql.types import StructType, StructField, BooleanType, IntegerType, LongType, StringType, ArrayType, TimestampType, MapType
 from pyspark.sql import Row
 from pyspark.sql import functions as F
 from time import strftime, localtime, time
+from datetime import datetime, timezone
+try:
+    from .NWTransport import NWTransport
+    from .NWQuery import selectFields
+    from .NWMetrics import METRICS
+except ImportError:
+    from NWTransport import NWTransport
+    from NWQuery import selectFields
+    from NWMetrics import METRICS
+
+
+# Schema registry of NetWitness meta keys -> column type. Keys missing here are read as strings; IP addresses stay strings.
+NW_META_TYPES = {
+    'sessionid': 'long', 'time': 'long', 'size': 'long', 'payload': 'long', 'packets': 'long',
+    'payload.req': 'long', 'payload.res': 'long', 'bytes.src': 'long', 'rbytes': 'long', 'lifetime': 'long', 'streams': 'int',
+    'tcp.srcport': 'int', 'tcp.dstport': 'int', 'udp.srcport': 'int', 'udp.dstport': 'int', 'service': 'int',
+    'ip.proto': 'int', 'eth.type': 'int', 'medium': 'int', 'tcp.flags': 'int',
+    'ip.src': 'ip', 'ip.dst': 'ip', 'ip.addr': 'ip', 'alias.ip': 'ip', 'ipv6.src': 'ip', 'ipv6.dst': 'ip', 'device.ip': 'ip',
+    'event.time': 'timestamp', 'starttime': 'timestamp', 'endtime': 'timestamp',
+    'alias.host': 'string', 'direction': 'string', 'action': 'string', 'extension': 'string', 'filename': 'string',
+    'user.src': 'string', 'user.dst': 'string', 'device.type': 'string'
+}
+
+
+# toLong / toTimestamp
+# Value converters for pivoted meta, returning None for values that don't parse
+def toLong(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def toTimestamp(value):
+    try:
+        return datetime.fromtimestamp(int(value), tz=timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
 
 
+def toString(value):
+    return None if value is None else str(value)
+
+
+# Registry type -> (Spark type, converter)
+META_TYPE_MAP = {
+    'long': (LongType, toLong),
+    'int': (IntegerType, toLong),
+    'timestamp': (TimestampType, toTimestamp),
+    'ip': (StringType, toString),
+    'string': (StringType, toString)
+}
+
 
 class SparkHandler:
 
@@ -41,7 +90,13 @@ class SparkHandler:
             self.url = f"https://{self.config['netwitness']['settings']['host']}:{self.config['netwitness']['settings']['port']}/{self.config['netwitness']['settings']['path']}"
         else:
             self.url = f"http://{self.config['netwitness']['settings']['host']}:{self.config['netwitness']['settings']['port']}/{self.config['netwitness']['settings']['path']}"
-        self.rest_udf = udf(SparkHandler.executeRestApi, ArrayType(MapType(StringType(), StringType())))
+        self.transport = NWTransport(self.config, debug)
+        # Driver side NWDB calls (e.g. metaIdBounds()) are timed by the transport; executors record into their own process' registry
+        METRICS.configure(self.config['netwitness'].get('metrics'))
+        METRICS.collector('transport', self.transport.stats, handler='SparkHandler')
+        # Meta type registry, extended/overridden by the 'spark: meta_types:' config section
+        self.meta_types = dict(NW_META_TYPES)
+        self.meta_types.update((self.config['netwitness'].get('spark') or {}).get('meta_types') or {})
 
     # Read nwhandler_config.yaml config file and return parsed object
     # * Reads provided YAML config file and loads into parsed object to return
@@ -62,10 +117,8 @@ class SparkHandler:
         res_list = []
         query_args = { 'msg': 'query', 'query': query, 'id1': 0, 'id2': 0, 'force-content-type': 'application/json' }
         try:
-            if verb == 'get':
-                res = requests.get(url, params=query_args, auth=HTTPBasicAuth('admin', 'netwitness'), verify=False)
-            elif verb == 'post':
-                res = requests.post(url, params=query_args, auth=HTTPBasicAuth('admin', 'netwitness'), verify=False)
+            if verb in ('get', 'post'):
+                res = self.transport.request(verb, url, params=query_args)
             else:
                 print('Only get and post supported.')
         except Exception as e:
@@ -91,45 +144,6 @@ class SparkHandler:
         
         return None
 
-    @staticmethod
-    def executeRestApi(verb, url, query):
-        res = None
-        rec = {}
-        rec_list = {}
-        res_list = []
-        query_args = { 'msg': 'query', 'query': query, 'id1': 0, 'id2': 0, 'force-content-type': 'application/json' }
-        try:
-            if verb == 'get':
-                res = requests.get(url, params=query_args, auth=HTTPBasicAuth('admin', 'netwitness'), verify=False)
-            elif verb == 'post':
-                res = requests.post(url, params=query_args, auth=HTTPBasicAuth('admin', 'netwitness'), verify=False)
-            else:
-                print('Only get and post supported.')
-        except Exception as e:
-            return e
-        
-        if res != None and res.status_code == 200:
-            #res_tot = json.loads(res.text)
-            #return res_tot[0]['results']['fields']
-            for i in res.json():
-                #rec = {}
-                for j in i['results']['fields']:
-                    #rec = { 'group': j['group'], 'type': j['type'], 'value': j['value'] }
-                    #rec.update({ j['type']: j['value'] })
-                    rec[j['type']] = j['value']
-                rec_list.update(rec)
-                    #rec = {}
-                #print(rec_list)
-                #res_list.extend(rec_list)
-                #rec_list = []
-            #print(res_list)
-                    
-            return Row(**rec_list)
-            #return rec
-            #return res.json()
-        
-        return None
-
     def startSparkSession(self, appName="NWAPI", sparkMaster="spark://172.30.30.69:7077"):
         self.spark = SparkSession.builder \
             .appName(appName) \
@@ -155,30 +169,184 @@ class SparkHandler:
 
     #sessionIdList = sessionIdResponseGen(response)
 
-    def sessionIdRequestGen(self, response):
-        for i in self.sessionIdResponseGen(response):
-            query = f"select * where sessionid={i}"
-            yield ("get", self.url, query)
-
-    def sparkMetaQuery(self, response):
-        RestApiRequestRow = Row("verb", "url", "query")
-
-        request_df = self.spark.createDataFrame(self.sessionIdRequestGen(response), RestApiRequestRow)
+    # sessionIdBatches
+    # Group session ids into where clauses covering at most batch_size ids each: runs of consecutive ids become ranges (sessionid=100-250), the remaining ids are sent as lists (sessionid=7,19,23)
+    # @param ids Iterable of session ids
+    # @param batch_size Max number of session ids per clause
+    @staticmethod
+    def sessionIdBatches(ids, batch_size=500):
+        ids = sorted(set(int(i) for i in ids))
+        runs = []
+        for i in ids:
+            if runs and i == runs[-1][1] + 1 and runs[-1][1] - runs[-1][0] + 1 < batch_size:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        clauses = []
+        singles = []
+        for start, end in runs:
+            if end > start:
+                clauses.append(f"sessionid={start}-{end}")
+            else:
+                singles.append(str(start))
+                if len(singles) == batch_size:
+                    clauses.append("sessionid=" + ",".join(singles))
+                    singles = []
+        if singles:
+            clauses.append("sessionid=" + ",".join(singles))
+        return clauses
+
+    # fetchMetaRows
+    # Page through a query's meta in id1/id2 windows and yield (group, type, value) tuples
+    # @param transport NWTransport to issue the requests on
+    # @param url NWDB service URL
+    # @param query Query to send to NWDB
+    # @param size Max number of meta values per window
+    # @param id1 First meta id to read
+    # @param id2 Last meta id to read (0 for unbounded)
+    @staticmethod
+    def fetchMetaRows(transport, url, query, size=10000, id1=0, id2=0):
+        while True:
+            query_args = { 'msg': 'query', 'query': query, 'id1': id1, 'id2': id2, 'size': size, 'force-content-type': 'application/json' }
+            meta = transport.get(url, params=query_args).json()
+            if isinstance(meta, dict):
+                meta = [meta]
+            last_id = 0
+            rows = 0
+            for rec in meta:
+                if 'results' not in rec:
+                    continue
+                for j in rec['results'].get('fields', []):
+                    if id2 and int(j.get('id1') or 0) > id2:
+                        continue
+                    rows += 1
+                    last_id = max(last_id, int(j.get('id2') or 0))
+                    yield (int(j['group']), j['type'], None if j['value'] is None else str(j['value']))
+                last_id = max(last_id, int(rec['results'].get('id2') or 0))
+            if not rows or last_id < id1 or (id2 and last_id >= id2):
+                break
+            id1 = last_id + 1
+
+    # fetchSessionBatches
+    # mapPartitions worker: runs every batched session query of the partition over the executor's pooled transport and yields the meta rows
+    # @param clauses Iterator of sessionid where clauses from sessionIdBatches()
+    # @param url NWDB service URL
+    # @param config Parsed nwhandler_config.yaml object
+    @staticmethod
+    def fetchSessionBatches(clauses, url, config):
+        transport = NWTransport.shared(config)
+        for clause in clauses:
+            for row in SparkHandler.fetchMetaRows(transport, url, f"select * where {clause}"):
+                yield row
+
+    # sparkMetaQuery
+    # Fetch all meta for the sessions in response. Session ids are batched into range/list queries (sessionIdBatches()) and each partition runs its batches with mapPartitions over one pooled HTTP session, so a hunt costs one request per batch instead of one per session. Returns a (group, type, value) DataFrame for formatMetaResultsPivot().
+    # @param response Session records returned by createQueryArg()/sessionQuery()
+    # @param batch_size Max number of session ids per NWDB request
+    def sparkMetaQuery(self, response, batch_size=500):
+        clauses = self.sessionIdBatches(self.sessionIdResponseGen(response), batch_size)
+        url = self.url
+        config = { 'netwitness': self.config['netwitness'] }
+        numSlices = max(1, min(len(clauses), self.spark.sparkContext.defaultParallelism * 4))
+
+        meta_rdd = self.spark.sparkContext.parallelize(clauses, numSlices) \
+            .mapPartitions(lambda part: SparkHandler.fetchSessionBatches(part, url, config))
 
         schema = StructType([ \
-            StructField('flags', IntegerType(), True), \
-            StructField('results', MapType(StringType(), ArrayType(MapType(StringType(), StringType())))) \
+            StructField('group', LongType(), False), \
+            StructField('type', StringType(), False), \
+            StructField('value', StringType(), True) \
         ])
 
-        #bcast_udf = self.executeRestApi
-        #udf_executeRestApi = udf(bcast_udf,ArrayType(MapType(StringType(), StringType())))
-
-        result_df = request_df \
-            .withColumn('result', self.rest_udf(col('verb'), col('url'), col('query')))
-        
-        return result_df
+        return self.spark.createDataFrame(meta_rdd, schema)
     
     
+    # * Partitioned Reader Section
+    # metaIdBounds
+    # Ask NWDB for the first and last meta id in the database (msg=summary mid1/mid2)
+    def metaIdBounds(self):
+        res = self.transport.get(self.url, params={ 'msg': 'summary', 'flags': 0, 'force-content-type': 'application/json' }).json()
+        summary = {}
+        if isinstance(res, dict) and isinstance(res.get('params'), dict):
+            summary.update(res['params'])
+        if isinstance(res, dict) and isinstance(res.get('string'), str):
+            for pair in res['string'].split():
+                if '=' in pair:
+                    key, value = pair.split('=', 1)
+                    summary[key] = value
+        return (int(summary['mid1']), int(summary['mid2']))
+
+    # metaIdRanges
+    # Split the inclusive meta id range [mid1, mid2] into numPartitions contiguous (id1, id2) windows
+    @staticmethod
+    def metaIdRanges(mid1, mid2, numPartitions):
+        numPartitions = max(1, min(int(numPartitions), mid2 - mid1 + 1))
+        step = (mid2 - mid1 + 1) / numPartitions
+        bounds = [mid1 + int(round(step * i)) for i in range(numPartitions)] + [mid2 + 1]
+        return [(bounds[i], bounds[i + 1] - 1) for i in range(numPartitions)]
+
+    # readMetaRange
+    # mapPartitions worker for readNWDB(): fetches the query's meta inside the partition's (id1, id2) window and pivots consecutive rows of a group into one row. The first and last group of the window may continue in a neighbouring window, so they are flagged as edges for readNWDB() to merge.
+    # @param ranges Iterator over the partition's (id1, id2) windows
+    # @param url NWDB service URL
+    # @param query Query to send to NWDB
+    # @param config Parsed nwhandler_config.yaml object
+    # @param columns Sanitized column names in schema order
+    # @param size Max number of meta values per request
+    # @param converters Value converter per column, strings by default
+    @staticmethod
+    def readMetaRange(ranges, url, query, config, columns, size, converters=None):
+        transport = NWTransport.shared(config)
+        index = { c: i for i, c in enumerate(columns) }
+        converters = converters or [toString] * len(columns)
+        for id1, id2 in ranges:
+            pending = None
+            current = None
+            first = True
+            for group, metaType, value in SparkHandler.fetchMetaRows(transport, url, query, size, id1, id2):
+                if current is None or current[0] != group:
+                    if pending is not None:
+                        yield tuple(pending)
+                    pending = current
+                    current = [group] + [None] * len(columns) + [first]
+                    first = False
+                i = index.get(metaType.replace('.', '_'))
+                if i is not None:
+                    current[i + 1] = converters[i](value)
+            if pending is not None:
+                yield tuple(pending)
+            if current is not None:
+                current[-1] = True
+                yield tuple(current)
+
+    # readNWDB
+    # Parallel partitioned reader: split the database's meta id range into numPartitions id1/id2 windows and let every executor fetch and pivot its own window. Sessions cut by a window boundary come back as edge fragments and are merged with a groupBy over just those rows.
+    # The pivoted windows feed both the inner and the edge rows, so they are materialized once with an eager localCheckpoint() when readNWDB() is called rather than read from NWDB twice. Unlike persist() nothing stays pinned in the cache: Spark's cleaner drops the blocks once the returned DataFrame is no longer referenced; cache the result yourself if you reuse it.
+    # Returns a DataFrame with a declared schema: group plus one column per selected meta key (dots replaced by underscores), typed from the meta type registry
+    # @param query Query to send to NWDB, its select list defines the columns
+    # @param numPartitions Number of meta id windows, defaults to the Spark default parallelism
+    # @param fields Meta keys to return, required when the query selects '*'
+    # @param size Max number of meta values per request
+    def readNWDB(self, query, numPartitions=None, fields=None, size=10000):
+        fields = fields or selectFields(query)
+        if not fields:
+            raise ValueError('SparkHandler::readNWDB() requires a select list or fields to declare the schema')
+        columns, schema, converters = self.metaSchema(fields)
+        mid1, mid2 = self.metaIdBounds()
+        ranges = self.metaIdRanges(mid1, mid2, numPartitions or self.spark.sparkContext.defaultParallelism)
+        url = self.url
+        config = { 'netwitness': self.config['netwitness'] }
+
+        schema = StructType(schema.fields + [StructField('_edge', BooleanType(), False)])
+
+        meta_rdd = self.spark.sparkContext.parallelize(ranges, len(ranges)) \
+            .mapPartitions(lambda part: SparkHandler.readMetaRange(part, url, query, config, columns, size, converters))
+        pivot_df = self.spark.createDataFrame(meta_rdd, schema).localCheckpoint()
+
+        inner_df = pivot_df.filter(~col('_edge')).drop('_edge')
+        edge_df = pivot_df.filter(col('_edge')).groupBy('group').agg(*[first(c, ignorenulls=True).alias(c) for c in columns])
+        return inner_df.unionByName(edge_df)
+
     def sparkStop(self):
         self.spark.stop()
 
@@ -187,19 +355,44 @@ class SparkHandler:
 
     #test = result_df.select(col('result').alias('j')).rdd.map(lambda x: x.j)
 
-    def formatMetaResults(self, result_df):
-        test_df = result_df.select(explode(result_df.result))
-        print(test_df.show(1, truncate=False))
-        #test2_df = test_df.select(explode(test_df.col))
-        #print(test2_df.show(10))
-        test2_df = test_df.select(explode(test_df.col))
-        print(test2_df.show(1, truncate=False))
-        #test3_df = test2_df.withColumn('record', test2_df.col['fields'])
-        #print(test3_df.show(10))
-        new_res_df = test_df.select(test_df.col['group'].alias('group'), test_df.col['type'].alias('type'), test_df.col['value'].alias('value')).groupBy('group').pivot('type').agg(collect_list('value'))
-        print(new_res_df.show(1, truncate=False))
-
-        return new_res_df
+    # metaTypes
+    # Meta keys present in a (group, type, value) DataFrame, sorted; costs one distinct job
+    # @param meta_df DataFrame with a type column
+    def metaTypes(self, meta_df):
+        return sorted(row[0] for row in meta_df.select('type').distinct().collect())
+
+    # pivotFields
+    # Meta keys a pivot produces columns for: the given fields (e.g. selectFields(query)), else the keys of the meta type registry. The distinct job of metaTypes() only runs when discover is set.
+    # @param meta_df DataFrame with a type column
+    # @param fields Meta keys to pivot
+    # @param discover Take the keys found in meta_df when fields is empty
+    def pivotFields(self, meta_df, fields=None, discover=False):
+        if fields:
+            return list(fields)
+        if discover:
+            return self.metaTypes(meta_df)
+        return sorted(self.meta_types)
+
+    # metaSchema
+    # Resolve meta keys against the type registry. Returns (columns, schema, converters): sanitized column names, a StructType led by the group column, and one value converter per column. Keys missing from the registry are typed as strings.
+    # @param fields Meta keys
+    def metaSchema(self, fields):
+        fields = list(fields)
+        columns = [f.replace('.', '_') for f in fields]
+        types = [META_TYPE_MAP.get(self.meta_types.get(f, 'string'), META_TYPE_MAP['string']) for f in fields]
+        schema = StructType([StructField('group', LongType(), False)] + [StructField(c, t[0](), True) for c, t in zip(columns, types)])
+        return (columns, schema, [t[1] for t in types])
+
+    # formatMetaResults
+    # Pivot a (group, type, value) DataFrame such as sparkMetaQuery() output into one row per group, collecting every value of a meta key into a list so multi-valued meta keeps all its values
+    # @param meta_df DataFrame with group, type and value columns
+    # @param fields Meta keys to pivot, defaults to the distinct types found in the data
+    def formatMetaResults(self, meta_df, fields=None):
+        meta_df = meta_df.select('group', 'type', 'value')
+        # Explicit pivot values skip the extra job Spark runs to discover the distinct types
+        if fields:
+            return meta_df.groupBy('group').pivot('type', list(fields)).agg(collect_list('value'))
+        return meta_df.groupBy('group').pivot('type').agg(collect_list('value'))
 
     def make_row(self, kv):
         key, val = kv
@@ -208,40 +401,76 @@ class SparkHandler:
 
     ## RDD Solution
     def formatMetaResultsRDD(self, input_rows):
-        #input_rows = []
-        #for i in meta["results"]["fields"]:
-        #    input_rows.append(i)
-
         nwRDD = self.spark.sparkContext.parallelize(input_rows)
 
         nw_test_df = self.spark.read.json(nwRDD)
 
-        nw_test_df.groupBy('type').count().show()
-
-        nw_test_df2 = nw_test_df.groupBy('group').pivot('type').agg(collect_list('value'))
-
         add_col_DF = nw_test_df.rdd.map(lambda row: (row.group, (row.type, row.value))).groupByKey()
 
-        
-
-        add_col_DF.map(self.make_row).collect()
-
         pivot_rdd_DF = self.spark.createDataFrame(add_col_DF.map(self.make_row))
 
         return pivot_rdd_DF
     
 
     ## Pivot Solution
-    def formatMetaResultsPivot(self, nw_test_df):
-        df3 = nw_test_df.select("group","type","value").groupBy('group').pivot('type').agg(first('value'))
-
-        new_cols=(column.replace('.','_') for column in df3.columns)
-
-        df3 = df3.toDF(*new_cols)
-
-        df4 = df3.withColumn("ts", from_unixtime(col("time")))
-
-        return df4
+    # formatMetaResultsPivot
+    # Pivot a (group, type, value) DataFrame into one typed row per group. Columns come from pivotFields(): fields (e.g. selectFields(query)), else the meta type registry, else with discover set the distinct types in the data. The registry sets the column types. Each column is a conditional first() aggregate named and cast upfront, so there is no rename pass.
+    # @param nw_test_df DataFrame with group, type and value columns
+    # @param fields Meta keys to pivot
+    # @param discover Pivot every key found in the data when fields is empty (runs an extra distinct job)
+    def formatMetaResultsPivot(self, nw_test_df, fields=None, discover=False):
+        fields = self.pivotFields(nw_test_df, fields, discover)
+        # Values are cast by Spark here, the Python converters are only used by the RDD pivots
+        columns, schema = self.metaSchema(fields)[:2]
+
+        aggs = []
+        for f, c, field in zip(fields, columns, schema.fields[1:]):
+            value = first(when(col('type') == f, col('value')), ignorenulls=True)
+            if isinstance(field.dataType, TimestampType):
+                value = value.cast('long').cast('timestamp')
+            elif not isinstance(field.dataType, StringType):
+                value = value.cast(field.dataType)
+            aggs.append(value.alias(c))
+
+        df3 = nw_test_df.select("group","type","value").groupBy('group').agg(*aggs)
+
+        if 'time' in columns:
+            df3 = df3.withColumn("ts", from_unixtime(col("time")))
+
+        return df3
+
+    # foldGroups
+    # mapPartitions worker for pivotMetaPartitions(): folds runs of consecutive rows with the same group into one typed tuple
+    # @param rows Iterator of (group, type, value) rows
+    # @param index Meta key -> column position
+    # @param converters Value converter per column
+    @staticmethod
+    def foldGroups(rows, index, converters):
+        current = None
+        for row in rows:
+            group, metaType, value = row[0], row[1], row[2]
+            if current is None or current[0] != group:
+                if current is not None:
+                    yield tuple(current)
+                current = [group] + [None] * len(converters)
+            i = index.get(metaType)
+            if i is not None:
+                current[i + 1] = converters[i](value)
+        if current is not None:
+            yield tuple(current)
+
+    # pivotMetaPartitions
+    # Shuffle-free pivot for meta DataFrames whose groups arrive contiguously within a partition, such as sparkMetaQuery() output where every session is fetched by exactly one partition
+    # @param meta_df DataFrame with group, type and value columns
+    # @param fields Meta keys to pivot (e.g. selectFields(query)), see pivotFields() for the defaults
+    # @param discover Pivot every key found in the data when fields is empty (runs an extra distinct job)
+    def pivotMetaPartitions(self, meta_df, fields=None, discover=False):
+        fields = self.pivotFields(meta_df, fields, discover)
+        columns, schema, converters = self.metaSchema(fields)
+        index = { f: i for i, f in enumerate(fields) }
+        pivot_rdd = meta_df.select('group', 'type', 'value').rdd \
+            .mapPartitions(lambda rows: SparkHandler.foldGroups(rows, index, converters))
+        return self.spark.createDataFrame(pivot_rdd, schema)
 
 
 # main
@@ -256,13 +485,21 @@ def main():
     parser.add_argument('-f', '--fields', help='Meta Fields to Return as Aggregate Query Result', metavar='<meta field>', nargs='*', required=False)
     parser.add_argument('-w', '--where', help='WHERE Clause for Aggregate Query Filter (single quoted, with values double quoted as necessary - ex: \'action="createprocess" && alias.host="testhost1"\'', metavar='<meta=value OR || OR &&>', default='')
     parser.add_argument('-q', '--query', help='Full NWDB Query String', metavar='<query>')
+    parser.add_argument('-p', '--partitions', help='Read the query with the partitioned meta id reader using this many partitions', metavar='<partitions>', type=int)
+    parser.add_argument('--discover-fields', help='For \'select *\' queries, pivot every meta key found in the results instead of the meta type registry (runs an extra Spark job)', action='store_true')
     args = parser.parse_args()
 
     nwdb = SparkHandler("nwhandler_config.yaml")
 
     debug = 0
 
-    if args.query:
+    if args.query and args.partitions:
+        nwdb.startSparkSession()
+        results_df = nwdb.readNWDB(args.query, args.partitions)
+        print(results_df.show(10, truncate=False))
+        nwdb.sparkStop()
+
+    elif args.query:
         if debug:
               print(f"query: {args.query}")
         nwdb.startSparkSession()
@@ -281,7 +518,7 @@ def main():
         #print(sList)
         resList_df = nwdb.sparkMetaQuery(sessionList)
         print(resList_df.show(1, truncate=False))
-        metaResults = nwdb.formatMetaResults(resList_df)
+        metaResults = nwdb.pivotMetaPartitions(resList_df, selectFields(args.query), args.discover_fields)
         print(metaResults.show(1, truncate=False))
         #pivotResults = nwdb.formatMetaResultsPivot(resList_df)
         #print(pivotResults.show(10))
@@ -0,0 +1,271 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  mock_nwdb.py:
+
+  Local stand-in for the NWDB RESTful API (msg=query, msg=values, msg=timeline, msg=summary and /packets) serving synthetic sessions, for benchmarks and offline development.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import argparse
+import gzip
+import json
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Meta keys used for synthetic sessions, in order; wider sessions add generic meta.fieldN keys
+FIELD_CATALOG = ['time', 'ip.src', 'ip.dst', 'service', 'size', 'tcp.dstport', 'alias.host', 'action',
+                 'direction', 'user.src', 'filename', 'extension', 'payload', 'packets', 'ip.proto', 'device.type']
+
+# NWDB messages served by the mock
+MESSAGES = ('query', 'values', 'timeline', 'summary')
+
+# Epoch of the first synthetic session; sessions are one second apart
+BASE_TIME = 1577836800
+
+
+class SyntheticNWDB:
+
+    # Constructor
+    # * Sessions are laid out contiguously by meta id like a real NWDB: session s owns meta ids offsets[s]+1 .. offsets[s+1]. Values are derived arithmetically from (session, field), so only the offsets are stored.
+    # @param sessions Number of sessions
+    # @param fields Number of meta fields per session
+    # @param multi_rate Fraction of sessions carrying a second ip.dst value
+    # @param latency Seconds added to every response
+    # @param seed Seed mixed into generated values, for reproducible datasets
+    def __init__(self, sessions=10000, fields=8, multi_rate=0.0, latency=0.0, seed=1):
+        self.fields = (FIELD_CATALOG + ['meta.field' + str(i) for i in range(len(FIELD_CATALOG), int(fields))])[:int(fields)]
+        self.multi_rate = float(multi_rate)
+        self.latency = float(latency)
+        self.seed = int(seed)
+        self.offsets = array('q', [0])
+        self.sessions = 0
+        # Last meta id written so far, None when every session is complete; set it to leave a session half ingested
+        self.ingested = None
+        self.append(int(sessions))
+
+    # append
+    # Add count sessions after the existing ones, as if they had just been ingested
+    def append(self, count):
+        multi_every = int(round(1 / self.multi_rate)) if self.multi_rate > 0 else 0
+        offsets = array('q')
+        last = self.offsets[-1]
+        for s in range(self.sessions, self.sessions + int(count)):
+            extra = 1 if multi_every and (s + self.seed) % multi_every == 0 else 0
+            last += len(self.fields) + extra
+            offsets.append(last)
+        self.offsets.extend(offsets)
+        self.sessions += int(count)
+
+    @property
+    def mid2(self):
+        return self.offsets[-1] if self.ingested is None else min(self.ingested, self.offsets[-1])
+
+    # value
+    # Synthetic value of field k (or the extra multi-value when k == len(fields)) of session s
+    def value(self, s, k):
+        x = (s * 2654435761 + k * 40503 + self.seed * 97) & 0xffffffff
+        name = self.fields[k] if k < len(self.fields) else 'ip.dst'
+        if name == 'time':
+            return BASE_TIME + s
+        if name in ('ip.src', 'ip.dst'):
+            return '10.%d.%d.%d' % ((x >> 16) & 15, (x >> 8) & 255, x & 255)
+        if name in ('service', 'tcp.dstport'):
+            return (80, 443, 53, 25, 8080, 22)[x % 6]
+        if name in ('size', 'payload', 'packets'):
+            return x % 100000
+        if name == 'ip.proto':
+            return (6, 17, 1)[x % 3]
+        return name.split('.')[-1] + str(x % 50)
+
+    # meta
+    # Build the NWDB meta row for meta id mid
+    def meta(self, mid):
+        s = bisect_right(self.offsets, mid - 1) - 1
+        k = mid - self.offsets[s] - 1
+        name = self.fields[k] if k < len(self.fields) else 'ip.dst'
+        return { 'id1': mid, 'id2': mid, 'count': 0, 'format': 8, 'flags': 0, 'group': s + 1, 'type': name, 'value': self.value(s, k) }
+
+    # query
+    # msg=query: meta rows of the selected fields with ids in [id1, id2], at most size of them
+    def query(self, params):
+        select = params.get('query', 'select *')
+        fields = select.split(' where ')[0].strip()[len('select'):].strip()
+        wanted = None if fields in ('', '*') else set(f.strip() for f in fields.split(','))
+        id1 = max(int(params.get('id1', 0) or 0), 1)
+        id2 = int(params.get('id2', 0) or 0) or self.mid2
+        id2 = min(id2, self.mid2)
+        size = int(params.get('size', 0) or 0) or 10000
+        rows = []
+        mid = id1
+        last = 0
+        while mid <= id2 and len(rows) < size:
+            row = self.meta(mid)
+            # NWDB keeps sessionid as a meta key of its own; here it's reported alongside each session's first meta
+            if wanted is not None and 'sessionid' in wanted and mid - self.offsets[row['group'] - 1] == 1:
+                rows.append(dict(row, type='sessionid', value=row['group']))
+            if wanted is None or row['type'] in wanted:
+                rows.append(row)
+            last = mid
+            mid += 1
+        return [{ 'flags': 0, 'results': { 'id1': id1, 'id2': last, 'fields': rows } }]
+
+    # values
+    # msg=values: a Zipf-like distribution of fieldName values, sorted by descending count
+    def values(self, params):
+        field = params.get('fieldName', 'ip.src')
+        size = int(params.get('size', 20) or 20)
+        distinct = max(1, min(size, 1000))
+        rows = []
+        for i in range(distinct):
+            rows.append({ 'id1': 0, 'id2': 0, 'count': max(1, self.sessions // (i + 1)), 'format': 65, 'flags': 0, 'group': 0, 'type': field, 'value': field.split('.')[-1] + str(i) })
+        return { 'flags': 0, 'results': { 'id1': 0, 'id2': 0, 'fields': rows } }
+
+    # timeline
+    # msg=timeline: session counts of size equal width buckets over [time1, time2], non-empty buckets only. The where clause is ignored.
+    def timeline(self, params):
+        time1 = int(params.get('time1', BASE_TIME))
+        time2 = int(params.get('time2', BASE_TIME + self.sessions - 1))
+        size = max(int(params.get('size', 1) or 1), 1)
+        width = max((time2 - time1 + 1) // size, 1)
+        rows = []
+        for i in range(size):
+            lo = max(time1 + i * width, BASE_TIME)
+            hi = min(time1 + (i + 1) * width - 1 if i < size - 1 else time2, BASE_TIME + self.sessions - 1)
+            if hi >= lo:
+                rows.append({ 'id1': 0, 'id2': 0, 'count': hi - lo + 1, 'format': 32, 'flags': 0, 'group': 0, 'type': 'time', 'value': time1 + i * width })
+        return { 'flags': 0, 'results': { 'id1': 0, 'id2': 0, 'fields': rows } }
+
+    # packets
+    # /packets?sessions=...&render=pcap: a PCAP with one synthetic packet per existing session, in the order requested
+    def packets(self, params):
+        out = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+        for sid in (int(s) for s in params.get('sessions', '').split(',') if s.strip()):
+            if 1 <= sid <= self.sessions:
+                length = 60 + (sid * 2654435761 + self.seed) % 1400
+                out.append(struct.pack('<IIII', BASE_TIME + sid - 1, 0, length, length))
+                out.append(bytes((sid + i) & 255 for i in range(length)))
+        return b''.join(out)
+
+    # summary
+    # msg=summary: database bounds in the key=value string format NWDB uses
+    def summary(self, params):
+        return { 'flags': 0, 'string': 'mid1=1 mid2=%d sid1=1 sid2=%d time1=%d time2=%d' % (self.mid2, self.sessions, BASE_TIME, BASE_TIME + self.sessions - 1) }
+
+
+class MockNWDBRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    db = None
+    # Honour Accept-Encoding (zstd, gzip) like an NWDB behind a compressing proxy
+    compress = False
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = { k: v[0] for k, v in parse_qs(url.query).items() }
+        if url.path.rstrip('/').endswith('/packets'):
+            if self.db.latency:
+                time.sleep(self.db.latency)
+            self.reply(200, self.db.packets(params), 'application/vnd.tcpdump.pcap')
+            return
+        msg = params.get('msg', '')
+        if msg not in MESSAGES:
+            self.reply(400, { 'flags': 0, 'string': 'Unsupported message: ' + msg })
+            return
+        if self.db.latency:
+            time.sleep(self.db.latency)
+        self.reply(200, getattr(self.db, msg)(params))
+
+    do_POST = do_GET
+
+    def reply(self, status, payload, contentType='application/json'):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        encoding = self.contentEncoding()
+        if encoding == 'zstd':
+            body = zstandard.ZstdCompressor(level=3).compress(body)
+        elif encoding == 'gzip':
+            body = gzip.compress(body, 6)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    # contentEncoding
+    # Encoding to apply to the response body, None when compression is off or the client accepts none we can produce
+    def contentEncoding(self):
+        if not self.compress:
+            return None
+        accepted = [e.split(';')[0].strip() for e in self.headers.get('Accept-Encoding', '').split(',')]
+        if 'zstd' in accepted and zstandard is not None:
+            return 'zstd'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+
+# start
+# Serve a SyntheticNWDB on a background thread. Returns the server; its URL is http://host:server.server_address[1]/sdk
+# @param db SyntheticNWDB to serve
+# @param host Interface to bind
+# @param port Port to bind, 0 picks a free port
+# @param compress Compress responses for clients sending Accept-Encoding
+def start(db, host='127.0.0.1', port=0, compress=False):
+    handler = type('BoundMockNWDBRequestHandler', (MockNWDBRequestHandler,), { 'db': db, 'compress': compress })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-nwdb', daemon=True).start()
+    return server
+
+
+# main
+# Command-line driver to run the mock NWDB in the foreground
+def main():
+    parser = argparse.ArgumentParser(prog='mock_nwdb.py', description='Local mock of the NWDB RESTful API serving synthetic sessions')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50103)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--fields', type=int, default=8)
+    parser.add_argument('--multi-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compress', action='store_true', help='Compress responses (zstd/gzip) per the Accept-Encoding header')
+    parser.add_argument('--rate', type=int, default=0, help='Sessions ingested per second after startup, for continuous queries')
+    args = parser.parse_args()
+
+    db = SyntheticNWDB(args.sessions, args.fields, args.multi_rate, args.latency, args.seed)
+    server = start(db, args.host, args.port, args.compress)
+    print(f"Mock NWDB serving {db.sessions} sessions ({db.mid2} meta) on http://{args.host}:{server.server_address[1]}/sdk")
+    try:
+        while True:
+            time.sleep(1 if args.rate else 3600)
+            db.append(args.rate)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  run_bench.py:
+
+  Benchmark suite for NWHandler, the Flask endpoints and SparkHandler against the local mock NWDB (mock_nwdb.py). Reports throughput, p50/p99 latency and peak RSS per benchmark.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, REPO_DIR]
+
+import mock_nwdb
+
+# Benchmarks in run order; each runs in its own interpreter so peak RSS is per benchmark
+BENCHMARKS = ('processNetwitnessMeta', 'pivotRows', 'NWGenerate', 'queryNWDB', 'queryNWDBAggregate', 'flask', 'spark')
+
+
+# percentile
+# Nearest-rank percentile of a sorted list of latencies
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+# timed
+# Call fn iterations times, returning (latencies, items) where items is the sum of what fn returns (sessions, rows, ...)
+def timed(fn, iterations):
+    latencies = []
+    items = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        items += fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies, items
+
+
+# writeConfig
+# Write a nwhandler_config.yaml pointing at the mock, with the result cache off so every call reaches NWDB
+# @param port Port of the running mock NWDB
+def writeConfig(port):
+    with open(os.path.join(REPO_DIR, 'NetWitnessHandler', 'nwhandler_config.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['netwitness']['settings'].update({ 'host': '127.0.0.1', 'port': str(port), 'path': 'sdk', 'ssl': 'disabled' })
+    config['netwitness']['services'] = []
+    config['netwitness']['cache'] = { 'enabled': False }
+    fd, path = tempfile.mkstemp(prefix='nwbench-', suffix='.yaml')
+    with os.fdopen(fd, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def benchProcessMeta(args, confloc):
+    from NetWitnessHandler.NetWitnessHandler import NWHandler
+    handler = NWHandler(confloc)
+    db = mock_nwdb.SyntheticNWDB(args.sessions, args.fields, args.multi_rate, 0, args.seed)
+    meta = db.query({ 'query': args.query, 'size': args.records * (len(db.fields) + 1) })
+
+    def run():
+        sessions = []
+        handler.processNetwitnessMeta(meta, sessions, args.records)
+        return len(sessions)
+    return timed(run, args.iterations)
+
+
+def benchPivotRows(args, confloc):
+    from NetWitnessHandler.NetWitnessHandler import NWHandler
+    handler = NWHandler(confloc)
+    db = mock_nwdb.SyntheticNWDB(args.sessions, args.fields, args.multi_rate, 0, args.seed)
+    meta = db.query({ 'query': args.query, 'size': args.records * (len(db.fields) + 1) })
+    if isinstance(meta, dict):
+        meta = [meta]
+
+    def run():
+        state = {}
+        sessions = handler.pivotRows(handler.pageFields(meta, {}), state)
+        return len(sessions) + (state.get('group') is not None)
+    return timed(run, args.iterations)
+
+
+def benchNWGenerate(args, confloc):
+    from NetWitnessHandler.NetWitnessHandler import NWHandler
+    handler = NWHandler(confloc)
+    return timed(lambda: len(handler.NWGenerate(args.query)), args.iterations)
+
+
+def benchQueryNWDB(args, confloc):
+    from NetWitnessHandler.NetWitnessHandler import NWHandler
+    handler = NWHandler(confloc)
+    return timed(lambda: len(handler.queryNWDB(args.query, args.records)), args.iterations)
+
+
+def benchAggregate(args, confloc):
+    from NetWitnessHandler.NetWitnessHandler import NWHandler
+    handler = NWHandler(confloc)
+    fields = ['ip.src', 'ip.dst', 'service']
+    return timed(lambda: sum(len(v) for v in handler.queryNWDBAggregate('service exists', 20, fields).values()), args.iterations)
+
+
+# benchFlask
+# Serve nwrest-api.py on a threaded werkzeug server and drive /api/queryNWDB with args.concurrency concurrent clients
+def benchFlask(args, confloc):
+    import requests
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    os.environ['NWHANDLER_CONFIG'] = confloc
+    os.chdir(REPO_DIR)
+    spec = importlib.util.spec_from_file_location('nwrest_api', os.path.join(REPO_DIR, 'nwrest-api.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    quiet = type('QuietRequestHandler', (WSGIRequestHandler,), { 'log_request': lambda self, *a: None })
+    server = make_server('127.0.0.1', 0, module.app, threaded=True, request_handler=quiet)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:' + str(server.server_port) + '/api/queryNWDB'
+    local = threading.local()
+
+    def request(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        response = session.post(url, json={ 'query': args.query, 'records': args.records, 'stream': 'ndjson' })
+        items = response.content.count(b'\n')
+        return time.perf_counter() - start, items
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(request, range(args.iterations * args.concurrency)))
+    server.shutdown()
+    return [r[0] for r in results], sum(r[1] for r in results)
+
+
+# benchSpark
+# Pivot the mock NWDB through SparkHandler.readNWDB() on a local[*] Spark session; skipped when pyspark isn't installed
+def benchSpark(args, confloc):
+    try:
+        import pyspark
+    except ImportError:
+        return None
+    from NetWitnessHandler.SparkHandler import SparkHandler
+    handler = SparkHandler(confloc)
+    handler.spark = pyspark.sql.SparkSession.builder.appName('NWAPI-bench').master('local[*]').getOrCreate()
+    try:
+        return timed(lambda: handler.readNWDB(args.query, args.partitions).count(), args.iterations)
+    finally:
+        handler.sparkStop()
+
+
+BENCH_FUNCTIONS = {
+    'processNetwitnessMeta': benchProcessMeta,
+    'pivotRows': benchPivotRows,
+    'NWGenerate': benchNWGenerate,
+    'queryNWDB': benchQueryNWDB,
+    'queryNWDBAggregate': benchAggregate,
+    'flask': benchFlask,
+    'spark': benchSpark
+}
+
+
+# runOne
+# Run a single benchmark in this process and print its result as one JSON line
+def runOne(args):
+    start = time.perf_counter()
+    measured = BENCH_FUNCTIONS[args.run](args, args.config)
+    elapsed = time.perf_counter() - start
+    if measured is None:
+        print(json.dumps({ 'name': args.run, 'skipped': True }))
+        return
+    latencies, items = measured
+    latencies.sort()
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+    print(json.dumps({
+        'name': args.run,
+        'calls': len(latencies),
+        'items': items,
+        'items_per_sec': items / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': rss_mb
+    }))
+
+
+# runAll
+# Start the mock NWDB, then run every selected benchmark in a child interpreter against it
+def runAll(args, argv):
+    db = mock_nwdb.SyntheticNWDB(args.sessions, args.fields, args.multi_rate, args.latency, args.seed)
+    server = mock_nwdb.start(db, compress=args.compress)
+    confloc = writeConfig(server.server_address[1])
+    results = []
+    try:
+        for name in args.only or BENCHMARKS:
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', name, '--config', confloc] + argv,
+                                  stdout=subprocess.PIPE, universal_newlines=True)
+            lines = [l for l in proc.stdout.splitlines() if l.startswith('{')]
+            if proc.returncode or not lines:
+                results.append({ 'name': name, 'error': 'exit status ' + str(proc.returncode) })
+            else:
+                results.append(json.loads(lines[-1]))
+    finally:
+        server.shutdown()
+        os.remove(confloc)
+
+    print(f"{'benchmark':<22}{'calls':>7}{'items/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}")
+    for r in results:
+        if 'calls' in r:
+            print(f"{r['name']:<22}{r['calls']:>7}{r['items_per_sec']:>12.0f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_rss_mb']:>13.1f}")
+        else:
+            print(f"{r['name']:<22}  " + ('skipped' if r.get('skipped') else r['error']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+# main
+# Command-line driver for the benchmark suite
+def main():
+    parser = argparse.ArgumentParser(prog='run_bench.py', description='Benchmark NWHandler, the REST endpoints and SparkHandler against a local mock NWDB')
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--fields', type=int, default=8)
+    parser.add_argument('--multi-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the mock adds to every NWDB response')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compress', action='store_true', help='Have the mock compress its responses per Accept-Encoding')
+    parser.add_argument('--records', type=int, default=5000, help='Sessions requested per call')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients for the flask benchmark')
+    parser.add_argument('--partitions', type=int, default=4, help='Partitions for the spark benchmark')
+    parser.add_argument('--query', default='select *')
+    parser.add_argument('--only', nargs='*', choices=BENCHMARKS, help='Run only these benchmarks')
+    parser.add_argument('--json', help='Also write the results to this JSON file', metavar='<path>')
+    parser.add_argument('--run', choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    if args.run:
+        runOne(args)
+    else:
+        # Children get the same workload options, minus the orchestration ones
+        argv = []
+        for key in ('sessions', 'fields', 'multi_rate', 'seed', 'records', 'iterations', 'concurrency', 'partitions', 'query'):
+            argv += ['--' + key.replace('_', '-'), str(getattr(args, key))]
+        runAll(args, argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,18 @@ __maintainer__ = "Wes Riley"
 __email__ = "elysian.blue@gmail.com"
 __status__ = "Development"
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request, stream_with_context
 from flask_restx import Api, Resource, reqparse, fields, marshal
 import NetWitnessHandler.NetWitnessHandler as NWHandler
+import NetWitnessHandler.AsyncNWHandler as AsyncNWHandler
+from NetWitnessHandler.NWJobManager import NWJobManager, NWJobLimitError
+from NetWitnessHandler.NWContent import NWContent, PCAP_MIMETYPE
+from NetWitnessHandler.NWTail import NWTailManager, NWTailLimitError
+from NetWitnessHandler.NWGraph import GRAPHML_MIMETYPE
+from NetWitnessHandler.NWEncoding import NWEncoding, packMsgpack, packArrow, JSON_MIMETYPE, NDJSON_MIMETYPE, MSGPACK_MIMETYPE, ARROW_MIMETYPE
+from NetWitnessHandler.NWMetrics import METRICS
+from NetWitnessHandler.NWQuery import NWQueryError
+import os
 import time
 import sys
 import json
@@ -31,10 +40,146 @@ parser.add_argument('query', location='json')
 
 nwdbQuery = api.model('nwdbQuery', {
     'query': fields.String(required=True),
+    'records': fields.Integer(required=False, default=1000),
+    'stream': fields.String(required=False, description='Stream sessions as they arrive from NWDB: "ndjson", "json" (array) or "msgpack"')
+})
+
+# Sessions requested per NWDB window when streaming
+STREAM_PAGE_SIZE = 1000
+
+nwdbJob = api.model('nwdbJob', {
+    'query': fields.String(required=True),
+    'records': fields.Integer(required=False, description='Max number of sessions to fetch (defaults to all, capped by validation.max_records)')
+})
+
+nwdbTimeline = api.model('nwdbTimeline', {
+    'where': fields.String(required=False, description='WHERE clause selecting the sessions to count (defaults to all)'),
+    'start': fields.String(required=True, description='Epoch seconds or "YYYY-mon-DD HH:MM:SS"'),
+    'end': fields.String(required=False, description='Epoch seconds or "YYYY-mon-DD HH:MM:SS" (defaults to now)'),
+    'bucket': fields.Integer(required=False, description='Bucket width in seconds (adaptive when omitted)')
+})
+
+nwdbTail = api.model('nwdbTail', {
+    'query': fields.String(required=True),
+    'cursor': fields.Raw(required=False, description='Cursor returned by the previous poll, omitted to start now')
+})
+
+nwdbGraph = api.model('nwdbGraph', {
+    'where': fields.String(required=False, description='WHERE clause selecting the sessions (defaults to all)'),
+    'src': fields.String(required=False, default='ip.src', description='Meta key of the edge sources'),
+    'dst': fields.String(required=False, default='ip.dst', description='Meta key of the edge destinations'),
+    'weight': fields.String(required=False, default='size', description='Meta key summed per edge as bytes, empty to only count sessions'),
+    'records': fields.Integer(required=False, description='Max number of sessions (defaults to all, capped by validation.max_records)'),
+    'format': fields.String(required=False, description='"json" (networkx node-link) or "graphml"'),
+    'min_count': fields.Integer(required=False, description='Drop edges with fewer sessions'),
+    'min_bytes': fields.Integer(required=False, description='Drop edges with fewer bytes'),
+    'min_degree': fields.Integer(required=False, description='Drop nodes with fewer edges'),
+    'top_edges': fields.Integer(required=False, description='Keep only this many of the heaviest edges')
+})
+
+nwdbBatch = api.model('nwdbBatch', {
+    'queries': fields.List(fields.String, required=True),
     'records': fields.Integer(required=False, default=1000)
 })
 
-nwdb = NWHandler.NWHandler('./NetWitnessHandler/nwhandler_config.yaml', debug)
+# NWHANDLER_CONFIG overrides the config location, e.g. to point the app at bench/mock_nwdb.py
+confloc = os.environ.get('NWHANDLER_CONFIG', './NetWitnessHandler/nwhandler_config.yaml')
+
+nwdb = NWHandler.NWHandler(confloc, debug)
+# Shared asyncio handler; its event loop runs on a background thread so request threads only wait on results, never on NWDB sockets
+nwdbAsync = AsyncNWHandler.AsyncRunner(AsyncNWHandler.AsyncNWHandler(nwdb))
+# Background jobs for long running queries, spooled to local disk
+jobs = NWJobManager(nwdb, nwdb.config['netwitness'].get('jobs'), debug)
+# Session content (PCAP) downloads, spooled to local disk in batches
+content = NWContent(nwdb, nwdb.config['netwitness'].get('content'), debug)
+# Continuous queries: one shared NWDB poller per distinct query, fanned out to SSE subscribers
+tail = NWTailManager(nwdb, nwdb.config['netwitness'].get('tail'), debug)
+METRICS.collector('tail', tail.stats)
+# Local session store: sync its hunt queries in the background when enabled
+if nwdb.store:
+    nwdb.store.start()
+# Response content encodings (gzip/zstd) and binary serializations (MessagePack, Arrow IPC)
+encoding = NWEncoding(nwdb.config['netwitness'].get('compression'))
+
+@app.before_request
+def startTiming():
+    g.requestStart = time.perf_counter()
+    g.metricsToken = METRICS.startRequest()
+    nwdb.serviceReport(clear=True)
+
+# recordTiming
+# Record the request latency per endpoint and, when metrics.server_timing is enabled, report the request's phase totals in a Server-Timing header. Streamed bodies are still being produced at this point, so only the phases before the first byte are included for them.
+@app.after_request
+def recordTiming(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    METRICS.observe('nwapi_request_seconds', time.perf_counter() - g.requestStart, endpoint=endpoint, status=str(response.status_code))
+    header = METRICS.endRequest(g.get('metricsToken'))
+    if header:
+        response.headers['Server-Timing'] = header
+    return response
+
+# reportServices
+# Tell the client which services answered a distributed query: X-NW-Services maps every service to its status, and X-NW-Partial is set when any of them failed or timed out (such results are not cached)
+@app.after_request
+def reportServices(response):
+    report = nwdb.serviceReport()
+    if report:
+        response.headers['X-NW-Services'] = json.dumps({ name: svc['status'] for name, svc in report['services'].items() }, separators=(',', ':'))
+        response.headers['X-NW-Partial'] = 'true' if report['partial'] else 'false'
+    return response
+
+# compressResponse
+# Content-encode the response with the best of the client's Accept-Encoding that compression.encodings offers. Buffered bodies under compression.min_size are left alone; streamed bodies are compressed as they are produced. Registered after recordTiming so it runs first and its time is in the Server-Timing header.
+@app.after_request
+def compressResponse(response):
+    if response.direct_passthrough or 'Content-Encoding' in response.headers or response.status_code in (204, 206, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    contentEncoding = request.accept_encodings.best_match(encoding.encodings)
+    if not contentEncoding:
+        return response
+    if response.is_streamed:
+        if not encoding.compressible(response.mimetype):
+            return response
+        response.response = encoding.compressStream(response.response, contentEncoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if not encoding.compressible(response.mimetype, len(data)):
+            return response
+        with METRICS.timer(request.url_rule.rule if request.url_rule else 'unmatched', 'compress'):
+            response.set_data(encoding.compress(data, contentEncoding))
+    response.headers['Content-Encoding'] = contentEncoding
+    return response
+
+# inputErrors
+# True when a handler result is the [{ 'error': ..., 'type': 'input' }] list returned for a rejected query
+def inputErrors(result):
+    return isinstance(result, list) and len(result) > 0 and isinstance(result[0], dict) and result[0].get('type') == 'input'
+
+# badRequest
+# 400 response carrying a handler's input error list
+def badRequest(errors):
+    response = jsonify(errors)
+    response.status_code = 400
+    return response
+
+# serializeTimed
+# Serialize an endpoint's result as JSON, MessagePack or (for session lists) Arrow IPC per the Accept header, recording the serialize phase
+# @param endpoint Endpoint path used as the metric's op label
+# @param payload Result to serialize
+# @param tabular True when payload is a list of sessions
+def serializeTimed(endpoint, payload, tabular=False):
+    mimetype = request.accept_mimetypes.best_match(encoding.formats(tabular), default=JSON_MIMETYPE)
+    with METRICS.timer(endpoint, 'serialize'):
+        if mimetype == MSGPACK_MIMETYPE:
+            response = Response(packMsgpack(payload), mimetype=MSGPACK_MIMETYPE)
+        elif mimetype == ARROW_MIMETYPE:
+            response = Response(packArrow(payload), mimetype=ARROW_MIMETYPE)
+        else:
+            response = jsonify(payload)
+    response.vary.add('Accept')
+    return response
 
 @api.route('/api/queryNWDB')
 class QueryNWDB(Resource):
@@ -53,11 +198,64 @@ class QueryNWDB(Resource):
             response = "{ \"Error\": \"No value for \"query\" parameter.\" }"
             return response
 
-        response = jsonify(nwdb.NWGenerate(resData['query']))
-        if debug:
-            print(json.loads(response.get_data()))
-            print(str(type(response.get_data())))
-        return json.dumps(response.get_json())
+        try:
+            records = int(resData.get('records') or 1000)
+        except (TypeError, ValueError):
+            return badRequest(nwdb.inputError(NWQueryError('records must be an integer')))
+        mode = streamMode(resData)
+        if mode:
+            # Validate up front: once streaming has started the status code can no longer change
+            try:
+                query, records = nwdb.checkQuery(resData.get('query'), records)
+            except NWQueryError as e:
+                return badRequest(nwdb.inputError(e))
+            return streamSessions(query, records, mode)
+        result = nwdb.queryNWDB(resData.get('query'), records)
+        if inputErrors(result):
+            return badRequest(result)
+        return serializeTimed('/api/queryNWDB', result, tabular=True)
+
+# streamMode
+# Pick the streaming response format from the 'stream' body parameter / query arg or the Accept header, None for a buffered response
+# @param reqData Parsed JSON request body
+def streamMode(reqData):
+    mode = reqData.get('stream') or request.args.get('stream')
+    if mode:
+        mode = str(mode).lower()
+        if mode in ('json', 'array'):
+            return 'json'
+        return 'msgpack' if mode == 'msgpack' and MSGPACK_MIMETYPE in encoding.formats() else 'ndjson'
+    if request.accept_mimetypes.best == NDJSON_MIMETYPE:
+        return 'ndjson'
+    return None
+
+# streamSessions
+# Stream up to records sessions as NDJSON, a JSON array or consecutive MessagePack maps while pages arrive from NWDB, serializing each session exactly once. The sessions and their keys are the ones a buffered request gets from queryNWDB(); with several services configured that merged result is gathered before the response starts, so it carries the X-NW-Services headers, and then streamed.
+# @param query Query to send to NWDB
+# @param records Max number of sessions to stream
+# @param mode 'ndjson', 'json' or 'msgpack'
+def streamSessions(query, records, mode):
+    merged = nwdb.queryNWDB(query, records) if len(nwdb.services) > 1 else None
+
+    def generate():
+        sent = 0
+        if mode == 'json':
+            yield '['
+        sessions = merged if merged is not None else nwdb.iter_sessions(query, min(records, STREAM_PAGE_SIZE))
+        for session in sessions:
+            if sent >= records:
+                break
+            if mode == 'json':
+                yield (',' if sent else '') + json.dumps(session)
+            elif mode == 'msgpack':
+                yield packMsgpack(session)
+            else:
+                yield json.dumps(session) + '\n'
+            sent += 1
+        if mode == 'json':
+            yield ']'
+    mimetype = { 'json': JSON_MIMETYPE, 'msgpack': MSGPACK_MIMETYPE }.get(mode, NDJSON_MIMETYPE)
+    return Response(stream_with_context(generate()), mimetype=mimetype)
     
 @api.route('/api/queryNWDBAggregate')
 class QueryNWDBAggregate(Resource):
@@ -70,10 +268,230 @@ class QueryNWDBAggregate(Resource):
             print(reqData)
             print(request.json)
             print(request)
-        response = jsonify(nwdb.queryNWDBAggregate(
-            reqData['query'], reqData['size'], reqData['field']))
-        return response
+        result = nwdb.queryNWDBAggregate(reqData.get('query'), reqData.get('size'), reqData.get('field'), reqData.get('exact', False))
+        if inputErrors(result):
+            return badRequest(result)
+        return serializeTimed('/api/queryNWDBAggregate', result)
     
+@api.route('/api/timeline')
+class Timeline(Resource):
+    @api.doc(body=nwdbTimeline)
+    def post(self):
+        reqData = request.get_json(force=True)
+        if not reqData or reqData.get('start') is None:
+            return badRequest([{ 'error': 'No value for "start" parameter.', 'type': 'input' }])
+        bucket = reqData.get('bucket')
+        try:
+            bucket = int(bucket) if bucket else None
+        except (TypeError, ValueError):
+            return badRequest([{ 'error': 'Bucket width must be a number of seconds', 'type': 'input' }])
+        result = nwdb.timeline(reqData.get('where'), reqData['start'], reqData.get('end'), bucket)
+        if inputErrors(result):
+            return badRequest(result)
+        return serializeTimed('/api/timeline', result)
+
+@api.route('/api/graph')
+class Graph(Resource):
+    # post
+    # Communication graph of the sessions the where clause selects, src -> dst edges carrying session counts and byte sums, pruned server side and returned as networkx node-link JSON or GraphML
+    @api.doc(body=nwdbGraph)
+    def post(self):
+        # Every parameter is optional: an empty body graphs ip.src -> ip.dst over all sessions
+        reqData = request.get_json(force=True, silent=True) or {}
+        try:
+            limits = [int(reqData.get(k) or 0) for k in ('records', 'min_count', 'min_bytes', 'min_degree', 'top_edges')]
+        except (TypeError, ValueError):
+            return badRequest([{ 'error': 'records, min_count, min_bytes, min_degree and top_edges must be numbers', 'type': 'input' }])
+        try:
+            table = nwdb.graph(reqData.get('where'), reqData.get('src') or 'ip.src', reqData.get('dst') or 'ip.dst', reqData.get('weight', 'size') or None, limits[0] or None)
+        except NWQueryError as e:
+            return badRequest(nwdb.inputError(e))
+        graph = table.toNetworkx(table.prune(*limits[1:]))
+        fmt = str(reqData.get('format') or '').lower()
+        if fmt == 'graphml' or (not fmt and request.accept_mimetypes.best == GRAPHML_MIMETYPE):
+            with METRICS.timer('/api/graph', 'serialize'):
+                response = Response(''.join(nx.generate_graphml(graph)), mimetype=GRAPHML_MIMETYPE)
+            return response
+        return serializeTimed('/api/graph', nx.node_link_data(graph))
+
+# namedService
+# URL of the configured service called name, the default service when name is empty, None when unknown
+def namedService(name):
+    if not name:
+        return nwdb.url
+    return next((svc['url'] for svc in nwdb.services if svc['name'] == name), None)
+
+@api.route('/api/content')
+class Content(Resource):
+    # get
+    # Stream the PCAP of the sessions listed in 'sessions' (comma separated ids) or selected by 'where' from the service named by 'service'. A single byte range is answered with 206 once the batches up to its end are spooled; batches past it aren't fetched, and the total length is reported as '*' until they are. Open ended and suffix ranges need the total length, so they wait for every batch. The ETag identifies the session set, so an If-Range resume only gets a partial response if the selection hasn't changed.
+    @api.doc(params={ 'sessions': 'Comma separated session ids', 'where': 'WHERE clause selecting the sessions (when no ids are given)', 'service': 'Service name (defaults to the configured service)' })
+    def get(self):
+        url = namedService(request.args.get('service'))
+        if url is None:
+            return badRequest([{ 'error': 'Unknown service ' + request.args.get('service'), 'type': 'input' }])
+        try:
+            ids = content.resolve(request.args.get('sessions'), request.args.get('where'), url)
+        except NWQueryError as e:
+            return badRequest(nwdb.inputError(e))
+        etag = content.key(ids, url)
+        ranged = request.range is not None and len(request.range.ranges) == 1 and (request.if_range.etag is None or request.if_range.etag == etag) and request.if_range.date is None
+        if ranged:
+            begin, end = request.range.ranges[0]
+            try:
+                parts, length = content.prepare(ids, url, end if begin >= 0 and end is not None else None)
+            except requests.RequestException as e:
+                response = jsonify({ 'error': str(e) })
+                response.status_code = 502
+                return response
+            if length is None:
+                # Spooling stopped once the range was covered, so the range is satisfiable as requested
+                start, stop = begin, end
+            else:
+                rng = request.range.range_for_length(length)
+                if rng is None:
+                    response = Response(status=416)
+                    response.headers['Content-Range'] = 'bytes */' + str(length)
+                    return response
+                start, stop = rng
+            response = Response(content.streamRange(parts, start, stop), status=206, mimetype=PCAP_MIMETYPE, direct_passthrough=True)
+            response.headers['Content-Range'] = 'bytes ' + str(start) + '-' + str(stop - 1) + '/' + ('*' if length is None else str(length))
+            response.headers['Content-Length'] = str(stop - start)
+        else:
+            response = Response(content.stream(ids, url), mimetype=PCAP_MIMETYPE, direct_passthrough=True)
+            length = content.length(ids, url)
+            if length is not None:
+                response.headers['Content-Length'] = str(length)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['ETag'] = '"' + etag + '"'
+        response.headers['Content-Disposition'] = 'attachment; filename=nwapi-' + etag[:12] + '.pcap'
+        return response
+
+@api.route('/api/tail')
+class Tail(Resource):
+    # get
+    # Server-Sent Events stream of the sessions matching 'query' as they arrive in NWDB. Subscribers to the same query share one poller. Each 'sessions' event carries a JSON array of sessions and the cursor as its id, so a reconnecting EventSource resumes through Last-Event-ID.
+    @api.doc(params={ 'query': 'Query to follow' })
+    def get(self):
+        try:
+            sub = tail.subscribe(request.args.get('query'), request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+        except NWQueryError as e:
+            return badRequest(nwdb.inputError(e))
+        except NWTailLimitError as e:
+            response = jsonify({ 'error': str(e) })
+            response.status_code = 503
+            return response
+        response = Response(tail.events(sub), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # post
+    # Incremental poll: the sessions that arrived since 'cursor' and the cursor for the next poll
+    @api.doc(body=nwdbTail)
+    def post(self):
+        reqData = request.get_json(force=True)
+        if not reqData:
+            return badRequest([{ 'error': 'No data in request.', 'type': 'input' }])
+        cursor = reqData.get('cursor')
+        if cursor is not None and (not isinstance(cursor, dict) or not all(isinstance(v, int) for v in cursor.values())):
+            return badRequest([{ 'error': 'Cursor must be an object of service: meta id', 'type': 'input' }])
+        try:
+            result = nwdb.tail(reqData.get('query'), cursor, STREAM_PAGE_SIZE, int(tail.settings['max_lag']))
+        except NWQueryError as e:
+            return badRequest(nwdb.inputError(e))
+        return serializeTimed('/api/tail', result)
+
+@api.route('/api/store')
+class Store(Resource):
+    # get
+    # Coverage window (since .. watermark, epoch seconds) and session count of each query synced to the local session store
+    def get(self):
+        if not nwdb.store:
+            api.abort(404, 'The local session store is not enabled')
+        return jsonify(nwdb.store.status())
+
+@api.route('/api/queryNWDBBatch')
+class QueryNWDBBatch(Resource):
+    @api.doc(body=nwdbBatch)
+    def post(self):
+        reqData = request.get_json(force=True)
+        if not reqData or not reqData.get('queries'):
+            response = { "Error": "No value for \"queries\" parameter." }
+            return response, 400
+        records = reqData.get('records', 1000)
+        calls = [('aqueryNWDB', (query, records)) for query in reqData['queries']]
+        results = nwdbAsync.run(nwdbAsync.handler.gather(calls))
+        response = []
+        for query, result in zip(reqData['queries'], results):
+            if isinstance(result, Exception):
+                response.append({ 'query': query, 'error': str(result) })
+            elif inputErrors(result):
+                response.append({ 'query': query, 'error': result[0]['error'] })
+            else:
+                response.append({ 'query': query, 'sessions': result })
+        return serializeTimed('/api/queryNWDBBatch', response)
+
+@api.route('/api/jobs')
+class Jobs(Resource):
+    def get(self):
+        return jsonify([job.toDict() for job in jobs.list()])
+
+    @api.doc(body=nwdbJob)
+    def post(self):
+        reqData = request.get_json(force=True)
+        if not reqData:
+            return badRequest([{ 'error': 'No data in request.', 'type': 'input' }])
+        records = reqData.get('records')
+        try:
+            job = jobs.submit(reqData.get('query'), int(records) if records else None)
+        except NWQueryError as e:
+            return badRequest(nwdb.inputError(e))
+        except NWJobLimitError as e:
+            response = jsonify({ 'error': str(e) })
+            response.status_code = 503
+            return response
+        response = jsonify(job.toDict())
+        response.status_code = 202
+        response.headers['Location'] = '/api/jobs/' + job.id
+        return response
+
+@api.route('/api/jobs/<string:job_id>')
+class Job(Resource):
+    def get(self, job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            api.abort(404, 'Unknown job ' + job_id)
+        return jsonify(job.toDict())
+
+    # delete
+    # Cancel the job if it is still queued or running and remove its spooled results
+    def delete(self, job_id):
+        if not jobs.delete(job_id):
+            api.abort(404, 'Unknown job ' + job_id)
+        return jsonify({ 'id': job_id, 'deleted': True })
+
+@api.route('/api/jobs/<string:job_id>/results')
+class JobResults(Resource):
+    # get
+    # Return the job's sessions as NDJSON. 'offset' skips that many chunks; 'follow=true' keeps the response open, streaming chunks as they are spooled, until the job ends.
+    def get(self, job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            api.abort(404, 'Unknown job ' + job_id)
+        offset = request.args.get('offset', 0, type=int)
+        follow = request.args.get('follow', 'false').lower() in ('1', 'true', 'yes')
+        response = Response(stream_with_context(jobs.results(job, offset, follow)), mimetype='application/x-ndjson')
+        response.headers['X-Job-Status'] = job.status
+        response.headers['X-Job-Fetched'] = str(job.fetched)
+        return response
+
+# metrics
+# Prometheus scrape endpoint: phase and operation histograms, NWDB response sizes and cache/pool gauges
+@app.route('/metrics')
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/app')
 def frontEnd():
     return render_template('index.html', flask_token='nwrest-api')
@@ -0,0 +1,368 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  nwrest-async.py:
+
+  aiohttp server for the REST API in nwrest-api.py. /api/queryNWDB, /api/queryNWDBAggregate and /api/queryNWDBBatch run as coroutines on the AsyncNWHandler event loop, so a request waiting on NWDB holds no thread; every other route is served by the Flask app on a bounded thread pool.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import aiohttp
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from NetWitnessHandler.NWEncoding import packMsgpack, packArrow, JSON_MIMETYPE, NDJSON_MIMETYPE, MSGPACK_MIMETYPE, ARROW_MIMETYPE
+from NetWitnessHandler.NWMetrics import METRICS
+from NetWitnessHandler.NWQuery import NWQueryError
+
+
+# loadApi
+# Load nwrest-api.py (not importable by name) from next to this file
+def loadApi():
+    spec = importlib.util.spec_from_file_location('nwrest_api', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nwrest-api.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class NWAsyncServer:
+
+    # Constructor
+    # * The query endpoints mirror their Flask counterparts (parameters, status codes, serializations, compression, X-NW-Services and Server-Timing headers) but await the shared AsyncNWHandler instead of calling NWHandler.
+    # * The Flask routes share async.wsgi_threads threads, so a slow export or content download cannot starve the query endpoints.
+    # @param api Loaded nwrest-api.py module
+    # @param threads Thread pool size for the Flask routes, async.wsgi_threads when None
+    def __init__(self, api, threads=None):
+        self.api = api
+        self.nwdb = api.nwdb
+        self.handler = api.nwdbAsync.handler
+        self.loop = api.nwdbAsync.loop
+        self.encoding = api.encoding
+        self.pool = ThreadPoolExecutor(max_workers=int(threads or self.handler.async_settings['wsgi_threads']), thread_name_prefix='nwrest-wsgi')
+        self.runner = None
+
+    # application
+    # aiohttp application: the native routes first, then a catch-all handing everything else (including the GET of /api/queryNWDB) to Flask
+    def application(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/api/queryNWDB', self.queryNWDB)
+        app.router.add_post('/api/queryNWDBAggregate', self.queryNWDBAggregate)
+        app.router.add_post('/api/queryNWDBBatch', self.queryNWDBBatch)
+        app.router.add_route('*', '/{path:.*}', self.wsgi)
+        return app
+
+    # start
+    # Start serving on the AsyncNWHandler loop. Returns the bound (host, port) pairs.
+    def start(self, host='0.0.0.0', port=5000):
+        async def listen():
+            self.runner = web.AppRunner(self.application(), access_log=None)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, host, port).start()
+            return self.runner.addresses
+        return asyncio.run_coroutine_threadsafe(listen(), self.loop).result()
+
+    def stop(self):
+        if self.runner is not None:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.pool.shutdown(wait=False)
+
+    # * Native endpoints
+
+    # queryNWDB
+    # Coroutine version of the Flask /api/queryNWDB POST
+    async def queryNWDB(self, request):
+        token = self.begin()
+        reqData = await self.body(request)
+        if not reqData:
+            return self.finish(request, token, self.jsonResponse("{ \"Error\": \"No value for \"query\" parameter.\" }"))
+        try:
+            records = int(reqData.get('records') or 1000)
+        except (TypeError, ValueError):
+            return self.finish(request, token, self.jsonResponse(self.nwdb.inputError(NWQueryError('records must be an integer')), 400))
+        mode = self.streamMode(request, reqData)
+        try:
+            if mode:
+                try:
+                    query, records = self.nwdb.checkQuery(reqData.get('query'), records)
+                except NWQueryError as e:
+                    return self.finish(request, token, self.jsonResponse(self.nwdb.inputError(e), 400))
+                return await self.streamSessions(request, token, query, records, mode)
+            result = await self.handler.aqueryNWDB(reqData.get('query'), records)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return self.finish(request, token, self.jsonResponse({ 'error': str(e) }, 502))
+        if self.api.inputErrors(result):
+            return self.finish(request, token, self.jsonResponse(result, 400))
+        return self.finish(request, token, self.serialize(request, result, tabular=True))
+
+    # queryNWDBAggregate
+    # Coroutine version of the Flask /api/queryNWDBAggregate POST
+    async def queryNWDBAggregate(self, request):
+        token = self.begin()
+        reqData = await self.body(request)
+        if not reqData:
+            return self.finish(request, token, self.jsonResponse({ "Error": "No data in request." }))
+        try:
+            result = await self.handler.aqueryNWDBAggregate(reqData.get('query'), reqData.get('size'), reqData.get('field'), reqData.get('exact', False))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return self.finish(request, token, self.jsonResponse({ 'error': str(e) }, 502))
+        if self.api.inputErrors(result):
+            return self.finish(request, token, self.jsonResponse(result, 400))
+        return self.finish(request, token, self.serialize(request, result))
+
+    # queryNWDBBatch
+    # Coroutine version of the Flask /api/queryNWDBBatch POST
+    async def queryNWDBBatch(self, request):
+        token = self.begin()
+        reqData = await self.body(request)
+        if not reqData or not reqData.get('queries'):
+            return self.finish(request, token, self.jsonResponse({ "Error": "No value for \"queries\" parameter." }, 400))
+        records = reqData.get('records', 1000)
+        results = await self.handler.gather([('aqueryNWDB', (query, records)) for query in reqData['queries']])
+        response = []
+        for query, result in zip(reqData['queries'], results):
+            if isinstance(result, Exception):
+                response.append({ 'query': query, 'error': str(result) })
+            elif self.api.inputErrors(result):
+                response.append({ 'query': query, 'error': result[0]['error'] })
+            else:
+                response.append({ 'query': query, 'sessions': result })
+        return self.finish(request, token, self.serialize(request, response))
+
+    # streamSessions
+    # Coroutine version of streamSessions() in nwrest-api.py. With several services the merged result is awaited before the response starts, so it still carries the X-NW-Services headers.
+    async def streamSessions(self, request, token, query, records, mode):
+        if len(self.nwdb.services) > 1:
+            merged = await self.handler.aqueryNWDB(query, records)
+            sessions = self.iterate(merged)
+        else:
+            sessions = self.handler.aiter_sessions(query, min(records, self.api.STREAM_PAGE_SIZE))
+        mimetype = { 'json': JSON_MIMETYPE, 'msgpack': MSGPACK_MIMETYPE }.get(mode, NDJSON_MIMETYPE)
+        response = web.StreamResponse(headers={ 'Content-Type': mimetype })
+        self.finish(request, token, response)
+        contentEncoding = self.contentEncoding(request, mimetype)
+        compress = flush = finish = None
+        if contentEncoding:
+            compress, flush, finish = self.encoding.compressor(contentEncoding)
+            response.headers['Content-Encoding'] = contentEncoding
+            response.headers['Vary'] = 'Accept-Encoding'
+        await response.prepare(request)
+        pending = 0
+
+        async def write(chunk):
+            nonlocal pending
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if compress is not None:
+                pending += len(chunk)
+                chunk = compress(chunk)
+                if pending >= self.encoding.flush_bytes:
+                    chunk += flush()
+                    pending = 0
+            if chunk:
+                await response.write(chunk)
+
+        sent = 0
+        try:
+            if mode == 'json':
+                await write('[')
+            async for session in sessions:
+                if sent >= records:
+                    break
+                if mode == 'json':
+                    await write((',' if sent else '') + json.dumps(session))
+                elif mode == 'msgpack':
+                    await write(packMsgpack(session))
+                else:
+                    await write(json.dumps(session) + '\n')
+                sent += 1
+            if mode == 'json':
+                await write(']')
+        finally:
+            # Stop paging NWDB when the client goes away
+            await sessions.aclose()
+        if finish is not None:
+            await response.write(finish())
+        await response.write_eof()
+        return response
+
+    async def iterate(self, sessions):
+        for session in sessions:
+            yield session
+
+    # * Request helpers
+
+    def begin(self):
+        self.nwdb.serviceReport(clear=True)
+        return (time.perf_counter(), METRICS.startRequest())
+
+    # finish
+    # Record the request like the Flask after_request hooks do: latency per endpoint, Server-Timing and the service report headers. Streamed responses are finished before their body is produced.
+    def finish(self, request, token, response):
+        startTime, metricsToken = token
+        METRICS.observe('nwapi_request_seconds', time.perf_counter() - startTime, endpoint=request.path, status=str(response.status))
+        header = METRICS.endRequest(metricsToken)
+        if header:
+            response.headers['Server-Timing'] = header
+        report = self.nwdb.serviceReport()
+        if report:
+            response.headers['X-NW-Services'] = json.dumps({ name: svc['status'] for name, svc in report['services'].items() }, separators=(',', ':'))
+            response.headers['X-NW-Partial'] = 'true' if report['partial'] else 'false'
+        return response
+
+    # body
+    # Parsed JSON request body, None when it is missing or malformed (as request.get_json(force=True, silent=True) would give)
+    async def body(self, request):
+        try:
+            return json.loads(await request.read() or b'null')
+        except ValueError:
+            return None
+
+    def streamMode(self, request, reqData):
+        mode = reqData.get('stream') or request.query.get('stream')
+        if mode:
+            mode = str(mode).lower()
+            if mode in ('json', 'array'):
+                return 'json'
+            return 'msgpack' if mode == 'msgpack' and MSGPACK_MIMETYPE in self.encoding.formats() else 'ndjson'
+        if parse_accept_header(request.headers.get('Accept'), MIMEAccept).best == NDJSON_MIMETYPE:
+            return 'ndjson'
+        return None
+
+    # contentEncoding
+    # Best of the client's Accept-Encoding that compression.encodings offers for this mimetype and length, None to send the body as is
+    def contentEncoding(self, request, mimetype, length=None):
+        if not self.encoding.compressible(mimetype, length):
+            return None
+        return parse_accept_header(request.headers.get('Accept-Encoding')).best_match(self.encoding.encodings)
+
+    def jsonResponse(self, payload, status=200):
+        return web.Response(body=json.dumps(payload).encode('utf-8'), status=status, content_type=JSON_MIMETYPE)
+
+    # serialize
+    # Serialize a result as JSON, MessagePack or (for session lists) Arrow IPC per the Accept header and content-encode it, as serializeTimed() and compressResponse() do in nwrest-api.py
+    def serialize(self, request, payload, tabular=False):
+        mimetype = parse_accept_header(request.headers.get('Accept'), MIMEAccept).best_match(self.encoding.formats(tabular), default=JSON_MIMETYPE)
+        with METRICS.timer(request.path, 'serialize'):
+            if mimetype == MSGPACK_MIMETYPE:
+                data = packMsgpack(payload)
+            elif mimetype == ARROW_MIMETYPE:
+                data = packArrow(payload)
+            else:
+                data = (json.dumps(payload) + '\n').encode('utf-8')
+        headers = { 'Vary': 'Accept, Accept-Encoding' }
+        contentEncoding = self.contentEncoding(request, mimetype, len(data))
+        if contentEncoding:
+            with METRICS.timer(request.path, 'compress'):
+                data = self.encoding.compress(data, contentEncoding)
+            headers['Content-Encoding'] = contentEncoding
+        return web.Response(body=data, content_type=mimetype, headers=headers)
+
+    # * WSGI bridge
+
+    # wsgi
+    # Serve a request with the Flask app on the thread pool, streaming its body back as the app produces it
+    async def wsgi(self, request):
+        environ = self.environ(request, await request.read())
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+            return lambda data: None
+
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(self.pool, self.api.app, environ, start_response)
+        chunks = iter(body)
+        try:
+            chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+            response = web.StreamResponse(status=started['status'])
+            for key, value in started['headers']:
+                response.headers.add(key, value)
+            await response.prepare(request)
+            while chunk is not None:
+                if chunk:
+                    await response.write(chunk)
+                chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+            await response.write_eof()
+            return response
+        finally:
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(self.pool, body.close)
+
+    # environ
+    # WSGI environ of an aiohttp request
+    def environ(self, request, body):
+        host, _, port = request.host.partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(request.raw_path.split('?', 1)[0], 'latin-1'),
+            'QUERY_STRING': request.rel_url.raw_query_string,
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or ('443' if request.secure else '80'),
+            'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+            'REMOTE_ADDR': request.remote or '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for key, value in request.headers.items():
+            key = key.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            elif 'HTTP_' + key in environ:
+                environ['HTTP_' + key] += ',' + value
+            else:
+                environ['HTTP_' + key] = value
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+
+
+# main
+# Command-line driver serving the REST API until interrupted
+def main():
+    parser = argparse.ArgumentParser(prog='nwrest-async.py', description='Serve the NWAPI REST API with the query endpoints on asyncio')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=None, help='Threads serving the Flask routes (default: async.wsgi_threads)')
+    args = parser.parse_args()
+
+    api = loadApi()
+    server = NWAsyncServer(api, args.threads)
+    for address in server.start(args.host, args.port):
+        print('Serving NWAPI on http://%s:%s' % address[:2])
+    try:
+        api.nwdbAsync.thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        api.nwdbAsync.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  conftest.py:
+
+  Shared pytest fixtures: a mock NWDB (bench/mock_nwdb.py) serving synthetic sessions for the whole run, and factories for nwhandler_config.yaml files, NWHandler instances and the Flask app pointed at it.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import importlib.util
+import os
+import sys
+
+import pytest
+import yaml
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [os.path.join(REPO_DIR, 'bench'), REPO_DIR]
+
+import mock_nwdb
+import run_bench
+
+# Synthetic dataset served to every test; about one session in ten carries a second ip.dst value
+SESSIONS = 3000
+FIELDS = 8
+MULTI_RATE = 0.1
+
+
+@pytest.fixture(scope='session')
+def nwdb():
+    db = mock_nwdb.SyntheticNWDB(SESSIONS, FIELDS, MULTI_RATE)
+    server = mock_nwdb.start(db)
+    db.port = server.server_address[1]
+    yield db
+    server.shutdown()
+
+
+# makeConfig
+# Factory writing a nwhandler_config.yaml for the mock (result cache off, as run_bench.writeConfig() does), with the given sections of 'netwitness' replaced
+@pytest.fixture
+def makeConfig(nwdb):
+    paths = []
+
+    def make(**sections):
+        path = run_bench.writeConfig(nwdb.port)
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        config['netwitness'].update(sections)
+        with open(path, 'w') as f:
+            yaml.safe_dump(config, f)
+        paths.append(path)
+        return path
+    yield make
+    for path in paths:
+        os.remove(path)
+
+
+# makeHandler
+# Factory building an NWHandler against the mock, taking the config sections makeConfig() does
+@pytest.fixture
+def makeHandler(makeConfig):
+    from NetWitnessHandler.NetWitnessHandler import NWHandler
+    return lambda **sections: NWHandler(makeConfig(**sections))
+
+
+@pytest.fixture
+def handler(makeHandler):
+    return makeHandler()
+
+
+# app
+# nwrest-api.py loaded against the mock, with content spooled under a temporary directory in batches of 7 sessions. The module builds its handlers at import, so it is loaded once per run.
+@pytest.fixture(scope='session')
+def app(nwdb, tmp_path_factory):
+    path = run_bench.writeConfig(nwdb.port)
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    config['netwitness']['content'] = { 'batch_sessions': 7, 'spool_path': str(tmp_path_factory.mktemp('content')) }
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    os.environ['NWHANDLER_CONFIG'] = path
+    spec = importlib.util.spec_from_file_location('nwrest_api', os.path.join(REPO_DIR, 'nwrest-api.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    os.remove(path)
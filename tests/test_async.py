@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_async.py:
+
+  Tests of AsyncNWHandler against the mock NWDB (same results as NWHandler, retry of failed fetches) and of the nwrest-async.py server (query endpoints served without a thread per request, the other routes through Flask).
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import aiohttp
+import pytest
+
+from NetWitnessHandler.AsyncNWHandler import AsyncNWHandler, AsyncRunner
+from conftest import REPO_DIR
+
+DAY = 'time="2020-Jan-01 00:00:00"-"2020-Jan-02 00:00:00"'
+
+
+@pytest.fixture
+def runner(handler):
+    runner = AsyncRunner(AsyncNWHandler(handler))
+    yield runner
+    runner.stop()
+
+
+@pytest.fixture(scope='module')
+def server(app):
+    spec = importlib.util.spec_from_file_location('nwrest_async', os.path.join(REPO_DIR, 'nwrest-async.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # A single Flask thread: anything routed through it is served one request at a time
+    server = module.NWAsyncServer(app, threads=1)
+    host, port = server.start('127.0.0.1', 0)[0][:2]
+    server.base = 'http://%s:%d' % (host, port)
+    yield server
+    server.stop()
+    app.nwdbAsync.run(app.nwdbAsync.handler.close())
+
+
+def post(base, path, payloads, headers=None):
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            async def one(payload):
+                async with session.post(base + path, data=json.dumps(payload), headers=headers) as response:
+                    return response.status, dict(response.headers), await response.read()
+            return await asyncio.gather(*[one(payload) for payload in payloads])
+    return asyncio.run(run())
+
+
+def test_aquery_matches_sync(handler, runner):
+    assert runner.run(runner.handler.aqueryNWDB('select * where ' + DAY, 250)) == handler.queryNWDB('select * where ' + DAY, 250)
+    assert runner.run(runner.handler.aqueryNWDBAggregate(DAY, 5, 'ip.src')) == handler.queryNWDBAggregate(DAY, 5, 'ip.src')
+    results = runner.run(runner.handler.gather([('aqueryNWDB', ('select *', 10)), ('aqueryNWDB', ('select * where (a=1', 10))]))
+    assert results[0] == handler.queryNWDB('select *', 10)
+    assert results[1][0]['type'] == 'input'
+
+
+def test_fetch_retries_then_raises(handler):
+    hits = []
+
+    class Unavailable(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            body = b'<html>Service Unavailable</html>'
+            self.send_response(503)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    failing = ThreadingHTTPServer(('127.0.0.1', 0), Unavailable)
+    threading.Thread(target=failing.serve_forever, daemon=True).start()
+    handler.config['netwitness']['transport'] = { 'retries': 2, 'backoff_factor': 0 }
+    runner = AsyncRunner(AsyncNWHandler(handler))
+    try:
+        with pytest.raises(aiohttp.ClientResponseError) as e:
+            runner.run(runner.handler.fetch({ 'msg': 'query', 'query': 'select *' }, 'http://127.0.0.1:%d/sdk' % failing.server_address[1]))
+        assert e.value.status == 503
+        # The first attempt and two retries
+        assert len(hits) == 3
+    finally:
+        runner.stop()
+        failing.shutdown()
+
+
+def test_server_queries_do_not_hold_threads(nwdb, app, server):
+    nwdb.latency = 0.3
+    try:
+        # Distinct queries so none of them is coalesced with another
+        payloads = [{ 'query': 'select * where service=%d' % i, 'records': 5 } for i in range(12)]
+        startTime = time.perf_counter()
+        responses = post(server.base, '/api/queryNWDB', payloads)
+        elapsed = time.perf_counter() - startTime
+    finally:
+        nwdb.latency = 0
+    assert [status for status, headers, body in responses] == [200] * 12
+    assert all(len(json.loads(body)) == 5 for status, headers, body in responses)
+    # One Flask thread would take at least 12 * 0.3s
+    assert elapsed < 12 * 0.3 / 2
+
+
+def test_server_query_endpoints(app, server):
+    expected = app.nwdb.queryNWDB('select *', 20)
+    (status, headers, body), = post(server.base, '/api/queryNWDB', [{ 'query': 'select *', 'records': 20 }])
+    assert status == 200 and json.loads(body) == expected
+    (status, headers, body), = post(server.base, '/api/queryNWDB', [{ 'query': 'select *', 'records': 20, 'stream': 'ndjson' }])
+    assert status == 200 and headers['Content-Type'].startswith('application/x-ndjson')
+    assert [json.loads(line) for line in body.splitlines()] == expected
+    (status, headers, body), = post(server.base, '/api/queryNWDB', [{ 'query': 'select *', 'records': 'x' }])
+    assert status == 400 and json.loads(body)[0]['type'] == 'input'
+    (status, headers, body), = post(server.base, '/api/queryNWDBAggregate', [{ 'query': DAY, 'size': 3, 'field': 'ip.src' }])
+    assert status == 200 and json.loads(body) == json.loads(json.dumps(app.nwdb.queryNWDBAggregate(DAY, 3, 'ip.src')))
+    (status, headers, body), = post(server.base, '/api/queryNWDBBatch', [{ 'queries': ['select *', 'select * where (a=1'], 'records': 3 }])
+    assert status == 200 and [sorted(r) for r in json.loads(body)] == [['query', 'sessions'], ['error', 'query']]
+
+
+def test_server_bridges_flask_routes(server):
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(server.base + '/api/queryNWDB') as response:
+                return response.status, await response.json()
+    status, body = asyncio.run(run())
+    assert status == 200 and body['source'].endswith('QueryNWDB:get()')
+    (status, headers, body), = post(server.base, '/api/tail', [{ 'query': 'select *' }])
+    assert status == 200 and 'cursor' in json.loads(body)
@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_content.py:
+
+  Tests of the PCAP download path: spooled batches, byte ranges served from the spool before every batch is fetched, and the /api/content endpoint.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import os
+import struct
+
+import pytest
+
+from NetWitnessHandler.NWContent import NWContent, PCAP_HEADER_SIZE
+from NetWitnessHandler.NWQuery import NWQueryError
+
+IDS = list(range(1, 101))
+
+
+# packetCount
+# Number of packet records of a PCAP, asserting its records add up to its length
+def packetCount(data):
+    assert struct.unpack_from('<I', data, 0)[0] == 0xa1b2c3d4
+    offset = PCAP_HEADER_SIZE
+    count = 0
+    while offset < len(data):
+        offset += 16 + struct.unpack_from('<IIII', data, offset)[2]
+        count += 1
+    assert offset == len(data)
+    return count
+
+
+@pytest.fixture
+def content(handler, tmp_path):
+    return NWContent(handler, { 'batch_sessions': 7, 'max_workers': 2, 'spool_path': str(tmp_path) })
+
+
+def spooledFiles(content, ids, url):
+    return sum(1 for path, batchIds in content.batches(ids, url) if os.path.exists(path))
+
+
+def test_stream(content, handler):
+    data = b''.join(content.stream(IDS, handler.url))
+    assert packetCount(data) == len(IDS)
+    assert content.length(IDS, handler.url) == len(data)
+    # Spooled batches are reused
+    assert b''.join(content.stream(IDS, handler.url)) == data
+
+
+def test_range_spools_only_what_it_needs(content, handler):
+    full = b''.join(NWContent(handler, { 'batch_sessions': 7, 'spool_path': content.spool_path + '-full' }).stream(IDS, handler.url))
+    parts, length = content.prepare(IDS, handler.url, 200)
+    # The first batch alone is several KB, so later batches stay unfetched and the total is unknown
+    assert length is None
+    assert spooledFiles(content, IDS, handler.url) < len(content.batches(IDS, handler.url))
+    assert b''.join(content.streamRange(parts, 100, 200)) == full[100:200]
+
+
+@pytest.mark.parametrize('start, end', [(0, 24), (0, 5000), (3000, 20000), (20000, 20001)])
+def test_range(content, handler, start, end):
+    full = b''.join(NWContent(handler, { 'batch_sessions': 7, 'spool_path': content.spool_path + '-full' }).stream(IDS, handler.url))
+    parts, length = content.prepare(IDS, handler.url, end)
+    assert b''.join(content.streamRange(parts, start, end)) == full[start:end]
+    parts, length = content.prepare(IDS, handler.url)
+    assert length == len(full)
+    assert b''.join(content.streamRange(parts, start, length)) == full[start:]
+
+
+def test_resolve(content, handler):
+    assert content.resolve('3,1,2') == [3, 1, 2]
+    with pytest.raises(NWQueryError):
+        content.resolve('1,a')
+    with pytest.raises(NWQueryError):
+        content.resolve()
+    content.settings['max_sessions'] = 10
+    with pytest.raises(NWQueryError):
+        content.resolve(list(range(11)))
+
+
+def test_endpoint_ranges(app):
+    client = app.app.test_client()
+    url = '/api/content?sessions=' + ','.join(str(i) for i in IDS)
+    response = client.get(url)
+    full = response.data
+    assert response.status_code == 200
+    assert packetCount(full) == len(IDS)
+    etag = response.headers['ETag']
+
+    response = client.get(url, headers={ 'Range': 'bytes=100-299' })
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 100-299/' + str(len(full))
+    assert response.data == full[100:300]
+
+    response = client.get(url, headers={ 'Range': 'bytes=1000-', 'If-Range': etag })
+    assert response.status_code == 206
+    assert response.data == full[1000:]
+
+    response = client.get(url, headers={ 'Range': 'bytes=-500' })
+    assert response.headers['Content-Range'] == 'bytes ' + str(len(full) - 500) + '-' + str(len(full) - 1) + '/' + str(len(full))
+    assert response.data == full[-500:]
+
+    # A resume against another session set gets the whole download
+    response = client.get(url, headers={ 'Range': 'bytes=10-20', 'If-Range': '"other"' })
+    assert response.status_code == 200
+    assert response.data == full
+
+    response = client.get(url, headers={ 'Range': 'bytes=' + str(len(full)) + '-' })
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */' + str(len(full))
+
+
+def test_endpoint_range_before_spooled(app):
+    client = app.app.test_client()
+    url = '/api/content?sessions=' + ','.join(str(i) for i in range(500, 800))
+    response = client.get(url, headers={ 'Range': 'bytes=0-99' })
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 0-99/*'
+    assert len(response.data) == 100
+    assert client.get(url).data[:100] == response.data
+
+
+def test_endpoint_errors(app):
+    client = app.app.test_client()
+    assert client.get('/api/content?sessions=a,b').status_code == 400
+    assert client.get('/api/content?sessions=1&service=nope').status_code == 400
+    assert client.get('/api/content').status_code == 400
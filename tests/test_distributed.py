@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_distributed.py:
+
+  Tests of the scatter-gather query across several NWDB services: the records cut shared between services, provenance tags, timed out and failing services reported as partial results (kept out of the cache), and the same merge from AsyncNWHandler.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import socket
+
+import pytest
+
+import mock_nwdb
+from NetWitnessHandler.AsyncNWHandler import AsyncNWHandler, AsyncRunner
+
+
+def service(name, port):
+    return { 'name': name, 'host': '127.0.0.1', 'port': str(port), 'path': 'sdk', 'ssl': 'disabled' }
+
+
+@pytest.fixture(scope='module')
+def second():
+    db = mock_nwdb.SyntheticNWDB(400, 8, 0.0, seed=2)
+    server = mock_nwdb.start(db)
+    db.port = server.server_address[1]
+    yield db
+    server.shutdown()
+
+
+@pytest.fixture(scope='module')
+def slow():
+    db = mock_nwdb.SyntheticNWDB(100, 8, 0.0, latency=2, seed=3)
+    server = mock_nwdb.start(db)
+    db.port = server.server_address[1]
+    yield db
+    server.shutdown()
+
+
+# deadPort
+# A local port nothing listens on
+@pytest.fixture(scope='module')
+def deadPort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_records_shared_between_services(nwdb, second, makeHandler):
+    handler = makeHandler(services=[service('a', nwdb.port), service('b', second.port)])
+    result = handler.queryDistributed('select *', 100)
+    assert result['partial'] is False
+    assert { name: (report['status'], report['sessions']) for name, report in result['services'].items() } == { 'a': ('ok', 50), 'b': ('ok', 50) }
+    expected = []
+    for svc in handler.services:
+        for session in handler.querySessionsFrom('select *', svc['url'], 50):
+            session['nw_service'] = svc['name']
+            expected.append(session)
+    assert result['sessions'] == sorted(expected, key=lambda session: session['time'])
+
+    # A service that runs out hands the rest of its share to the others
+    result = handler.queryDistributed('select *', 1000)
+    assert { name: report['sessions'] for name, report in result['services'].items() } == { 'a': 600, 'b': 400 }
+
+
+def test_fan_out_through_query_nwdb(nwdb, second, makeHandler):
+    handler = makeHandler(services=[service('a', nwdb.port), service('b', second.port)])
+    handler.serviceReport(clear=True)
+    sessions = handler.queryNWDB('select *', 10)
+    assert len(sessions) == 10 and { session['nw_service'] for session in sessions } == { 'a', 'b' }
+    assert handler.serviceReport()['partial'] is False
+    assert handler.NWGenerate('select * where service=80')[0]['nw_service'] in ('a', 'b')
+
+
+def test_partial_results(nwdb, slow, deadPort, makeHandler):
+    handler = makeHandler(services=[service('a', nwdb.port), service('slow', slow.port), service('dead', deadPort)],
+                          distrib={ 'timeout': 0.5 }, transport={ 'retries': 0 }, cache={ 'enabled': True })
+    sessions = handler.queryNWDB('select *', 30)
+    report = handler.serviceReport()
+    assert report['partial'] is True
+    assert { name: svc['status'] for name, svc in report['services'].items() } == { 'a': 'ok', 'slow': 'timeout', 'dead': 'error' }
+    assert report['services']['dead']['error']
+    # The shares of the missing services go to the one that answered
+    assert len(sessions) == 30 and { session['nw_service'] for session in sessions } == { 'a' }
+    # Partial results are never cached
+    handler.queryNWDB('select *', 30)
+    assert handler.cache.counters['stores'] == 0 and handler.cache.counters['hits'] == 0
+
+
+def test_async_fan_out_matches_sync(nwdb, second, slow, makeHandler):
+    handler = makeHandler(services=[service('a', nwdb.port), service('b', second.port), service('slow', slow.port)], distrib={ 'timeout': 0.5 })
+    runner = AsyncRunner(AsyncNWHandler(handler))
+    try:
+        result = runner.run(runner.handler.aqueryDistributed('select *', 40))
+    finally:
+        runner.stop()
+    assert result['partial'] is True and result['services']['slow']['status'] == 'timeout'
+    assert result['sessions'] == handler.queryDistributed('select *', 40)['sessions']
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_export.py:
+
+  Tests of NWHandler.export() against the mock NWDB: NDJSON, CSV and Parquet files hold the sessions queryNWDB() returns, batch after batch, and with several services every service is exported.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import csv
+import gzip
+import json
+
+import pyarrow.parquet as pq
+import pytest
+
+import mock_nwdb
+
+QUERY = 'select ip.src, service, size where service=80'
+
+
+def readNDJSON(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize('batch_size', [7, 10000])
+def test_export_ndjson(handler, tmp_path, batch_size):
+    path = str(tmp_path / 'sessions.ndjson')
+    assert handler.export(QUERY, path, batch_size=batch_size, records=250) == 250
+    assert readNDJSON(path) == [{ 'ip_src': s.get('ip_src'), 'service': s.get('service'), 'size': s.get('size') } for s in handler.queryNWDB(QUERY, 250)]
+
+
+def test_export_csv_and_parquet(handler, tmp_path):
+    expected = handler.queryNWDB(QUERY, 100)
+    path = str(tmp_path / 'sessions.csv.gz')
+    assert handler.export(QUERY, path, compression='gzip', batch_size=30, records=100) == 100
+    with gzip.open(path, 'rt', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['ip_src'] for row in rows] == [s['ip_src'] for s in expected]
+    assert [int(row['size']) for row in rows] == [s['size'] for s in expected]
+
+    path = str(tmp_path / 'sessions.parquet')
+    assert handler.export(QUERY, path, batch_size=30, records=100) == 100
+    table = pq.read_table(path)
+    assert table.column_names == ['ip_src', 'service', 'size']
+    assert table.column('size').to_pylist() == [s['size'] for s in expected]
+    # One row group per batch
+    assert pq.ParquetFile(path).num_row_groups == 4
+
+
+def test_export_every_service(nwdb, makeHandler, tmp_path):
+    db = mock_nwdb.SyntheticNWDB(150, 8, 0.0, seed=5)
+    server = mock_nwdb.start(db)
+    try:
+        handler = makeHandler(services=[
+            { 'name': 'a', 'host': '127.0.0.1', 'port': str(nwdb.port), 'path': 'sdk', 'ssl': 'disabled' },
+            { 'name': 'b', 'host': '127.0.0.1', 'port': str(server.server_address[1]), 'path': 'sdk', 'ssl': 'disabled' }])
+        path = str(tmp_path / 'sessions.ndjson')
+        assert handler.export('select ip.src, size', path, batch_size=100) == nwdb.sessions + db.sessions
+        rows = readNDJSON(path)
+        assert [row['nw_service'] for row in rows] == ['a'] * nwdb.sessions + ['b'] * db.sessions
+        assert [row['size'] for row in rows[nwdb.sessions:]] == [s['size'] for s in handler.querySessionsFrom('select ip.src, size', handler.services[1]['url'], None)]
+    finally:
+        server.shutdown()
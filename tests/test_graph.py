@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_graph.py:
+
+  Tests of the communication graph: NWHandler.graph() against the mock NWDB gives the edge counts and byte sums of the sessions queryNWDB() returns, the numpy and dictionary edge tables agree, pruning and the max_edges limit, and /api/graph as node-link JSON and GraphML.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+from collections import Counter
+
+import networkx as nx
+import pytest
+
+from NetWitnessHandler import NWGraph
+from NetWitnessHandler.NWGraph import NWEdgeTable
+from NetWitnessHandler.NWQuery import NWQueryError
+
+SESSIONS = [
+    { 'ip_src': 'a', 'ip_dst': 'b', 'size': 10 },
+    { 'ip_src': 'a', 'ip_dst': 'b', 'size': 5 },
+    { 'ip_src': 'a', 'ip_dst': 'c', 'size': 100 },
+    { 'ip_src': 'c', 'ip_dst': 'a', 'size': 1 },
+    { 'ip_src': 'd', 'ip_dst': 'd', 'size': 7 },
+    { 'ip_src': 'e', 'size': 3 },
+]
+
+
+# edges
+# { (src value, dst value): (sessions, bytes) } of an edge table as returned by table() or prune()
+def edges(table, columns):
+    return { (table.nodes[a], table.nodes[b]): (count, size) for a, b, count, size in zip(*(list(column) for column in columns)) }
+
+
+def test_graph_matches_sessions(makeHandler):
+    handler = makeHandler(graph={ 'page_size': 100, 'batch_sessions': 7, 'max_edges': 0 })
+    table = handler.graph('service=80', records=500)
+    sessions = handler.queryNWDB('select ip.src,ip.dst,size where service=80', 500)
+    counts = Counter((s['ip_src'], s['ip_dst']) for s in sessions)
+    sizes = Counter()
+    for s in sessions:
+        sizes[(s['ip_src'], s['ip_dst'])] += s['size']
+    assert table.sessions == 500 and table.skipped == 0
+    assert edges(table, table.table()) == { edge: (counts[edge], sizes[edge]) for edge in counts }
+    # Without a weight only sessions are counted
+    unweighted = handler.graph(None, 'alias.host', 'action', None, 50)
+    assert sum(count for count in unweighted.table()[2]) == 50 and not any(unweighted.table()[3])
+
+
+def test_graph_rejected(handler):
+    with pytest.raises(NWQueryError):
+        handler.graph(None, 'ip.src', 'ip.dst;drop')
+    with pytest.raises(NWQueryError):
+        handler.graph('service=(')
+
+
+def test_edge_table_without_numpy(monkeypatch):
+    vectorized = NWEdgeTable('ip_src', 'ip_dst', 'size', batch_sessions=2).extend(SESSIONS)
+    monkeypatch.setattr(NWGraph, 'np', None)
+    plain = NWEdgeTable('ip_src', 'ip_dst', 'size', batch_sessions=2).extend(SESSIONS)
+    expected = { ('a', 'b'): (2, 15), ('a', 'c'): (1, 100), ('c', 'a'): (1, 1), ('d', 'd'): (1, 7) }
+    assert edges(plain, plain.table()) == expected
+    monkeypatch.undo()
+    assert edges(vectorized, vectorized.table()) == expected
+    assert vectorized.sessions == 5 and vectorized.skipped == 1
+
+
+@pytest.mark.parametrize('numpy', [True, False])
+def test_edge_table_prune(monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(NWGraph, 'np', None)
+    table = NWEdgeTable('ip_src', 'ip_dst', 'size').extend(SESSIONS)
+    assert set(edges(table, table.prune(min_count=2))) == { ('a', 'b') }
+    assert set(edges(table, table.prune(min_bytes=7))) == { ('a', 'b'), ('a', 'c'), ('d', 'd') }
+    assert set(edges(table, table.prune(top_edges=2))) == { ('a', 'b'), ('a', 'c') }
+    # d -> d gives d a degree of 2, b has a single edge
+    assert set(edges(table, table.prune(min_degree=2))) == { ('a', 'c'), ('c', 'a'), ('d', 'd') }
+    graph = table.toNetworkx(table.prune())
+    assert graph.graph == { 'src': 'ip.src', 'dst': 'ip.dst', 'sessions': 5 }
+    assert graph.edges['a', 'b'] == { 'sessions': 2, 'bytes': 15 }
+    assert graph.nodes['a'] == { 'sessions': 4, 'bytes': 116 }
+    assert graph.nodes['d'] == { 'sessions': 1, 'bytes': 7 }
+
+
+def test_edge_table_max_edges():
+    table = NWEdgeTable('ip_src', 'ip_dst', 'size', batch_sessions=1, max_edges=3)
+    with pytest.raises(NWQueryError):
+        table.extend(SESSIONS)
+
+
+def test_graph_api(app):
+    client = app.app.test_client()
+    payload = { 'where': 'service=80', 'records': 200, 'min_count': 1 }
+    expected = app.nwdb.graph('service=80', records=200)
+    expected = expected.toNetworkx(expected.prune(1))
+    response = client.post('/api/graph', data=json.dumps(payload))
+    assert response.status_code == 200
+    graph = nx.node_link_graph(response.get_json())
+    assert graph.graph == expected.graph
+    assert dict(graph.edges.items()) == dict(expected.edges.items())
+    response = client.post('/api/graph', data=json.dumps(payload), headers={ 'Accept': NWGraph.GRAPHML_MIMETYPE })
+    assert response.mimetype == NWGraph.GRAPHML_MIMETYPE
+    graph = nx.parse_graphml(response.get_data(as_text=True))
+    assert dict(graph.edges.items()) == dict(expected.edges.items())
+    assert client.post('/api/graph', data=json.dumps({ 'top_edges': 'x' })).status_code == 400
+    assert client.post('/api/graph', data=json.dumps({ 'src': 'ip src' })).status_code == 400
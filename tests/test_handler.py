@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_handler.py:
+
+  Tests of NWHandler against the mock NWDB: meta id window paging, the top-k merge of aggregations, time sharding and the query cache.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import heapq
+import pickle
+import random
+import time
+
+import pytest
+
+from NetWitnessHandler.NWQuery import parseQuery, formatTime
+from mock_nwdb import BASE_TIME
+
+
+def timeClause(start, end):
+    return 'time="' + formatTime(start) + '"-"' + formatTime(end) + '"'
+
+
+# * iterGroups
+
+@pytest.mark.parametrize('page_size', [1, 7, 100])
+def test_iter_groups_window_boundaries(handler, nwdb, page_size):
+    # One window returns everything; small windows cut sessions in two at almost every boundary. The last 300 sessions keep the number of windows down.
+    first = nwdb.sessions - 300
+    whole = list(handler.iterGroups('select *', nwdb.sessions))
+    cursor = {}
+    paged = list(handler.iterGroups('select *', page_size, nwdb.offsets[first] + 1, None, cursor))
+    assert len(whole) == nwdb.sessions
+    assert paged == whole[first:]
+    assert [group for group, session in paged] == list(range(first + 1, nwdb.sessions + 1))
+    assert cursor['id2'] == nwdb.mid2
+
+
+def test_iter_groups_from_meta_id(handler, nwdb):
+    # Starting at the first meta id of session 101 skips the first 100 sessions
+    sessions = list(handler.iterGroups('select *', 50, nwdb.offsets[100] + 1))
+    assert sessions[0][0] == 101
+    assert len(sessions) == nwdb.sessions - 100
+
+
+def test_iter_groups_multi_values(handler, nwdb):
+    multi = dict(handler.iterGroups('select ip.dst,time', 7, nwdb.offsets[2500] + 1, multi=True))
+    last = dict(handler.iterGroups('select ip.dst,time', 7, nwdb.offsets[2500] + 1))
+    lists = [group for group, session in multi.items() if isinstance(session['ip_dst'], list)]
+    assert lists
+    for group in lists:
+        assert len(multi[group]['ip_dst']) == 2
+        assert multi[group]['ip_dst'][-1] == last[group]['ip_dst']
+    assert all(multi[group] == last[group] for group in multi if group not in lists)
+
+
+def test_query_nwdb_records(handler):
+    sessions = handler.queryNWDB('select ip.src,time', 250)
+    assert len(sessions) == 250
+    assert [s['time'] for s in sessions] == list(range(BASE_TIME, BASE_TIME + 250))
+
+
+def test_query_nwdb_sends_query_as_written(handler, monkeypatch):
+    sent = []
+    get = handler.transport.get
+    monkeypatch.setattr(handler.transport, 'get', lambda url, params=None, **kwargs: sent.append(params) or get(url, params=params, **kwargs))
+    query = 'select ip.src, time where  service = 80 '
+    assert handler.queryNWDB(query, 20, page_size=1000) == handler.queryNWDB(parseQuery(query).canonical, 20)
+    assert sent[0]['query'] == query.strip() != parseQuery(query).canonical
+    # The records cap bounds the NWDB window itself: 20 sessions of (2 + 3) meta items
+    assert sent[0]['size'] == 20 * 5
+    sent.clear()
+    handler.queryNWDBTable('select ip.src, time', 20)
+    assert sent[0]['size'] == 20 * 5
+
+
+def test_process_netwitness_meta(handler, nwdb):
+    meta = nwdb.query({ 'query': 'select *', 'size': 120 * 9 })
+    sessions = []
+    handler.processNetwitnessMeta(meta, sessions, 100)
+    assert sessions == handler.queryNWDB('select *', 100)
+    # A page ending mid-session still yields the sessions it holds, the last one as far as it goes
+    sessions = []
+    handler.processNetwitnessMeta(meta, sessions, 1000)
+    expected = handler.queryNWDB('select *', len(sessions))
+    assert sessions[:-1] == expected[:-1] and sessions[-1].items() <= expected[-1].items()
+
+
+# * mergeTopK
+
+def test_merge_top_k_complete(handler):
+    lists = [([('a', 5), ('b', 3)], True), ([('b', 4), ('c', 1)], True)]
+    assert handler.mergeTopK(lists, 2) == ([('b', 7), ('a', 5)], 0, True)
+
+
+def test_merge_top_k_truncated(handler):
+    # The second service was cut off at a count of 4: 'c' could hold up to 4 there
+    lists = [([('a', 10), ('b', 9), ('c', 8)], True), ([('a', 6), ('b', 4)], False)]
+    top, error_bound, exact = handler.mergeTopK(lists, 2)
+    assert top == [('a', 16), ('b', 13)]
+    assert error_bound == 4
+    assert exact
+    # Cut off at 3 instead, 'c' (9 + up to 3) could overtake 'b' (8 + 3)
+    lists = [([('a', 10), ('c', 9), ('b', 8)], True), ([('a', 6), ('b', 3)], False)]
+    top, error_bound, exact = handler.mergeTopK(lists, 2)
+    assert top == [('a', 16), ('b', 11)]
+    assert exact is False
+
+
+def test_merge_top_k_exactness(handler):
+    # Whenever mergeTopK() claims exactness the top-k counts must be the true ones, and the error bound must cover every undercount
+    rng = random.Random(7)
+    checked = 0
+    for trial in range(500):
+        values = ['v' + str(i) for i in range(rng.randint(3, 30))]
+        services = [dict((v, rng.randint(1, 1000)) for v in rng.sample(values, rng.randint(1, len(values)))) for s in range(rng.randint(1, 4))]
+        size = rng.randint(1, 8)
+        fetched = rng.randint(1, 12)
+        lists = []
+        for counts in services:
+            pairs = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            lists.append((pairs[:fetched], len(pairs) < fetched))
+        totals = {}
+        for counts in services:
+            for v, c in counts.items():
+                totals[v] = totals.get(v, 0) + c
+        top, error_bound, exact = handler.mergeTopK(lists, size)
+        merged = dict(top)
+        assert all(totals[v] - merged.get(v, 0) <= error_bound for v in merged)
+        if exact:
+            checked += 1
+            assert [c for v, c in top] == heapq.nlargest(size, totals.values())
+            assert all(merged[v] == totals[v] for v in merged)
+    assert checked
+
+
+def test_aggregate_nwdb(handler):
+    ret = handler.aggregateNWDB('service exists', 5, 'ip.src,service')
+    assert set(ret['results']) == set(['ip.src', 'service'])
+    assert all(len(pairs) == 5 for pairs in ret['results'].values())
+    assert ret['exact'] == { 'ip.src': True, 'service': True }
+
+
+# * shardQuery
+
+def test_shard_query(handler):
+    start = BASE_TIME
+    query = 'select ip.src where service=80 && ' + timeClause(start, start + 999) + ' && ip.dst exists'
+    shards = handler.shardQuery(query, 4)
+    assert len(shards) == 4
+    ranges = [parseQuery(s).time_range for s in shards]
+    assert ranges[0][0] == start and ranges[-1][1] == start + 999
+    assert all(ranges[i][1] + 1 == ranges[i + 1][0] for i in range(3))
+    for s in shards:
+        assert s.startswith('select ip.src where service=80 && time=')
+        assert s.endswith(' && ip.dst exists')
+        assert s.count('time=') == 1
+
+
+def test_shard_query_small_range(handler):
+    shards = handler.shardQuery('select * where ' + timeClause(BASE_TIME, BASE_TIME + 2), 10)
+    assert [parseQuery(s).time_range for s in shards] == [(BASE_TIME + i, BASE_TIME + i) for i in range(3)]
+
+
+def test_shard_query_open_range(handler):
+    now = int(time.time())
+    shards = handler.shardQuery('select * where time="' + formatTime(now - 3600) + '"-u', 2)
+    ranges = [parseQuery(s).time_range for s in shards]
+    assert ranges[0][0] == now - 3600
+    assert ranges[1][1] >= now
+
+
+@pytest.mark.parametrize('query', [
+    'select * where service=80',
+    'select * where service=80 || ' + timeClause(BASE_TIME, BASE_TIME + 99),
+    'select * where !(' + timeClause(BASE_TIME, BASE_TIME + 99) + ')',
+    'select * where b="unterminated',
+])
+def test_shard_query_unshardable(handler, query):
+    assert handler.shardQuery(query, 4) is None
+
+
+# * Query cache
+
+def test_cache_immutability(makeHandler):
+    handler = makeHandler(cache={ 'enabled': True, 'ttl': 60, 'settle': 60 })
+    past = 'select ip.src,time where ' + timeClause(BASE_TIME, BASE_TIME + 99)
+    recent = 'select ip.src,time where time="' + formatTime(int(time.time()) - 30) + '"-"' + formatTime(int(time.time()) + 3600) + '"'
+    first = handler.queryNWDB(past, 10)
+    assert handler.queryNWDB(past, 10) == first
+    assert handler.cache.counters['hits'] == 1
+    handler.queryNWDB(recent, 10)
+    handler.queryNWDB('select ip.src where ' + timeClause(BASE_TIME, BASE_TIME + 99) + ' || service=80', 10)
+    expiries = [entry[0] for entry in handler.cache.entries.values()]
+    assert len(expiries) == 3
+    # Only the range that ended more than settle seconds ago never expires
+    assert expiries.count(None) == 1
+    key = [k for k, entry in handler.cache.entries.items() if entry[0] is None][0]
+    assert pickle.loads(handler.cache.entries[key][2]) == first
+
+
+# test_cache_hits_are_copies
+# A caller altering a cached result must not change what the next hit returns, from memory or from disk
+@pytest.mark.parametrize('disk', [False, True])
+def test_cache_hits_are_copies(makeHandler, tmp_path, disk):
+    handler = makeHandler(cache={ 'enabled': True, 'disk_path': str(tmp_path) if disk else '' })
+    query = 'select ip.src,time where ' + timeClause(BASE_TIME, BASE_TIME + 99)
+    first = handler.queryNWDB(query, 10)
+    expected = [dict(session) for session in first]
+    first[0]['ip_src'] = 'changed'
+    first.pop()
+    if disk:
+        handler.cache.clear()
+    second = handler.queryNWDB(query, 10)
+    assert second == expected
+    second[0].clear()
+    assert handler.queryNWDB(query, 10) == expected
+    assert handler.cache.counters['hits'] == 2
@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_jobs.py:
+
+  Tests of NWJobManager against the mock NWDB: spooled chunks hold the sessions queryNWDB() returns, jobs stop at their records limit or when cancelled, every configured service is fetched with its own meta id watermark, and the /api/jobs endpoints drive the same jobs.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+import time
+
+import pytest
+
+import mock_nwdb
+from NetWitnessHandler.NWJobManager import NWJobManager, NWJobLimitError
+
+
+@pytest.fixture
+def makeJobs(tmp_path):
+    managers = []
+
+    def make(handler, **settings):
+        manager = NWJobManager(handler, dict({ 'spool_path': str(tmp_path) }, **settings))
+        managers.append(manager)
+        return manager
+    yield make
+    for manager in managers:
+        manager.shutdown()
+
+
+def results(jobs, job):
+    return [json.loads(line) for line in jobs.results(job)]
+
+
+def test_job_results(handler, makeJobs):
+    jobs = makeJobs(handler, chunk_sessions=40, page_size=25)
+    job = jobs.submit('select ip.src, time, size', 100)
+    job.future.result(timeout=30)
+    status = jobs.get(job.id).toDict()
+    assert (status['status'], status['fetched'], status['chunks']) == ('done', 100, 3)
+    assert results(jobs, job) == handler.queryNWDB('select ip.src, time, size', 100)
+    # Chunks from an offset on
+    assert [json.loads(line) for line in jobs.results(job, offset=2)] == results(jobs, job)[80:]
+    assert list(status['cursor']) == [handler.services[0]['name']]
+
+
+def test_job_rejected(handler, makeJobs):
+    jobs = makeJobs(handler, max_jobs=0)
+    with pytest.raises(NWJobLimitError):
+        jobs.submit('select *', 10)
+
+
+def test_job_every_service(nwdb, makeHandler, makeJobs):
+    db = mock_nwdb.SyntheticNWDB(120, 8, 0.0, seed=6)
+    server = mock_nwdb.start(db)
+    try:
+        handler = makeHandler(services=[
+            { 'name': 'a', 'host': '127.0.0.1', 'port': str(nwdb.port), 'path': 'sdk', 'ssl': 'disabled' },
+            { 'name': 'b', 'host': '127.0.0.1', 'port': str(server.server_address[1]), 'path': 'sdk', 'ssl': 'disabled' }])
+        jobs = makeJobs(handler)
+        job = jobs.submit('select ip.src, size')
+        job.future.result(timeout=60)
+        sessions = results(jobs, job)
+        assert job.status == 'done' and job.fetched == nwdb.sessions + db.sessions
+        assert [s['nw_service'] for s in sessions] == ['a'] * nwdb.sessions + ['b'] * db.sessions
+        # Each service has its own watermark: the last meta id it returned
+        assert job.toDict()['cursor'] == { 'a': nwdb.mid2, 'b': db.mid2 }
+    finally:
+        server.shutdown()
+
+
+def test_job_cancel(makeHandler, makeJobs):
+    db = mock_nwdb.SyntheticNWDB(1000, 8, 0.0, latency=0.05, seed=7)
+    server = mock_nwdb.start(db)
+    try:
+        handler = makeHandler(services=[{ 'name': 'slow', 'host': '127.0.0.1', 'port': str(server.server_address[1]), 'path': 'sdk', 'ssl': 'disabled' }])
+        jobs = makeJobs(handler, chunk_sessions=10, page_size=10)
+        job = jobs.submit('select *')
+        deadline = time.time() + 30
+        while job.fetched == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert jobs.cancel(job.id) is job
+        job.future.result(timeout=30)
+        assert job.status == 'cancelled' and 0 < job.fetched < db.sessions
+        # Chunks spooled before the cancel stay readable
+        assert len(results(jobs, job)) == job.fetched
+        assert jobs.delete(job.id) and jobs.get(job.id) is None
+    finally:
+        server.shutdown()
+
+
+def test_jobs_api(app):
+    client = app.app.test_client()
+    response = client.post('/api/jobs', data=json.dumps({ 'query': 'select ip.src, time', 'records': 30 }))
+    assert response.status_code == 202
+    job = response.get_json()
+    assert response.headers['Location'] == '/api/jobs/' + job['id']
+    app.jobs.get(job['id']).future.result(timeout=30)
+    assert client.get('/api/jobs/' + job['id']).get_json()['status'] == 'done'
+    response = client.get('/api/jobs/' + job['id'] + '/results')
+    assert [json.loads(line) for line in response.get_data().splitlines()] == app.nwdb.queryNWDB('select ip.src, time', 30)
+    assert response.headers['X-Job-Fetched'] == '30'
+    assert client.delete('/api/jobs/' + job['id']).status_code == 200
+    assert client.get('/api/jobs/' + job['id']).status_code == 404
+    response = client.post('/api/jobs', data=json.dumps({ 'query': 'select * where (' }))
+    assert response.status_code == 400 and response.get_json()[0]['type'] == 'input'
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_query.py:
+
+  Tests of the NWQuery parser: canonical text, top level time ranges, time range replacement, the immutability check behind the query cache, and validateQuery() handing back the query as written.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import pytest
+
+from NetWitnessHandler.NWQuery import NWQueryError, parseQuery, canonicalQuery, replaceTimeRange, isImmutable, formatTime, validateQuery, addCondition, VALIDATION_DEFAULTS
+
+JAN1 = 1577836800
+RANGE = 'time="2020-jan-01 00:00:00"-"2020-jan-01 01:00:00"'
+
+
+def test_canonical_text():
+    parsed = parseQuery('SELECT ip.src , IP.DST WHERE service = 80 &&  ' + RANGE)
+    assert parsed.canonical == 'select ip.src,ip.dst where service=80 && ' + RANGE
+    assert parsed.fields == ('ip.src', 'ip.dst')
+    assert parsed.keys == frozenset(['service', 'time'])
+    assert parsed.where == 'service=80 && ' + RANGE
+
+
+def test_canonical_spellings_match():
+    assert canonicalQuery('select ip.src where service=80') == canonicalQuery('Select  ip.src  Where service = 80')
+    assert canonicalQuery('select * where alias.host="A  B"') != canonicalQuery('select * where alias.host="A B"')
+
+
+def test_where_clause():
+    parsed = parseQuery('service=80 && ' + RANGE)
+    assert parsed.fields is None
+    assert parsed.canonical == 'service=80 && ' + RANGE
+
+
+def test_malformed():
+    with pytest.raises(NWQueryError):
+        parseQuery('select a where b="unterminated')
+    with pytest.raises(NWQueryError):
+        parseQuery('   ')
+    # Falls back to the normalized text
+    assert canonicalQuery('SELECT a WHERE b="unterminated') == 'select a where b="unterminated'
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('select * where ' + RANGE, (JAN1, JAN1 + 3600)),
+    ('service=80 && time="2020-jan-01 00:00:00"-u', (JAN1, None)),
+    ('select * where (service=80 && ' + RANGE + ') && ip.src exists', (JAN1, JAN1 + 3600)),
+    ('select * where service=80 || ' + RANGE, None),
+    ('select * where !(' + RANGE + ')', None),
+    ('select * where service=80', None),
+])
+def test_time_range(query, expected):
+    assert parseQuery(query).time_range == expected
+
+
+def test_replace_time_range():
+    query = 'select ip.src where service=80 && ' + RANGE + ' && ip.dst exists'
+    replaced = replaceTimeRange(query, JAN1 + 60, JAN1 + 119)
+    assert replaced == 'select ip.src where service=80 && time="' + formatTime(JAN1 + 60) + '"-"' + formatTime(JAN1 + 119) + '" && ip.dst exists'
+    assert parseQuery(replaced).time_range == (JAN1 + 60, JAN1 + 119)
+    with pytest.raises(NWQueryError):
+        replaceTimeRange('select * where service=80 || ' + RANGE, JAN1, JAN1 + 1)
+
+
+@pytest.mark.parametrize('query, now, settle, expected', [
+    ('select * where ' + RANGE, JAN1 + 7200, 0, True),
+    # Ended 10 minutes ago, but sessions may still arrive for an hour
+    ('select * where ' + RANGE, JAN1 + 4200, 3600, False),
+    ('select * where ' + RANGE, JAN1 + 1800, 0, False),
+    ('select * where time="2020-jan-01 00:00:00"-u', JAN1 + 7200, 0, False),
+    ('select * where service=80 || ' + RANGE, JAN1 + 7200, 0, False),
+    ('select * where service=80', JAN1 + 7200, 0, False),
+    ('select * where b="unterminated', JAN1 + 7200, 0, False),
+])
+def test_is_immutable(query, now, settle, expected):
+    assert isImmutable(query, now, settle) is expected
+
+
+def test_validate_keeps_query_text():
+    query = '  Select IP.SRC ,ip.dst  Where alias.host = "A  B"  &&  ' + RANGE + ' '
+    assert validateQuery(query, dict(VALIDATION_DEFAULTS, max_records=100), 500) == (query.strip(), 100)
+    assert validateQuery('Service = 80', VALIDATION_DEFAULTS, 5, where_only=True) == ('Service = 80', 5)
+
+
+SPAN = dict(VALIDATION_DEFAULTS, require_time=True, default_span=3600)
+INJECTED = 'time="' + formatTime(JAN1 - 3600) + '"-"' + formatTime(JAN1) + '"'
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('Select IP.SRC', 'Select IP.SRC where ' + INJECTED),
+    ('select *  WHERE  alias.host = "A  B"', 'select * where alias.host = "A  B" && ' + INJECTED),
+    ('select * where service=80 || service=443', 'select * where (service=80 || service=443) && ' + INJECTED),
+    ('select ip.src where service=80 Group By ip.src', 'select ip.src where service=80 && ' + INJECTED + ' Group By ip.src'),
+    ('select ip.src order by ip.src desc', 'select ip.src where ' + INJECTED + ' order by ip.src desc'),
+    ('select * where alias.host="group by"', 'select * where alias.host="group by" && ' + INJECTED),
+])
+def test_validate_injects_time_into_query_text(query, expected):
+    injected, records = validateQuery(query, SPAN, now=JAN1)
+    assert injected == expected
+    # The same query as the range ANDed onto the canonical text
+    assert canonicalQuery(injected) == addCondition(parseQuery(query), INJECTED)
+    assert parseQuery(injected).time_range == (JAN1 - 3600, JAN1)
+
+
+def test_validate_injects_time_into_where_clause():
+    assert validateQuery('service=80 || service=443', SPAN, where_only=True, now=JAN1)[0] == '(service=80 || service=443) && ' + INJECTED
@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_singleflight.py:
+
+  Tests of NWSingleFlight and the request coalescing behind NWHandler.cached(): concurrent identical calls run once, every caller gets its own copy of the result, and errors reach every caller.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import threading
+import time
+
+from NetWitnessHandler.NWSingleFlight import NWSingleFlight
+
+
+# coalesce
+# Call flight.do(key, fn) from count threads, the first one leading, and release fn once all the others wait on it. Returns the results (or exceptions) in thread order.
+def coalesce(flight, fn, count=4, key='k'):
+    release = threading.Event()
+    results = [None] * count
+
+    def call(i):
+        try:
+            results[i] = flight.do(key, lambda: release.wait(10) and fn())
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    threads[0].start()
+    while key not in flight.flights:
+        time.sleep(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.flights[key].followers < count - 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_followers_get_copies():
+    calls = []
+    results = coalesce(NWSingleFlight(), lambda: calls.append(1) or [{ 'ip_src': '10.0.0.1', 'ip_dst': ['10.0.0.2'] }])
+    assert calls == [1]
+    assert all(result == [{ 'ip_src': '10.0.0.1', 'ip_dst': ['10.0.0.2'] }] for result in results)
+    assert len(set(id(result) for result in results)) == len(results)
+    results[0][0]['ip_src'] = 'changed'
+    results[1][0]['ip_dst'].append('10.0.0.3')
+    assert results[2] == results[3] == [{ 'ip_src': '10.0.0.1', 'ip_dst': ['10.0.0.2'] }]
+    assert results[1][0]['ip_src'] == '10.0.0.1'
+
+
+def test_errors_reach_every_caller():
+    def fail():
+        raise ValueError('NWDB failed')
+    results = coalesce(NWSingleFlight(), fail)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_unpicklable_results_are_shared():
+    lock = threading.Lock()
+    results = coalesce(NWSingleFlight(), lambda: { 'lock': lock }, count=2)
+    assert results[0] is results[1]
+
+
+def test_handler_coalesced_results_are_copies(nwdb, makeHandler, monkeypatch):
+    handler = makeHandler(cache={ 'enabled': False })
+    sent = []
+    get = handler.transport.get
+    monkeypatch.setattr(handler.transport, 'get', lambda url, params=None, **kwargs: sent.append(params) or get(url, params=params, **kwargs))
+    nwdb.latency = 0.2
+    try:
+        results = [None] * 3
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, handler.queryNWDB('select ip.src, ip.dst where service=1234', 5))) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+    finally:
+        nwdb.latency = 0
+    assert len(sent) == 1
+    expected = handler.queryNWDB('select ip.src, ip.dst where service=1234', 5)
+    for session in results[0]:
+        session['ip_src'] = 'changed'
+    assert results[1] == results[2] == expected
@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_store.py:
+
+  Tests of NWSessionStore: answers from the synced sessions must match what queryNWDB() returns from NWDB. The mock ignores where clauses, so NWDB's answer to a narrower query is its full result filtered here.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import pytest
+
+from NetWitnessHandler.NWQuery import formatTime
+from mock_nwdb import BASE_TIME
+
+SYNCED = 'select ip.src,ip.dst,alias.host,action,service where service exists'
+FIELDS = 'select ip.src,ip.dst,alias.host,action,service'
+
+
+@pytest.fixture
+def store(makeHandler, tmp_path):
+    handler = makeHandler(store={ 'enabled': True, 'path': str(tmp_path / 'store.sqlite'), 'queries': [SYNCED], 'retention': 20 * 365 * 86400 })
+    handler.store.sync()
+    return handler.store
+
+
+def timeClause(start, end):
+    return 'time="' + formatTime(start) + '"-"' + formatTime(end) + '"'
+
+
+# values
+# Values of a meta key in a session fetched with iterGroups(multi=True)
+def values(session, key):
+    value = session.get(key)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+# reference
+# What NWDB returns for the synced fields over [start, end] with the sessions filtered by match, keyed as queryNWDB() keys them
+def reference(handler, start, end, match):
+    ret = []
+    for group, session in handler.iterGroups(FIELDS + ',time', 1000, multi=True):
+        if start <= session['time'] <= end and match(session):
+            ret.append(dict((key, value[-1] if isinstance(value, list) else value) for key, value in session.items() if key != 'time'))
+    return ret
+
+
+def test_synced(store, nwdb):
+    status = store.status()
+    assert len(status) == 1
+    assert status[0]['sessions'] == nwdb.sessions
+
+
+def test_answer_matches_query_nwdb(store, handler, nwdb):
+    query = FIELDS + ' where service exists && ' + timeClause(BASE_TIME, BASE_TIME + nwdb.sessions - 1)
+    local = store.answer(store.handler.checkQuery(query)[0])
+    assert local == handler.queryNWDB(query, nwdb.sessions)
+    # queryNWDB() itself answers from the store
+    hits = store.counters['hits']
+    assert store.handler.queryNWDB(query, nwdb.sessions) == local
+    assert store.counters['hits'] == hits + 1
+
+
+def test_answer_records(store, handler):
+    query = FIELDS + ' where service exists && ' + timeClause(BASE_TIME, BASE_TIME + 999)
+    assert store.answer(query, 25) == handler.queryNWDB(query, 25)
+
+
+def multiValued(handler):
+    return next(values(s, 'ip_dst')[0] for g, s in handler.iterGroups('select ip.dst', 1000, multi=True) if len(values(s, 'ip_dst')) > 1)
+
+
+@pytest.mark.parametrize('where, match', [
+    # Case-insensitive like NWDB
+    ('alias.host="HOST3"', lambda s: any(v.lower() == 'host3' for v in values(s, 'alias_host'))),
+    ('action="ACTION7",action12', lambda s: any(v.lower() in ('action7', 'action12') for v in values(s, 'action'))),
+    ('action begins "ACTION1"', lambda s: any(v.startswith('action1') for v in values(s, 'action'))),
+    ('service=80,443 && ip.src contains ".1"', lambda s: s['service'] in (80, 443) and '.1' in s['ip_src']),
+    ('!(service=80) || alias.host="host1"', lambda s: s['service'] != 80 or 'host1' in values(s, 'alias_host')),
+    ('ip.dst !exists', lambda s: not values(s, 'ip_dst')),
+])
+def test_answer_filtered(store, handler, nwdb, where, match):
+    query = FIELDS + ' where service exists && (' + where + ') && ' + timeClause(BASE_TIME + 100, BASE_TIME + 2099)
+    assert store.answer(query) == reference(handler, BASE_TIME + 100, BASE_TIME + 2099, match)
+
+
+def test_answer_multi_valued(store, handler, nwdb):
+    # The first ip.dst of a multi-valued session isn't the one queryNWDB() reports, but it still selects the session
+    value = multiValued(handler)
+    for op, match in (('=', lambda s: value in values(s, 'ip_dst')), ('!=', lambda s: any(v != value for v in values(s, 'ip_dst')))):
+        query = FIELDS + ' where service exists && ip.dst' + op + value + ' && ' + timeClause(BASE_TIME, BASE_TIME + nwdb.sessions - 1)
+        expected = reference(handler, BASE_TIME, BASE_TIME + nwdb.sessions - 1, match)
+        assert expected
+        assert store.answer(query) == expected
+
+
+@pytest.mark.parametrize('query', [
+    # Not ANDed with the synced query's condition
+    FIELDS + ' where ' + timeClause(BASE_TIME, BASE_TIME + 99),
+    # A meta key the synced query doesn't select
+    'select ip.src,size where service exists && ' + timeClause(BASE_TIME, BASE_TIME + 99),
+    # No time range, or one past the watermark
+    FIELDS + ' where service exists',
+    FIELDS + ' where service exists && time="' + formatTime(BASE_TIME) + '"-u',
+    # Conditions SQLite can't evaluate like NWDB
+    FIELDS + ' where service exists && ip.src=10.0.0.0/8 && ' + timeClause(BASE_TIME, BASE_TIME + 99),
+])
+def test_answer_declines(store, query):
+    assert store.answer(query) is None
@@ -0,0 +1,69 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_stream.py:
+
+  Tests of the streamed /api/queryNWDB responses: NDJSON, JSON array and MessagePack bodies carry the sessions a buffered request returns, validation errors still get a 400, and with several services the merged result is streamed with its X-NW-Services headers.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+
+import msgpack
+import pytest
+
+import mock_nwdb
+
+
+def post(app, payload, **kwargs):
+    return app.app.test_client().post('/api/queryNWDB', data=json.dumps(payload), **kwargs)
+
+
+@pytest.mark.parametrize('records', [1, 999, 1000, 2500])
+def test_stream_matches_buffered(app, records):
+    expected = app.nwdb.queryNWDB('select *', records)
+    response = post(app, { 'query': 'select *', 'records': records, 'stream': 'ndjson' })
+    assert response.status_code == 200 and response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.get_data().splitlines()] == expected
+
+
+def test_stream_formats(app):
+    expected = app.nwdb.queryNWDB('select *', 50)
+    response = post(app, { 'query': 'select *', 'records': 50, 'stream': 'json' })
+    assert response.mimetype == 'application/json' and json.loads(response.get_data()) == expected
+    response = post(app, { 'query': 'select *', 'records': 50, 'stream': 'msgpack' })
+    assert response.mimetype == 'application/msgpack'
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(response.get_data())
+    assert list(unpacker) == expected
+    # Accept: application/x-ndjson streams without a 'stream' parameter
+    response = post(app, { 'query': 'select *', 'records': 50 }, headers={ 'Accept': 'application/x-ndjson' })
+    assert [json.loads(line) for line in response.get_data().splitlines()] == expected
+
+
+def test_stream_rejected_before_start(app):
+    response = post(app, { 'query': 'select * where (', 'stream': 'ndjson' })
+    assert response.status_code == 400 and response.get_json()[0]['type'] == 'input'
+
+
+def test_stream_several_services(app, monkeypatch):
+    db = mock_nwdb.SyntheticNWDB(200, 8, 0.0, seed=4)
+    server = mock_nwdb.start(db)
+    try:
+        url = 'http://127.0.0.1:%d/sdk' % server.server_address[1]
+        monkeypatch.setattr(app.nwdb, 'services', app.nwdb.services[:1] + [{ 'name': 'second', 'url': url }])
+        expected = app.nwdb.queryNWDB('select *', 60)
+        response = post(app, { 'query': 'select *', 'records': 60, 'stream': 'ndjson' })
+        assert [json.loads(line) for line in response.get_data().splitlines()] == expected
+        assert json.loads(response.headers['X-NW-Services']) == { app.nwdb.services[0]['name']: 'ok', 'second': 'ok' }
+        assert response.headers['X-NW-Partial'] == 'false'
+    finally:
+        server.shutdown()
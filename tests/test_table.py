@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_table.py:
+
+  Tests of NWResultTable and NWHandler.queryNWDBTable(): the typed column buffers give back the values queryNWDB() returns, through iter_dicts(), to_numpy() and to_arrow().
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+from NetWitnessHandler.NWResultTable import NWResultTable, DICTIONARY_MIN
+
+
+def asList(value):
+    return value if isinstance(value, list) else [value]
+
+
+def test_table_matches_query(handler):
+    table = handler.queryNWDBTable('select *', 500)
+    sessions = [session for group, session in handler.iterGroups('select *', 500, multi=True)][:500]
+    assert len(table) == 500
+    assert table.multi == { 'ip_dst' }
+    for row, session in zip(table.iter_dicts(), sessions):
+        assert row.keys() == session.keys()
+        for key, value in row.items():
+            assert value == (asList(session[key]) if key in table.multi else session[key])
+    assert { name: column.kind for name, column in table.columns.items() if name not in table.multi } == {
+        'time': int, 'ip_src': str, 'service': int, 'size': int, 'tcp_dstport': int, 'alias_host': str, 'action': str }
+
+
+def test_table_rejected_query(handler):
+    result = handler.queryNWDBTable('select * where (', 10)
+    assert result[0]['type'] == 'input'
+
+
+def test_column_fallbacks():
+    rows = [{ 'group': g, 'type': 'a.b', 'value': v } for g, v in enumerate([1, 2, 2 ** 70, 3])]
+    rows += [{ 'group': g, 'type': 'mixed', 'value': v } for g, v in enumerate([1.5, 'x', True])]
+    rows += [{ 'group': g, 'type': 'host', 'value': 'host' + str(g % 3) } for g in range(4)]
+    table = NWResultTable()
+    # Rows arrive grouped by session, as NWDB returns them
+    table.extend(sorted(rows, key=lambda row: row['group']))
+    assert table.columns['a_b'].kind is object and table.column('a_b') == [1, 2, 2 ** 70, 3]
+    assert table.columns['mixed'].kind is object and table.column('mixed') == [1.5, 'x', True, None]
+    assert table.columns['host'].kind is str and table.columns['host'].dictionary == ['host0', 'host1', 'host2']
+    assert table.column('host') == ['host0', 'host1', 'host2', 'host0']
+
+
+def test_distinct_strings_stop_dictionary_encoding():
+    table = NWResultTable()
+    table.extend({ 'group': g, 'type': 'ip.src', 'value': '10.0.%d.%d' % (g // 256, g % 256) } for g in range(DICTIONARY_MIN * 4))
+    assert table.columns['ip_src'].kind is object
+    assert table.column('ip_src')[-1] == '10.0.15.255'
+
+
+def test_numpy_and_arrow(handler):
+    table = handler.queryNWDBTable('select *', 300)
+    arrays = table.to_numpy()
+    assert arrays['size'].dtype.kind == 'i' and arrays['alias_host'].dtype == object
+    assert arrays['size'].tolist() == table.column('size') and arrays['alias_host'].tolist() == table.column('alias_host')
+    arrow = table.to_arrow()
+    assert str(arrow.schema.field('alias_host').type) == 'dictionary<values=string, indices=int32, ordered=0>'
+    assert arrow.column('action').to_pylist() == table.column('action')
+    assert arrow.column('ip_dst').to_pylist() == table.column('ip_dst')
+
+    sparse = NWResultTable()
+    sparse.extend([{ 'group': 1, 'type': 'size', 'value': 10 }, { 'group': 2, 'type': 'action', 'value': 'get' }, { 'group': 3, 'type': 'size', 'value': 30 }])
+    assert sparse.to_arrow().to_pydict() == { 'group': [1, 2, 3], 'size': [10, None, 30], 'action': [None, 'get', None] }
+    assert sparse.to_numpy()['action'].tolist() == [None, 'get', None]
@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""\
+  test_tail.py:
+
+  Tests of continuous queries against the mock NWDB: NWHandler.tail() returns each new session once and whole, even when its meta is still arriving at a poll, and NWTailManager pollers push the same sessions to their subscribers as Server-Sent Events.
+
+"""
+
+__author__ = "Wes Riley"
+__contact__ = "elysian.blue@gmail.com"
+__version__ = "0.2.202308152021"
+__maintainer__ = "Wes Riley"
+__email__ = "elysian.blue@gmail.com"
+__status__ = "Development"
+
+import json
+import time
+
+import pytest
+
+import mock_nwdb
+from NetWitnessHandler.NWTail import NWTailManager
+
+
+@pytest.fixture
+def live(makeHandler):
+    db = mock_nwdb.SyntheticNWDB(20, 8, 0.0, seed=8)
+    server = mock_nwdb.start(db)
+    db.handler = makeHandler(services=[{ 'name': 'live', 'host': '127.0.0.1', 'port': str(server.server_address[1]), 'path': 'sdk', 'ssl': 'disabled' }])
+    yield db
+    server.shutdown()
+
+
+def sessions(db, first, last):
+    return db.handler.querySessionsFrom('select *', db.handler.services[0]['url'], None)[first:last]
+
+
+def test_tail_split_session_returned_once(live):
+    handler = live.handler
+    cursor = handler.tail('select *')['cursor']
+    assert cursor == { 'live': live.mid2 }
+    live.append(5)
+    # Sessions 20 and 21 are written, 22 only half
+    live.ingested = live.offsets[22] + 4
+    first = handler.tail('select *', cursor)
+    # The half written session is held back and the cursor left before its first meta id
+    assert first['sessions'] == sessions(live, 20, 22)
+    assert first['cursor'] == { 'live': live.offsets[22] }
+    live.ingested = None
+    # Session 22 comes back whole, once; 24 is the newest and waits for the next one
+    second = handler.tail('select *', first['cursor'])
+    assert second['sessions'] == sessions(live, 22, 24)
+    live.append(1)
+    third = handler.tail('select *', second['cursor'])
+    assert third['sessions'] == sessions(live, 24, 25)
+    # Nothing new: the held back session stays held
+    assert handler.tail('select *', third['cursor']) == { 'sessions': [], 'cursor': third['cursor'], 'reset': [] }
+
+
+def test_tail_poller_events(live):
+    manager = NWTailManager(live.handler, { 'interval': 0.05, 'heartbeat': 1 })
+    try:
+        sub = manager.subscribe('select *')
+        events = manager.events(sub)
+        assert next(events).startswith('retry: ')
+        # The poller's first poll only sets the cursor to now
+        deadline = time.time() + 10
+        while sub.poller.polls == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        live.append(3)
+        live.ingested = live.offsets[-2] + 2
+        received = []
+        for count in (2, 3):
+            while len(received) < count:
+                event = next(events)
+                assert not event.startswith('event: error')
+                if not event.startswith(':'):
+                    lines = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+                    received.extend(json.loads(lines['data']))
+                    cursor = json.loads(lines['id'])
+            live.ingested = None
+            live.append(1)
+        # The half written session 22 is sent once, whole
+        assert received == sessions(live, 20, 23)
+        assert cursor == { 'live': live.offsets[23] }
+        # A client reconnecting with that cursor only gets what came after it
+        assert manager.subscribe('select *', json.dumps(cursor)).events.empty()
+        events.close()
+        assert manager.stats()['subscribers'] == 1
+    finally:
+        manager.shutdown()
+
+
+def test_tail_api(app):
+    client = app.app.test_client()
+    first = client.post('/api/tail', data=json.dumps({ 'query': 'select *' })).get_json()
+    assert first['sessions'] == [] and list(first['cursor']) == [app.nwdb.services[0]['name']]
+    assert client.post('/api/tail', data=json.dumps({ 'query': 'select *', 'cursor': { 'a': 'x' } })).status_code == 400
+    assert client.get('/api/tail', query_string={ 'query': 'select * where (' }).status_code == 400